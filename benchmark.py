@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+import uuid
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+from bs4 import BeautifulSoup
+
+import deposit
+import standin
+import textclean
+import crossref
+from crossref import serialize_doi_batch
+from deposit import content_hash, doi_batch, pubtypes, template_for
+from ledger import DepositLedger
+
+# Micro-benchmarks for the hot parts of the DOI scripts.
+# Use as (example): python3 benchmark.py ledger --sizes 1000 10000 100000 200000
+#                   python3 benchmark.py build --records 2000 --authors 5
+#                   python3 benchmark.py clean --corpus cris_publications.json
+#                   python3 benchmark.py affiliations --records 500 --authors 20
+#                   python3 benchmark.py validate --schema-dir schemas
+#                   python3 benchmark.py suite --records 10 100 1000 --save before.json
+#                   python3 benchmark.py suite --records 10 100 1000 --compare before.json
+
+
+def synthetic_person(i, j):
+    chalmers = j % 3 != 2
+    org = {'Id': 'org-' + str(j % 7), 'DisplayPathEng': 'Chalmers, Department ' + str(j % 7), 'NameEng': 'Department ' + str(j % 7),
+           'OrganizationTypes': [{'NameEng': 'Chalmers department' if chalmers else 'University'}],
+           'City': 'Gothenburg', 'Country': 'Sweden',
+           'Identifiers': [] if chalmers else [{'Type': {'Value': 'ROR_ID'}, 'Value': 'https://ror.org/00000000' + str(j % 10)}]}
+    return {'PersonData': {'FirstName': 'Given' + str(j), 'LastName': 'Surname' + str(i), 'IdentifierOrcid': ['0000-0002-1825-' + str(j).zfill(4)]},
+            'Organizations': [{'OrganizationData': org}]}
+
+
+def synthetic_record(i, authors=3):
+    # Cleaned field values of one publication, as passed to DepositTemplate.build
+    return {'doi': '10.63959/cth.bench/' + str(i), 'url': 'https://research.chalmers.se/en/publication/' + str(500000 + i),
+            'title': 'A synthetic thesis title number ' + str(i), 'abstract': 'Lorem ipsum dolor sit amet. ' * 40,
+            'lang': 'en', 'year': '2025', 'isbn': '978-91-8103-' + str(i % 1000).zfill(3) + '-1', 'disp_date': '2025-10-01T10:00:00',
+            'degree': 'PhD', 'version': '1', 'persons': [synthetic_person(i, j) for j in range(authors)],
+            'conference': {'Name': 'Conference ' + str(i), 'City': 'Gothenburg', 'Country': {'NameEng': 'Sweden'},
+                           'StartDate': '2025-06-01', 'EndDate': '2025-06-03'}}
+
+
+def bench_build(args):
+    # Records/second for building the deposit XML of each CrossRef type (and building + serializing)
+    records = [synthetic_record(i, args.authors) for i in range(args.records)]
+    for pubtype in pubtypes:
+        template = template_for(pubtype)
+
+        def build():
+            for record in records:
+                template.build(record)
+
+        def build_serialize():
+            for record in records:
+                root, body = doi_batch(record['doi'], '20250101000000')
+                body.append(template.build(record))
+                serialize_doi_batch(root)
+
+        best_build = min(timeit.repeat(build, number=1, repeat=args.repeat))
+        best_serialize = min(timeit.repeat(build_serialize, number=1, repeat=args.repeat))
+        print(pubtype.ljust(14) + ' build: ' + str(int(args.records / best_build)).rjust(8) + ' records/s'
+              + '   build + serialize: ' + str(int(args.records / best_serialize)).rjust(8) + ' records/s')
+
+
+class UncachedTemplate(deposit.DepositTemplate):
+    # Resolves and renders every affiliation again (as before the organisation cache)
+
+    def affiliation(self, org):
+        return self.render_institution(deposit._institution(org))
+
+
+def bench_affiliations(args):
+    # Records/second for multi-author records with and without the organisation cache
+    records = [synthetic_record(i, args.authors) for i in range(args.records)]
+    for pubtype in ['dissertation', 'proceeding']:
+        for name, template in [('uncached', UncachedTemplate(pubtype)), ('cached', deposit.DepositTemplate(pubtype))]:
+
+            def build():
+                for record in records:
+                    template.build(record)
+
+            best = min(timeit.repeat(build, number=1, repeat=args.repeat))
+            print(pubtype.ljust(14) + name.ljust(10) + str(int(args.records / best)).rjust(8) + ' records/s   '
+                  + '{:.2f}'.format(best / (args.records * args.authors) * 1e6).rjust(8) + ' us/author')
+
+
+def synthetic_texts(count):
+    # Titles and abstracts in the shapes that come out of CRIS (plain, <p>-wrapped, inline markup, entities)
+    texts = []
+    for i in range(count):
+        texts.append('Modelling of heat transfer in porous media ' + str(i))
+        texts.append('CO<sub>2</sub> capture with <i>in situ</i> monitoring &ndash; part ' + str(i))
+        texts.append('<p>' + 'The thesis studies transport phenomena in fibre networks. ' * 12 + '</p><p>' + 'Results show a 5&nbsp;% increase. ' * 6 + str(i) + '</p>')
+        texts.append('Abstract without markup, long enough to matter. ' * 20 + str(i))
+        texts.append('<p>Kinetics of H<sub>2</sub>O<sub>2</sub> &amp; O<sub>3</sub> &gt; 10&#8201;ppm</p>\r\n<p>Second paragraph ' + str(i) + '</p>')
+    return texts
+
+
+def corpus_texts(path):
+    # Titles and abstracts from saved CRIS search results (a JSON response with Publications, or JSON lines)
+    with open(path, 'r') as cfile:
+        content = cfile.read()
+    try:
+        publs = json.loads(content)
+        publs = publs['Publications'] if isinstance(publs, dict) else publs
+    except ValueError:
+        publs = [json.loads(line) for line in content.splitlines() if line.strip()]
+    texts = []
+    for publ in publs:
+        for field in ['Title', 'Abstract']:
+            if publ.get(field):
+                texts.append(publ[field])
+    return texts
+
+
+def bench_clean(args):
+    # clean_text against BeautifulSoup(..., "lxml").text: identical output and time per string
+    texts = corpus_texts(args.corpus) if args.corpus else synthetic_texts(args.records)
+
+    def soup():
+        return [BeautifulSoup(text.rstrip('\r\n').strip(), "lxml").text for text in texts]
+
+    def uncached():
+        textclean._clean.cache_clear()
+        return [textclean.clean_text(text) for text in texts]
+
+    def cached():
+        return [textclean.clean_text(text) for text in texts]
+
+    expected = soup()
+    differences = [text for text, a, b in zip(texts, expected, uncached()) if a != b]
+    print('strings: ' + str(len(texts)) + ', differing from BeautifulSoup: ' + str(len(differences)))
+    for text in differences[:5]:
+        print('  ' + repr(text[:120]))
+    for name, func in [('BeautifulSoup', soup), ('clean_text', uncached), ('clean_text (cached)', cached)]:
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print(name.ljust(20) + '{:.2f}'.format(best / len(texts) * 1e6).rjust(10) + ' us/string')
+
+
+def bench_ledger(args):
+    # Lookup cost for the deposit ledger at growing ledger sizes (should stay flat)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for size in args.sizes:
+            pidfile = os.path.join(tmpdir, 'pubids_' + str(size) + '.log')
+            with open(pidfile, 'w') as pfile:
+                for i in range(size):
+                    pfile.write(str(uuid.UUID(int=i)) + '\t10.63959/cth.diss/' + str(i) + '\n')
+
+            ledger = DepositLedger(os.path.join(tmpdir, 'ledger_' + str(size) + '.sqlite'), pidfile)
+            keys = [(str(uuid.UUID(int=(i * 7919) % size)), '10.63959/cth.diss/' + str((i * 7919) % size)) for i in range(args.lookups)]
+
+            def lookup():
+                for pubid, doi in keys:
+                    ledger.contains(pubid, doi)
+
+            best = min(timeit.repeat(lookup, number=1, repeat=args.repeat))
+            print('ledger rows: ' + str(len(ledger)).rjust(8) + '   lookup: ' + '{:.2f}'.format(best / args.lookups * 1e6) + ' us')
+            ledger.close()
+
+
+def bench_validate(args):
+    # Schema compile time and validation time per record (serialized single-record doi_batch files).
+    # Exit status 1 if there is no schema or a file of any pubtype is not valid.
+    validator = crossref.DepositValidator(args.schema_dir, args.schema_version)
+    if not validator.available:
+        print('No schema at ' + validator.schema_file + ' (copy it with fetch-crossref-schema.py)')
+        sys.exit(1)
+    start = time.perf_counter()
+    crossref._schema(validator.schema_file)
+    print('compile: ' + '{:.1f}'.format((time.perf_counter() - start) * 1000) + ' ms (once per process)')
+    records = [synthetic_record(i, args.authors) for i in range(args.records)]
+    invalid_types = []
+    for pubtype in pubtypes:
+        template = template_for(pubtype)
+        files = []
+        for record in records:
+            root, body = doi_batch(record['doi'], '20250101000000', args.schema_version)
+            body.append(template.build(record))
+            files.append(serialize_doi_batch(root))
+
+        def validate():
+            for xml_bytes in files:
+                validator.errors(xml_bytes)
+
+        best = min(timeit.repeat(validate, number=1, repeat=args.repeat))
+        errors = [validator.errors(xml_bytes) for xml_bytes in files]
+        invalid = [file_errors for file_errors in errors if file_errors]
+        print(pubtype.ljust(14) + '{:.3f}'.format(best / args.records * 1000).rjust(8) + ' ms/record   '
+              + ('valid' if not invalid else 'INVALID (' + str(len(invalid)) + ' of ' + str(len(files)) + '): ' + invalid[0][0]))
+        if invalid:
+            invalid_types.append(pubtype)
+    if invalid_types:
+        print('Not valid against ' + validator.schema_file + ': ' + ', '.join(invalid_types))
+        sys.exit(1)
+
+
+# CrossRef type and degree for the CRIS publication types of the synthetic corpus
+crossref_types = {'Doctoral thesis': 'dissertation', 'Licentiate thesis': 'dissertation', 'Book': 'book', 'Report': 'report',
+                  'Paper in proceeding': 'proceeding', 'Preprint': 'preprint'}
+degrees = {'Doctoral thesis': 'PhD', 'Licentiate thesis': 'Licentiate'}
+
+
+def record_of(publ, title, abstract):
+    # Deposit record of a CRIS publication (cleaned title and abstract), with the field handling of the DOI scripts
+    cris_pubtype = publ['PublicationType']['NameEng']
+    return {'doi': str(publ['IdentifierDoi'][0]), 'url': 'https://research.chalmers.se/en/publication/' + str(publ['IdentifierCplPubid'][0]),
+            'title': title, 'abstract': abstract, 'lang': publ['Language']['Iso'], 'year': str(publ['Year']),
+            'isbn': str(publ['IdentifierIsbn'][0]) if publ.get('IdentifierIsbn') else '', 'disp_date': str(publ.get('DispDate', '')),
+            'degree': degrees.get(cris_pubtype, ''), 'version': '1', 'persons': publ['Persons'], 'conference': publ.get('Conference') or []}
+
+
+def measure(func, repeat):
+    # Best time of repeat runs, and the peak of the memory allocated by one (extra) run
+    best = min(timeit.repeat(func, number=1, repeat=repeat))
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def run_batch(publs, args, tmpdir):
+    # Whole create-doi-batch.py run against the stand-in (in this process, on a free port).
+    # Returns the wall time, the peak memory (max RSS) of the script and the stand-in counters.
+    service = standin.StandIn(publs, seed=args.seed, cris_latency=args.cris_latency, deposit_latency=args.deposit_latency,
+                              doi_latency=args.doi_latency)
+    server = standin.serve(service, port=0)
+    base_url = 'http://127.0.0.1:' + str(server.server_address[1]) + '/'
+    env = dict(os.environ, CRIS_API_EP=base_url + 'cris/publications/', CROSSREF_API_EP=base_url + 'crossref/servlet/deposit',
+               DOI_RESOLVER=base_url + 'doi/', CROSSREF_UID='benchmark', CROSSREF_PW='benchmark', CREATE_DOI='true',
+               LOGFILE=os.path.join(tmpdir, 'log.txt'), PUBIDFILE=os.path.join(tmpdir, 'pubids.log'),
+               RUNTIME=os.path.join(tmpdir, 'lastrun.txt'), DOI_PREFIX='10.63959', CRIS_BASE_URL='https://research.chalmers.se/en/publication/',
+               MAXRECORDS='0', PAGESIZE=str(args.page_size), DEPOSIT_BATCH_RECORDS=str(args.batch_records),
+               CROSSREF_TRACK_WAIT='0', XML_ARCHIVE_DIR='', CRIS_RATE_LIMIT='', DOI_RATE_LIMIT='', CROSSREF_RATE_LIMIT='')
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'create-doi-batch.py')
+    try:
+        with open(os.path.join(tmpdir, 'batch.out'), 'w') as out:
+            start = time.perf_counter()
+            process = subprocess.Popen([sys.executable, script], cwd=tmpdir, env=env, stdout=out, stderr=subprocess.STDOUT)
+            # wait4 gives the resource usage of this run only
+            pid, status, usage = os.wait4(process.pid, 0)
+            elapsed = time.perf_counter() - start
+            process.returncode = os.waitstatus_to_exitcode(status)
+    finally:
+        server.shutdown()
+        server.server_close()
+    with service.lock:
+        counters = dict(service.counters, registered=len(service.registered))
+    return elapsed, usage.ru_maxrss * 1024, counters
+
+
+def suite_size(count, args):
+    # Results per stage for a synthetic corpus of count publications
+    publs = standin.synthetic_publications(count, args.seed, authors=(args.authors[0], args.authors[-1]), affiliations=args.affiliations,
+                                           paragraphs=(args.paragraphs[0], args.paragraphs[-1]), mixed=not args.theses_only)
+    pages = [json.dumps({'TotalCount': count, 'Publications': publs[start:start + args.page_size]}) for start in range(0, count, args.page_size)]
+    titles = [publ['Title'] for publ in publs]
+    abstracts = [publ['Abstract'] for publ in publs]
+    records = [record_of(publ, textclean.clean_text(publ['Title']), textclean.clean_text(publ['Abstract'])) for publ in publs]
+    templates = [template_for(crossref_types[publ['PublicationType']['NameEng']]) for publ in publs]
+    built = [template.build(record) for template, record in zip(templates, records)]
+
+    def parse():
+        for page in pages:
+            json.loads(page)
+
+    def clean():
+        textclean._clean.cache_clear()
+        for title, abstract in zip(titles, abstracts):
+            textclean.clean_text(title)
+            textclean.clean_text(abstract)
+
+    def build():
+        for template, record in zip(templates, records):
+            template.build(record)
+
+    def content_hashes():
+        for publication in built:
+            content_hash(publication)
+
+    def serialize():
+        for record, publication in zip(records, built):
+            root, body = doi_batch(record['doi'], '20250101000000')
+            body.append(publication)
+            serialize_doi_batch(root)
+
+    results = {}
+    for name, func in [('parse', parse), ('clean', clean), ('build', build), ('hash', content_hashes), ('serialize', serialize)]:
+        best, peak = measure(func, args.repeat)
+        results[name] = {'records_per_s': count / best, 'peak_bytes': peak}
+
+    # Schema check of the serialized deposit files (DEPOSIT_BATCH_RECORDS records each), only with the CrossRef schema in --schema-dir
+    validator = crossref.DepositValidator(args.schema_dir)
+    if validator.available:
+        crossref._schema(validator.schema_file)
+        files = []
+        for start in range(0, count, args.batch_records):
+            root, body = doi_batch('benchmark-' + str(start), '20250101000000')
+            for publication in built[start:start + args.batch_records]:
+                body.append(publication)
+            files.append(serialize_doi_batch(root))
+
+        def validate():
+            for xml_bytes in files:
+                validator.errors(xml_bytes)
+
+        best, peak = measure(validate, args.repeat)
+        results['validate'] = {'records_per_s': count / best, 'peak_bytes': peak,
+                               'invalid_files': len([xml_bytes for xml_bytes in files if validator.errors(xml_bytes)])}
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Ledger with every other record already deposited
+        pidfile = os.path.join(tmpdir, 'pubids.log')
+        with open(pidfile, 'w') as pfile:
+            for publ in publs[::2]:
+                pfile.write(publ['Id'] + '\t' + publ['IdentifierDoi'][0] + '\n')
+        ledger = DepositLedger(os.path.join(tmpdir, 'ledger.sqlite'), pidfile)
+        keys = [(publ['Id'], publ['IdentifierDoi'][0]) for publ in publs]
+
+        def lookup():
+            for pubid, doi in keys:
+                ledger.contains(pubid, doi)
+
+        best, peak = measure(lookup, args.repeat)
+        results['ledger'] = {'records_per_s': count / best, 'peak_bytes': peak}
+        ledger.close()
+
+    if not args.no_network:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            elapsed, peak, counters = run_batch(publs, args, tmpdir)
+        results['batch run'] = {'records_per_s': count / elapsed, 'peak_bytes': peak, 'deposited': counters.get('deposited_records', 0)}
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def bench_suite(args):
+    # Records/second and peak memory per stage for growing synthetic corpora, optionally saved / compared
+    # with an earlier result (e.g. from another commit)
+    report = {'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'settings': {
+        'authors': args.authors, 'affiliations': args.affiliations, 'paragraphs': args.paragraphs, 'mixed': not args.theses_only,
+        'seed': args.seed, 'network': not args.no_network, 'cris_latency': args.cris_latency,
+        'deposit_latency': args.deposit_latency, 'doi_latency': args.doi_latency}, 'results': {}}
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as bfile:
+            baseline = json.load(bfile)
+        print('comparing with ' + args.compare + ' (commit ' + str(baseline.get('commit') or '?') + ')')
+    regressions = []
+    for count in args.records:
+        results = suite_size(count, args)
+        report['results'][str(count)] = results
+        print('records: ' + str(count))
+        for stage, result in results.items():
+            line = '  ' + stage.ljust(10) + str(int(result['records_per_s'])).rjust(10) + ' records/s' + \
+                   '{:.1f}'.format(result['peak_bytes'] / 1048576).rjust(10) + ' MB peak'
+            before = (baseline or {}).get('results', {}).get(str(count), {}).get(stage)
+            if before:
+                change = result['records_per_s'] / before['records_per_s'] - 1
+                line += '   ' + '{:+.1f}'.format(change * 100).rjust(7) + ' %'
+                if change < -args.tolerance / 100:
+                    line += '  SLOWER'
+                    regressions.append(str(count) + ' ' + stage)
+            print(line)
+        if 'validate' not in results:
+            print('  (no CrossRef schema in ' + args.schema_dir + ', validation not measured)')
+        elif results['validate']['invalid_files']:
+            print('  ' + str(results['validate']['invalid_files']) + ' deposit file(s) NOT valid against the CrossRef schema')
+    if args.save:
+        with open(args.save, 'w') as sfile:
+            json.dump(report, sfile, indent=2)
+    if regressions:
+        print('slower than ' + args.compare + ' by more than ' + str(args.tolerance) + ' %: ' + ', '.join(regressions))
+        sys.exit(1)
+
+
+parser = ArgumentParser(description='Micro-benchmarks for the Research2CrossRef scripts.', formatter_class=ArgumentDefaultsHelpFormatter)
+subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+ledger_parser = subparsers.add_parser('ledger', help='Deposit ledger lookups', formatter_class=ArgumentDefaultsHelpFormatter)
+ledger_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 200000], help='Ledger sizes (rows)')
+ledger_parser.add_argument('--lookups', type=int, default=10000, help='Lookups per measurement')
+ledger_parser.add_argument('--repeat', type=int, default=5, help='Repetitions (best is reported)')
+ledger_parser.set_defaults(func=bench_ledger)
+
+build_parser = subparsers.add_parser('build', help='Deposit XML building per CrossRef type', formatter_class=ArgumentDefaultsHelpFormatter)
+build_parser.add_argument('--records', type=int, default=2000, help='Records per measurement')
+build_parser.add_argument('--authors', type=int, default=3, help='Authors per record')
+build_parser.add_argument('--repeat', type=int, default=3, help='Repetitions (best is reported)')
+build_parser.set_defaults(func=bench_build)
+
+clean_parser = subparsers.add_parser('clean', help='Title/abstract cleaning', formatter_class=ArgumentDefaultsHelpFormatter)
+clean_parser.add_argument('--corpus', help='Saved CRIS search result (JSON) or JSON lines with Title/Abstract, default synthetic')
+clean_parser.add_argument('--records', type=int, default=500, help='Synthetic records (5 strings each)')
+clean_parser.add_argument('--repeat', type=int, default=3, help='Repetitions (best is reported)')
+clean_parser.set_defaults(func=bench_clean)
+
+affiliations_parser = subparsers.add_parser('affiliations', help='Organisation cache on multi-author records', formatter_class=ArgumentDefaultsHelpFormatter)
+affiliations_parser.add_argument('--records', type=int, default=500, help='Records per measurement')
+affiliations_parser.add_argument('--authors', type=int, default=20, help='Authors per record')
+affiliations_parser.add_argument('--repeat', type=int, default=3, help='Repetitions (best is reported)')
+affiliations_parser.set_defaults(func=bench_affiliations)
+
+validate_parser = subparsers.add_parser('validate', help='Deposit XML schema validation', formatter_class=ArgumentDefaultsHelpFormatter)
+validate_parser.add_argument('--schema-dir', default=os.getenv('SCHEMA_DIR') or 'schemas', help='Directory with the CrossRef schema files')
+validate_parser.add_argument('--schema-version', default='5.4.0', help='CrossRef schema version')
+validate_parser.add_argument('--records', type=int, default=1000, help='Records per measurement')
+validate_parser.add_argument('--authors', type=int, default=5, help='Authors per record')
+validate_parser.add_argument('--repeat', type=int, default=3, help='Repetitions (best is reported)')
+validate_parser.set_defaults(func=bench_validate)
+
+suite_parser = subparsers.add_parser('suite', help='Stage timings and a whole batch run against the stand-in (standin.py)', formatter_class=ArgumentDefaultsHelpFormatter)
+suite_parser.add_argument('--records', type=int, nargs='+', default=[10, 100, 1000], help='Corpus sizes (publications)')
+suite_parser.add_argument('--authors', type=int, nargs=2, default=[1, 50], metavar=('MIN', 'MAX'), help='Authors per publication')
+suite_parser.add_argument('--affiliations', type=int, default=3, help='Maximum affiliations per author')
+suite_parser.add_argument('--paragraphs', type=int, nargs=2, default=[20, 200], metavar=('MIN', 'MAX'), help='Sentences per abstract')
+suite_parser.add_argument('--theses-only', action='store_true', help='Only doctoral theses (default: mixed publication types)')
+suite_parser.add_argument('--seed', type=int, default=1, help='Random seed of the corpus')
+suite_parser.add_argument('--page-size', type=int, default=50, help='CRIS page size')
+suite_parser.add_argument('--batch-records', type=int, default=50, help='Records per deposit (DEPOSIT_BATCH_RECORDS) in the batch run')
+suite_parser.add_argument('--cris-latency', type=float, default=0.05, help='Stand-in seconds per CRIS request')
+suite_parser.add_argument('--deposit-latency', type=float, default=0.2, help='Stand-in seconds per CrossRef deposit')
+suite_parser.add_argument('--doi-latency', type=float, default=0.01, help='Stand-in seconds per doi.org check')
+suite_parser.add_argument('--no-network', action='store_true', help='Skip the batch run against the stand-in')
+suite_parser.add_argument('--schema-dir', default=os.getenv('SCHEMA_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schemas'),
+                          help='Directory with the CrossRef schema files (validate stage)')
+suite_parser.add_argument('--repeat', type=int, default=3, help='Repetitions (best is reported)')
+suite_parser.add_argument('--save', help='Write the results (JSON) to this file')
+suite_parser.add_argument('--compare', help='Earlier results (JSON) to compare with')
+suite_parser.add_argument('--tolerance', type=float, default=10.0, help='Percent slower than --compare that counts as a regression (exit status 1)')
+suite_parser.set_defaults(func=bench_suite)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import datetime
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+# Script for backfilling CrossRef DOIs for older CRIS publication records (before the first created date of
+# create-doi-batch.py). The CreatedDate range is split into shards (month, quarter or year) and every shard is
+# harvested and deposited by its own create-doi-batch.py process, --workers of them at a time.
+#
+# Every shard checkpoints on its own in the state directory:
+#   <shard>.runtime   RUNTIME (watermark) of the shard, a rerun harvests from there (committed after every page with CRIS_SORT=LatestEventDate,
+#                     otherwise at the end of the shard)
+#   <shard>.log       output of the shard process
+#   <shard>.runlog    LOGFILE of the shard
+#   <shard>.done      written when the shard has finished cleanly (create-doi-batch.py exits 0 only if no record was held
+#                     or failed), finished shards are skipped when the backfill is run again
+# The ledger (LEDGER_DB / PUBIDFILE) is shared with the regular batch runs, so records already deposited are not
+# deposited again. All other settings come from the environment / .env as for create-doi-batch.py.
+
+# Use as (example): python3 create-doi-backfill.py --from 2015-01-01 --to 2025-08-26 --shard month --workers 6
+#                   python3 create-doi-backfill.py --from 2015-01-01 --to 2025-08-26 --list
+
+load_dotenv()
+batch_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'create-doi-batch.py')
+shard_units = ['month', 'quarter', 'year']
+# Exit code of create-doi-batch.py when the same RUNTIME file is in use by another run
+exit_running = 75
+
+
+def parse_day(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def shards(first_day, last_day, unit):
+    # (label, from, to) per shard, from inclusive and to exclusive; the first and last shard are cut to the range
+    months = {'month': 1, 'quarter': 3, 'year': 12}[unit]
+    day = first_day
+    while day < last_day:
+        start = datetime.date(day.year, day.month - (day.month - 1) % months, 1)
+        month = start.month - 1 + months
+        end = min(datetime.date(start.year + month // 12, month % 12 + 1, 1), last_day)
+        if unit == 'month':
+            label = start.strftime('%Y-%m')
+        elif unit == 'quarter':
+            label = str(start.year) + '-q' + str((start.month - 1) // 3 + 1)
+        else:
+            label = str(start.year)
+        yield label, day, end
+        day = end
+
+
+def shard_env(label, first_day, end_day, state_dir):
+    env = dict(os.environ)
+    env['CREATED_FROM'] = first_day.isoformat()
+    env['CREATED_TO'] = end_day.isoformat()
+    env['RUNTIME'] = os.path.join(state_dir, label + '.runtime')
+    env['LOGFILE'] = os.path.join(state_dir, label + '.runlog')
+    # Batch ids and deposit file names must not collide between shards running at the same time
+    env['BATCH_ID_PREFIX'] = (os.getenv('BATCH_ID_PREFIX') or 'cth') + '-bf' + label.replace('-', '')
+    env['XML_FILE_PREFIX'] = (os.getenv('XML_FILE_PREFIX') or '') + 'bf' + label + '_'
+    # The whole shard is harvested, results of the submissions still pending are followed up by the next regular run
+    env['MAXRECORDS'] = '0'
+    env['CROSSREF_TRACK_WAIT'] = os.getenv('BACKFILL_TRACK_WAIT') or '0'
+    metrics_file = os.getenv('METRICS_FILE')
+    if metrics_file:
+        base, ext = os.path.splitext(metrics_file)
+        env['METRICS_FILE'] = base + '-' + label + ext
+    return env
+
+
+def run_shard(label, first_day, end_day, state_dir, verbose=False):
+    # Run create-doi-batch.py for one shard, (label, exit code, seconds)
+    started = time.time()
+    if verbose:
+        print('Shard ' + label + ' (' + first_day.isoformat() + ' - ' + end_day.isoformat() + ') started')
+    with open(os.path.join(state_dir, label + '.log'), 'a') as outfile:
+        process = subprocess.Popen([sys.executable, batch_script], env=shard_env(label, first_day, end_day, state_dir),
+                                   stdout=outfile, stderr=subprocess.STDOUT, cwd=os.getcwd())
+        returncode = process.wait()
+    # Exit code 1: records were held or failed (or the harvest failed), the shard stays open and is run again
+    if returncode == 0:
+        with open(os.path.join(state_dir, label + '.done'), 'w') as donefile:
+            donefile.write(datetime.datetime.now().strftime("%Y%m%d%H%M%S") + '\n')
+    seconds = time.time() - started
+    if returncode == 0:
+        result = 'done'
+    elif returncode == exit_running:
+        result = 'skipped, another run of this shard is still in progress'
+    else:
+        result = 'failed or incomplete (exit code ' + str(returncode) + ', see ' + os.path.join(state_dir, label + '.log') + ')'
+    print('Shard ' + label + ': ' + result + ', ' + '{:.1f}'.format(seconds) + ' s')
+    return label, returncode, seconds
+
+
+parser = ArgumentParser(description='Backfill CrossRef DOIs for a historical CreatedDate range, split into shards that are processed in parallel by create-doi-batch.py. \nUse as (example): python3 create-doi-backfill.py --from 2015-01-01 --to 2025-08-26 --shard month --workers 6',
+                        formatter_class=ArgumentDefaultsHelpFormatter)
+parser.add_argument("-v", "--verbose", action="store_true", help="increase verbosity")
+parser.add_argument("--from", dest="first_day", required=True, help="First CreatedDate of the backfill (YYYY-MM-DD)")
+parser.add_argument("--to", dest="last_day", default="2025-08-26", help="End of the backfill, exclusive (YYYY-MM-DD), the first created date of the regular batch runs")
+parser.add_argument("--shard", default="month", choices=shard_units, help="Size of the shards")
+parser.add_argument("-w", "--workers", type=int, default=4, help="Shards processed in parallel (create-doi-batch.py processes)")
+parser.add_argument("--state-dir", default=os.getenv("BACKFILL_DIR") or "backfill", help="Directory for the checkpoints and output of the shards")
+parser.add_argument("--list", action="store_true", help="Only list the shards and their state")
+parser.add_argument("--reset", action="store_true", help="Process finished shards again (their checkpoints are kept, the ledger skips what was deposited)")
+args = parser.parse_args()
+
+try:
+    first_day = parse_day(args.first_day)
+    last_day = parse_day(args.last_day)
+except ValueError as e:
+    parser.error('--from and --to must be dates (YYYY-MM-DD): ' + str(e))
+if first_day >= last_day:
+    parser.error('--from must be before --to')
+
+os.makedirs(args.state_dir, exist_ok=True)
+all_shards = list(shards(first_day, last_day, args.shard))
+
+if args.list:
+    for label, shard_from, shard_to in all_shards:
+        done = os.path.exists(os.path.join(args.state_dir, label + '.done'))
+        runtime_file = os.path.join(args.state_dir, label + '.runtime')
+        checkpoint = ''
+        if os.path.exists(runtime_file):
+            with open(runtime_file, 'r') as rtfile:
+                checkpoint = ', checkpoint ' + rtfile.read().strip()
+        print(label + '\t' + shard_from.isoformat() + ' - ' + shard_to.isoformat() + '\t' + ('done' if done else 'open') + checkpoint)
+    exit()
+
+todo = [shard for shard in all_shards if args.reset or not os.path.exists(os.path.join(args.state_dir, shard[0] + '.done'))]
+print('Backfill ' + first_day.isoformat() + ' - ' + last_day.isoformat() + ': ' + str(len(all_shards)) + ' shards, '
+      + str(len(all_shards) - len(todo)) + ' already done, ' + str(min(max(args.workers, 1), max(len(todo), 1))) + ' workers')
+
+started = time.time()
+with ThreadPoolExecutor(max_workers=max(args.workers, 1)) as executor:
+    results = list(executor.map(lambda shard: run_shard(shard[0], shard[1], shard[2], args.state_dir, args.verbose), todo))
+
+failed = [label for label, returncode, seconds in results if returncode != 0]
+print('Backfill finished in ' + '{:.1f}'.format(time.time() - started) + ' s: ' + str(len(results) - len(failed)) + ' shards done, '
+      + str(len(failed)) + ' failed or incomplete' + (' (' + ', '.join(failed) + ', run again to resume)' if failed else ''))
+if failed:
+    exit(1)
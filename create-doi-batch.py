@@ -1,55 +1,140 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import xml.etree.ElementTree as ET
-import xml.dom.minidom
 import datetime
 import requests
-from bs4 import BeautifulSoup
+import atexit
+import httpclient
+import metrics
+import time
+import itertools
+import subprocess
+import sys
 from dotenv import load_dotenv
 import os
-import json
-from time import sleep
-import csv
+import locking
+from ledger import DepositLedger
+from runlog import open_runlog
+from pipeline import Pipeline
+from textclean import clean_text
+from deposit import doi_batch, template_for, content_hash, content_fields, changed_fields
+from cris import PublicationHarvester, Watermark, CrisWriteBack, sorted_by_event_date
+from crossref import check_dois, doi_resolver, serialize_doi_batch, archive_xml, deposit_files, DepositPacker, DepositValidator, SubmissionTracker
 
 # Script for batch creating new CrossRef DOIs from Chalmers CRIS publication records (Doctoral theses only!).
 # Sample XML: https://gitlab.com/crossref/schema/-/blob/master/best-practice-examples/dissertation.5.4.0.xml
 # Schema: https://crossref.org/schemas/common5.4.0.xsd
 # Guide: https://www.crossref.org/documentation/schema-library/markup-guide-metadata-segments/
 
-m_encoding = 'UTF-8'
-
 # Params
 load_dotenv()
 crossref_ep = os.getenv("CROSSREF_API_EP")
 crossref_uid = os.getenv("CROSSREF_UID")
 crossref_pw = os.getenv("CROSSREF_PW")
+crossref_status_ep = os.getenv("CROSSREF_STATUS_EP") or str(crossref_ep).replace('/deposit', '/submissionDownload')
+track_backoff = os.getenv("CROSSREF_TRACK_BACKOFF") or 30
+track_wait = os.getenv("CROSSREF_TRACK_WAIT") or 0
 logfile = os.getenv("LOGFILE")
 pidfile = os.getenv("PUBIDFILE")
+ledger_db = os.getenv("LEDGER_DB") or str(pidfile) + '.sqlite'
 runtime_file = os.getenv("RUNTIME")
 doi_prefix = os.getenv("DOI_PREFIX")
 cris_base_url = os.getenv("CRIS_BASE_URL")
 cris_api_ep = os.getenv("CRIS_API_EP")
 pubtype_id = os.getenv("PUBTYPE_ID")
 start_date = os.getenv("START_DATE")
-max_records = os.getenv("MAXRECORDS")
-
-# Get last runtime from file
-with open(os.getenv("RUNTIME"), 'r') as file:
-    lastrun_date = file.read().rstrip()
-    lastrun_day = lastrun_date[:10]
+max_records = os.getenv("MAXRECORDS") or 0
+page_size = os.getenv("PAGESIZE") or 50
+deposit_batch_records = os.getenv("DEPOSIT_BATCH_RECORDS") or 1
+deposit_batch_bytes = os.getenv("DEPOSIT_BATCH_BYTES") or 5000000
+watermark_overlap = os.getenv("WATERMARK_OVERLAP") or 10
+cris_sort = os.getenv("CRIS_SORT") or ''
+pipeline_queue_size = os.getenv("PIPELINE_QUEUE_SIZE") or 100
+build_workers = os.getenv("PIPELINE_BUILD_WORKERS") or 1
+deposit_workers = os.getenv("PIPELINE_DEPOSIT_WORKERS") or 2
+cris_workers = os.getenv("PIPELINE_CRIS_WORKERS") or 4
+xml_validation = str(os.getenv("XML_VALIDATION") or 'true').lower() == 'true'
+metadata_updates = str(os.getenv("METADATA_UPDATES") or 'false').lower() == 'true'
+created_from = os.getenv("CREATED_FROM")
+created_to = os.getenv("CREATED_TO")
+batch_id_prefix = os.getenv("BATCH_ID_PREFIX") or 'cth'
+xml_file_prefix = os.getenv("XML_FILE_PREFIX") or ''
+worker_count = int(os.getenv("WORKER_COUNT") or 1)
+worker_index = os.getenv("WORKER_INDEX")
+run_lock_on = str(os.getenv("RUN_LOCK") or 'true').lower() == 'true'
+
+# Exit code of a run that found another run of the same RUNTIME file (and worker) still in progress
+exit_running = 75
+
+# MAXRECORDS cuts the harvest short. Unless the records come in LatestEventDate order, the watermark cannot move past a
+# truncated harvest and every run would take the same first records again, so that combination is refused.
+if int(max_records) > 0 and not sorted_by_event_date(cris_sort):
+    print('MAXRECORDS=' + str(max_records) + ' needs CRIS_SORT=LatestEventDate (ascending), otherwise the watermark never moves. '
+          'Set CRIS_SORT or MAXRECORDS=0, exiting!')
+    exit(1)
+
+# WORKER_COUNT > 1 without WORKER_INDEX: start one process per worker (WORKER_INDEX 0 .. WORKER_COUNT - 1) and wait for them.
+# Every worker handles the publications whose pubid hashes to it (locking.worker_of) and keeps its own
+# watermark (RUNTIME.<index>of<count>); the ledger, LOGFILE and PUBIDFILE are shared.
+if worker_count > 1 and not worker_index:
+    workers = [subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=dict(os.environ, WORKER_INDEX=str(index)))
+               for index in range(worker_count)]
+    # A failed or incomplete worker outweighs one that found its previous run still in progress (exit_running)
+    codes = [worker.wait() for worker in workers]
+    exit(max([code for code in codes if code not in (0, exit_running)] or codes))
+worker_index = int(worker_index or 0)
+if worker_count > 1:
+    shared_runtime_file = runtime_file
+    runtime_file = str(runtime_file) + '.' + str(worker_index) + 'of' + str(worker_count)
+    # Batch ids and deposit file names of the workers must not collide
+    batch_id_prefix = batch_id_prefix + '-w' + str(worker_index)
+    xml_file_prefix = xml_file_prefix + 'w' + str(worker_index) + '_'
+
+# Buffered run log (LOGFILE), per-host HTTP counters are written to it when the script exits
+log = open_runlog(logfile)
+atexit.register(httpclient.log_summary, log)
+
+# Stage timings and counters (METRICS_FILE, stage summary in the run log) and profile (PROFILE_FILE), written when the script exits
+metrics.setup('create-doi-batch', log)
+
+# Requests per second for each service (empty or 0 = unlimited)
+httpclient.set_rate_limit(cris_api_ep, os.getenv("CRIS_RATE_LIMIT"))
+httpclient.set_rate_limit(doi_resolver(), os.getenv("DOI_RATE_LIMIT"))
+httpclient.set_rate_limit(crossref_ep, os.getenv("CROSSREF_RATE_LIMIT"))
+
+# One run at a time per RUNTIME file (and worker): a run that starts while the previous one is still going exits
+if run_lock_on:
+    run_lock = locking.try_lock(str(runtime_file) + '.run')
+    if run_lock is None:
+        print('Another run using ' + str(runtime_file) + ' is still in progress, exiting!')
+        log.event('Another run using ' + str(runtime_file) + ' is still in progress, exiting', stage='harvest', status='running')
+        exit(exit_running)
+
+# Ledger of already deposited (pubid, DOI) pairs, PUBIDFILE is imported into it.
+# DOIs are claimed in the ledger before they are checked, so concurrent runs never deposit the same DOI twice.
+ledger = DepositLedger(ledger_db, pidfile, timeout=os.getenv("LEDGER_TIMEOUT") or 60, owner=locking.process_owner(log.run_id),
+                       claim_ttl=os.getenv("CLAIM_TTL") or 3600)
+atexit.register(ledger.release_claims)
+
+# CrossRef results of submitted batches (also the ones still pending from earlier runs) are polled in the background
+tracker = SubmissionTracker(ledger, crossref_status_ep, crossref_uid, crossref_pw, backoff=track_backoff)
+tracker.start()
+
+# Harvest from the LatestEventDate of the last processed record (minus WATERMARK_OVERLAP minutes), kept in the RUNTIME file
+# (committed after every page only if CRIS_SORT sorts on LatestEventDate ascending)
+watermark = Watermark(runtime_file, watermark_overlap, ordered=sorted_by_event_date(cris_sort), initial_file=shared_runtime_file if worker_count > 1 else None)
 
-instname_txt = 'Chalmers University of Technology'
-instplace_txt = 'Gothenburg, Sweden'
-ror_id = 'https://ror.org/040wg7k59'
-
-depositor_name = 'Chalmers Research Support'
-depositor_email = 'research.lib@chalmers.se'
 cris_updated_by = 'crossref/doi'
+
+# New DOIs are added to the CRIS records (CRIS update stage)
+writeback = CrisWriteBack(cris_api_ep, cris_updated_by, retries=os.getenv("CRIS_WRITEBACK_RETRIES") or 2)
 cris_update = 'no'
 
 # The absolute first created date for records to be included (static)
 first_created_day = '2025-08-26'
 
+# CreatedDate range of the query: from first_created_day on, or [CREATED_FROM, CREATED_TO) for one shard of a backfill (see create-doi-backfill.py)
+created_range = '%5B' + str(created_from or first_created_day) + '%20TO%20' + (str(created_to) + '%7D' if created_to else '*%5D')
+
 # Debug, test
 cris_update = 'false'
 #create_doi = 'false'
@@ -68,357 +153,409 @@ cris_update = 'false'
 # IsLocal:true
 # IsMainFulltext:true
 
-cris_query = '_exists_%3AValidatedBy%20_exists_:IdentifierDoi%20%26%26%20PublicationType.Id%3A%22645ba094-942d-400a-84cc-ec47ee01ec48%22%20%26%26%20LatestEventDate%3A%5B' + str(lastrun_day) + '%20TO%20*%5D%20%26%26%20CreatedDate%3A%5B' + str(first_created_day) + '%20TO%20*%5D%20%26%26%20DataObjects.IsLocal%3Atrue%20%26%26%20DataObjects.IsMainFulltext%3Atrue%20%26%26%20IsDraft%3Afalse%20%26%26%20IsDeleted%3Afalse%20%26%26%20!_exists_%3AReplacedById%20%26%26%20_exists_%3AIdentifierIsbn&max=50&start=0&selectedFields=Id%2CIdentifierDoi%2CIdentifierCplPubid%2CTitle%2CAbstract%2CYear%2CPersons.PersonData.FirstName%2CPersons.PersonData.LastName%2CPersons.PersonData.IdentifierOrcid%2CIncludedPapers%2CLanguage.Iso%2CIdentifierIsbn%2CDispDate%2CSeries%2CKeywords%2CPersons.Organizations.OrganizationData.Id%2CPersons.Organizations.OrganizationData.OrganizationTypes.NameEng%2CPersons.Organizations.OrganizationData.Country%2CPersons.Organizations.OrganizationData.City%2CPersons.Organizations.OrganizationData.NameEng%2CPersons.Organizations.OrganizationData.DisplayPathEng%2CPublicationType.NameEng%2CPersons.Organizations.OrganizationData.Identifiers'
+cris_query = '_exists_%3AValidatedBy%20_exists_:IdentifierDoi%20%26%26%20PublicationType.Id%3A%22645ba094-942d-400a-84cc-ec47ee01ec48%22%20%26%26%20LatestEventDate%3A%5B%22' + watermark.query_from() + '%22%20TO%20*%5D%20%26%26%20CreatedDate%3A' + created_range + '%20%26%26%20DataObjects.IsLocal%3Atrue%20%26%26%20DataObjects.IsMainFulltext%3Atrue%20%26%26%20IsDraft%3Afalse%20%26%26%20IsDeleted%3Afalse%20%26%26%20!_exists_%3AReplacedById%20%26%26%20_exists_%3AIdentifierIsbn'
+cris_fields = 'Id%2CIdentifierDoi%2CIdentifierCplPubid%2CTitle%2CAbstract%2CYear%2CPersons.PersonData.FirstName%2CPersons.PersonData.LastName%2CPersons.PersonData.IdentifierOrcid%2CIncludedPapers%2CLanguage.Iso%2CIdentifierIsbn%2CDispDate%2CSeries%2CKeywords%2CPersons.Organizations.OrganizationData.Id%2CPersons.Organizations.OrganizationData.OrganizationTypes.NameEng%2CPersons.Organizations.OrganizationData.Country%2CPersons.Organizations.OrganizationData.City%2CPersons.Organizations.OrganizationData.NameEng%2CPersons.Organizations.OrganizationData.DisplayPathEng%2CPublicationType.NameEng%2CPersons.Organizations.OrganizationData.Identifiers%2CLatestEventDate%2CUpdatedDate'
 #print(cris_query)
 
-research_lookup_url = str(cris_api_ep) + '?query=' + cris_query
-research_lookup_headers = {'Accept': 'application/json'}
+# CrossRef deposit XML
+schema_version = os.getenv("SCHEMA_VERSION") or "5.4.0"
+
+# Deposit files are checked against the CrossRef schema (SCHEMA_DIR) before they are posted, rejected records go to REJECT_FILE
+validator = DepositValidator(os.getenv("SCHEMA_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schemas'), schema_version,
+                             os.getenv("REJECT_FILE"), enabled=xml_validation)
+if xml_validation and not validator.available:
+    print('No CrossRef schema at ' + validator.schema_file + ', deposit XML is NOT validated before it is posted (copy it with fetch-crossref-schema.py).')
+    log.event('No CrossRef schema at ' + validator.schema_file + ', deposit XML is NOT validated', stage='validate', status='unavailable')
+
+# Records are packed into multi-record doi_batch files (at most DEPOSIT_BATCH_RECORDS records / DEPOSIT_BATCH_BYTES bytes each)
+packer = DepositPacker(max_records=deposit_batch_records, max_bytes=deposit_batch_bytes)
+batch_numbers = itertools.count(1)
+
+def update_cris_record(cris_pubid, doi_id, expected_updated=None):
+    # Update publication record in Research with the new DOI
+    print('Updating publication ID: ' + cris_pubid + ' in Research.')
+    started = time.monotonic()
+    result, detail = writeback.add_doi(cris_pubid, doi_id, expected_updated)
+    if result == 'updated' or result == 'exists':
+        print(cris_pubid + ' UPDATED\n')
+        log.event('Research CRIS publication ' + cris_pubid + ' has been updated!', stage='cris_update', status='ok',
+                  pubid=cris_pubid, doi=doi_id, duration=time.monotonic() - started, result=result)
+    else:
+        print(cris_pubid + ' could not be updated! ' + result + ': ' + str(detail) + '\n')
+        log.event('Research CRIS publication ' + cris_pubid + ' count NOT be updated! (' + result + ': ' + str(detail) + ')', stage='cris_update', status=result,
+                  pubid=cris_pubid, doi=doi_id, duration=time.monotonic() - started)
+
+def valid_record(record, batch_id, create_date):
+    # Schema check of one packed record on its own, an invalid record is reported and left out of the deposit.
+    # It is not held back by the watermark: it is harvested again when it has been corrected in CRIS.
+    publication, info = record
+    root, body = doi_batch(batch_id, create_date, schema_version)
+    body.append(publication)
+    errors = validator.errors(serialize_doi_batch(root))
+    if not errors:
+        return True
+    print('Deposit XML for ' + info['doi'] + ' is not valid and will NOT be posted: ' + errors[0])
+    log.event('Deposit XML for DOI: ' + info['doi'] + ' (Research publ: ' + info['cris_url'] + ') is not valid and was NOT posted: ' + '; '.join(errors[:5]),
+              stage='validate', status='rejected', pubid=info['pubid'], doi=info['doi'], errors=len(errors))
+    validator.reject(info['pubid'], info['doi'], errors)
+    watermark.done(info['pubid'])
+    return False
+
+def deposit_batch(records):
+    # Create one doi_batch file for the packed records, post it to CrossRef and handle each record.
+    # Returns the records that should get their new DOI in CRIS.
+    batch_enum = next(batch_numbers)
+    create_date = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+    xml_filename = xml_file_prefix + create_date + '_' + str(batch_enum - 1) + '.xml'
+
+    # Every submission gets a unique batch id, it is used to look up the CrossRef result later
+    batch_id = batch_id_prefix + '-' + create_date + '-' + str(batch_enum)
+
+    root, body = doi_batch(batch_id, create_date, schema_version)
+    for publication, info in records:
+        body.append(publication)
+
+    # Post XML to CrossRef endpoint
+    # https://www.crossref.org/documentation/register-maintain-records/direct-deposit-xml/https-post/
+
+    # Serialize in memory (a copy is kept in XML_ARCHIVE_DIR if set)
+    xml_bytes = serialize_doi_batch(root)
+
+    # Check the file against the CrossRef schema before it is posted. If it is not valid, the records are
+    # checked one by one and the file is built again without the invalid ones. The rebuilt file is checked
+    # too: if it is still not valid, nothing is posted and the records are tried again next run.
+    if validator.errors(xml_bytes):
+        records = [record for record in records if valid_record(record, batch_id, create_date)]
+        if not records:
+            return
+        root, body = doi_batch(batch_id, create_date, schema_version)
+        for publication, info in records:
+            body.append(publication)
+        xml_bytes = serialize_doi_batch(root)
+        errors = validator.errors(xml_bytes)
+        if errors:
+            print('Deposit file ' + xml_filename + ' is not valid and will NOT be posted: ' + errors[0])
+            for publication, info in records:
+                log.event('Deposit file for DOI: ' + info['doi'] + ' (Research publ: ' + info['cris_url'] + ') is not valid and was NOT posted: ' + '; '.join(errors[:5]),
+                          stage='validate', status='rejected', pubid=info['pubid'], doi=info['doi'], errors=len(errors), batch=batch_id)
+                validator.reject(info['pubid'], info['doi'], errors)
+                watermark.hold(info['pubid'])
+            return
+
+    doi_ids = [info['doi'] for publication, info in records]
+    archive_xml(xml_bytes, xml_filename)
+
+    files = deposit_files(crossref_uid, crossref_pw, xml_bytes, xml_filename)
+
+    print('Trying to create ' + str(len(records)) + ' DOI(s): ' + ', '.join(doi_ids) + ' using file: ' + xml_filename + '\n')
+
+    started = time.monotonic()
+    try:
+        with metrics.timed('stage', stage='deposit') as timer:
+            response = httpclient.post(crossref_ep, files=files)
+            timer.status = str(response.status_code)
+        duration = time.monotonic() - started
+        if not response.ok:
+            # Only a 2xx answer means CrossRef has queued the file, anything else is deposited again next run
+            print("Something went wrong. Response: " + str(response.status_code) + ' ' + str(response.reason))
+            for publication, info in records:
+                log.event('Creating DOI: ' + info['doi'] + ' for Research publ: ' + info['cris_url'] + ' using file: ' + xml_filename + ' failed! Response: ' + str(response.status_code) + ' ' + str(response.reason),
+                          stage='deposit', status='failed', pubid=info['pubid'], doi=info['doi'], duration=duration, batch=batch_id, http_status=response.status_code)
+                watermark.hold(info['pubid'])
+            return
+        else:
+            # CrossRef only queues the file, the result is followed up by the submission tracker
+            print("DOI(s) submitted to CrossRef as " + batch_id + ". Status: " + str(response.status_code))
+            tracker.track(batch_id)
+    except requests.exceptions.RequestException as e:
+        print('DOI(s) were not created. Exception: ' + str(e))
+        for publication, info in records:
+            log.event('DOI could NOT be created: ' + info['doi'] + ' for Research publ: ' + info['cris_url'] + ' using file: ' + xml_filename,
+                      stage='deposit', status='failed', pubid=info['pubid'], doi=info['doi'], duration=time.monotonic() - started, batch=batch_id, error=str(e))
+            watermark.hold(info['pubid'])
+        return
+
+    cris_updates = []
+    for publication, info in records:
+        log.event('Created DOI: ' + info['doi'] + ' for Research publ: ' + info['cris_url'] + '. Filename: ' + xml_filename + '. Submission: ' + batch_id,
+                  stage='deposit', status='submitted', pubid=info['pubid'], doi=info['doi'], duration=duration, batch=batch_id)
+        # Write CRIS pubid to the ledger
+        ledger.record(info['pubid'], info['doi'], batch_id, info['hash'], info['fields'], info['version'])
+
+        # Update publication record in Research (if ok and cris_update=yes), done by the next stage
+        if info['cris_update'] == 'yes':
+            cris_updates.append(info)
+        else:
+            print('CRIS record was NOT updated with new DOI.')
+            log.event('Research CRIS publication ' + info['pubid'] + ' was NOT updated (existing DOI).', stage='cris_update', status='skipped',
+                      pubid=info['pubid'], doi=info['doi'])
+        watermark.done(info['pubid'])
+    return cris_updates
+
+# Existing DOIs are checked in bulk (doi.org status per DOI) for each harvested page, before any XML is built.
+# The statuses are taken out again by prepare_record, which may still be working on the previous page.
+# DOIs with a deposit of ours in the ledger (registered or still being processed by CrossRef) are not checked: they are
+# decided by content hash, and the few whose content has changed since are checked one by one in prepare_record.
+doi_status = {}
+
+def check_page_dois(publs):
+    doi_ids = [publ['IdentifierDoi'][0] for publ in publs if len(publ.get('IdentifierDoi', [])) > 0]
+    doi_status.update(check_dois([doi_id for doi_id in doi_ids if not ledger.registered(doi_id) and not ledger.deposit_hashes(doi_id)]))
+
+def next_page(publs):
+    # The previous page has been harvested: commit the watermark (capped by the records still in the pipeline)
+    watermark.commit()
+    check_page_dois(publs)
+
+# Metadata
+pubtype = 'dissertation'
+degree_abbrev = 'PhD'
+template = template_for(pubtype)
+
+def prepare_record(publ):
+    # Decide whether a DOI should be created for the publication and build its deposit XML.
+    # Returns [(publication element, info)] for the packer, or None if the record is skipped.
+    create_doi = os.getenv("CREATE_DOI")
+
+    # Debug, test
+    # create_doi = 'false'   
+
+    pubid = str(publ['Id'])
+    print(str(pubid ))
+    isbn = str(publ['IdentifierIsbn'][0])
+    isbn_normal = isbn.replace('-', '')
+    print(str(isbn_normal ))
+    #doi_id = str(doi_prefix) + '/cth.diss/' + isbn_normal
+    doi_id = str(publ['IdentifierDoi'][0])
+    
+    # Check if DOI has already been created for this item
+    if ledger.contains(pubid, doi_id):
+        print('DOI ' + doi_id + ' has already been created for ' + pubid)
+        create_doi = 'false'
+
+    # Check if the publ already has a DOI, in that case the CRIS record should not be updated
+    if 'IdentifierDoi' in publ:
+        if len(publ['IdentifierDoi']) > 0:
+            cris_update = 'no'
+        else:
+            cris_update = 'yes'
+    else:
+        cris_update = 'yes'         
+
+    title_txt = publ['Title']
+    version_enum = '1'
+    year = str(publ['Year'])
+    
+    abstract_txt = ''
+    if ('Abstract' in publ):
+        abstract_txt = publ['Abstract']
+
+    # Persons
+    authors = []
+    authors = publ['Persons']
+
+    lang = publ['Language']['Iso']
+
+    disp_date = ''
+    if 'DispDate' in publ:
+        disp_date = str(publ['DispDate'])
+
+    itemnumber = ''
+    if 'Series' in publ:
+        if len(publ['Series']) > 0:
+            for serie in publ['Series']:
+                if  serie['SerialItem']['Id'] == '3b982ea2-6c34-1014-b6a7-7ac9b7ba4313':
+                    itemnumber = str(serie['SerialNumber'])
+            
+    cris_pubid = pubid
+    public_pubid = str(publ['IdentifierCplPubid'][0])
+    cris_url = str(cris_base_url) + public_pubid
+
+    # Clean relevant text fields
+    abstract_clean = ''
+    if abstract_txt:
+        abstract_clean = clean_text(abstract_txt)
+
+    if title_txt:
+        title_clean = clean_text(title_txt)
+
+    # Create XML for this record (the doi_batch around it is created in deposit_batch)
+    record = {'doi': doi_id, 'url': cris_url, 'title': title_clean, 'abstract': abstract_clean,
+              'lang': lang, 'year': year, 'isbn': isbn, 'disp_date': disp_date,
+              'degree': degree_abbrev, 'version': version_enum, 'persons': authors}
+    publication = template.build(record)
+
+    # DOIs deposited before are decided by the content hash of the record: the same as the last deposit
+    # (that did not fail) -> skip, changed since a deposit CrossRef registered -> deposit again
+    record_hash = content_hash(publication)
+    doi_checked = doi_id in doi_status
+    doi_check_status = doi_status.pop(doi_id, None)
+    if not ledger.claim(doi_id):
+        # Another run is working on this DOI, the record is harvested again next run (and then decided by the ledger)
+        print('DOI ' + doi_id + ' is being handled by another run, skipping to next publication...')
+        log.event('DOI ' + doi_id + ' is claimed by another run and was skipped', stage='build', status='claimed', pubid=pubid, doi=doi_id)
+        watermark.hold(pubid)
+        return None
+    if record_hash in ledger.deposit_hashes(doi_id):
+        print('DOI ' + doi_id + ' has been deposited with the same metadata before, skipping to next publication...')
+        log.event('DOI ' + doi_id + ' is unchanged since the last deposit and was NOT deposited again', stage='deposit', status='unchanged',
+                  pubid=pubid, doi=doi_id)
+        watermark.done(pubid)
+        return None
+
+    update = False
+    if ledger.registered(doi_id):
+        update = True
+    else:
+        # Check if DOI already exists in CrossRef (and skip to next publ if so, unless METADATA_UPDATES is on)
+        print('Checking if DOI ' + doi_id + ' already exists in CrossRef...')
+        if not doi_checked:
+            # Left out of the page check (deposited by us before, content changed since)
+            doi_check_status = check_dois([doi_id]).get(doi_id)
+        if doi_check_status == 200 or doi_check_status == 301 or doi_check_status == 302:
+            if metadata_updates and doi_id.startswith(str(doi_prefix) + '/'):
+                # Registered before the ledger kept content hashes (or by create-doi-single.py)
+                update = True
+            else:
+                print('DOI ' + doi_id + ' already exists in CrossRef and will NOT be created again! Skipping to next publication...')
+                watermark.done(pubid)
+                return None
+        elif doi_check_status == 404:
+            create_doi = 'true'
+        elif doi_check_status is None:
+            print('DOI lookup failed for ' + doi_id)
+            create_doi = 'true'
+        else:
+            print('Something went wrong when checking existing DOI in CrossRef. Status: ' + str(doi_check_status))
+            log.event('Checking existing DOI in CrossRef for: ' + doi_id + ' failed! Status: ' + str(doi_check_status), stage='check', status='failed',
+                      pubid=pubid, doi=doi_id, http_status=doi_check_status)
+            create_doi = 'true'
+
+    fields = content_fields(publication)
+    version = int(version_enum)
+    if update:
+        # Metadata update of a registered DOI: what changed since the last deposit, sent with the next version_info
+        # (a change of the URL alone is also sent as a full deposit)
+        previous = ledger.last_deposit(doi_id)
+        if previous is None:
+            changed = 'no earlier deposit in the ledger'
+            version += 1
+        else:
+            previous_fields, previous_version, previous_status = previous
+            changed = ', '.join(changed_fields(previous_fields, fields))
+            version = (previous_version or version) + (0 if previous_status == 'failed' else 1)
+        publication = template.build(dict(record, version=str(version)))
+        print('Metadata for DOI ' + doi_id + ' has changed since the last deposit (' + changed + '), depositing version ' + str(version) + '.')
+        log.event('Updating metadata for DOI: ' + doi_id + ' (changed: ' + changed + ') as version ' + str(version), stage='build', status='update',
+                  pubid=pubid, doi=doi_id, changed=changed, version=version)
+        create_doi = 'true'
+    else:
+        # Write to log
+        log.event('Trying to create a new DOI: ' + doi_id + ' for Research publ: ' + cris_url, stage='build', pubid=pubid, doi=doi_id)
+
+    if create_doi == 'true':
+        return [(publication, {'pubid': cris_pubid, 'doi': doi_id, 'cris_url': cris_url, 'cris_update': cris_update,
+                             'updated': publ.get('UpdatedDate'), 'hash': record_hash, 'fields': fields, 'version': version})]
+    else:
+        print("DOI " + doi_id + " was NOT created, due to system settings or it already exists")
+        log.event('DOI ' + doi_id + ' was NOT created, due to system settings or it already exists', stage='deposit', status='skipped',
+                  pubid=pubid, doi=doi_id)
+        watermark.done(pubid)
+        return None
+
+def pack_record(record):
+    # Post XML to CrossRef endpoint, packed together with other records (see deposit_batch)
+    publication, info = record
+    return packer.add(publication, info)
+
+def update_cris(info):
+    update_cris_record(info['pubid'], info['doi'], info['updated'])
+
+def item_pubids(item):
+    # CRIS pubids of a pipeline item: publication (build), (publication, info) (pack), [(publication, info)] (deposit) or info (CRIS update)
+    if isinstance(item, dict):
+        return [str(item['Id'] if 'Id' in item else item['pubid'])]
+    if isinstance(item, tuple):
+        return [item[1]['pubid']]
+    if isinstance(item, list):
+        return [info['pubid'] for publication, info in item]
+    return []
+
+def stage_failed(stage, item, e):
+    # The records of the failed item are held, so the watermark stays before them and they are harvested again next run
+    pubids = item_pubids(item)
+    print('Pipeline stage ' + stage + ' failed' + (' for ' + ', '.join(pubids) if pubids else '') + ': ' + str(e))
+    for pubid in pubids or [None]:
+        log.event('Pipeline stage ' + stage + ' failed: ' + str(e), stage=stage, status='failed', pubid=pubid, error=repr(e))
+        if pubid is not None:
+            watermark.hold(pubid)
+
+# Records flow through the stages build -> pack -> deposit -> CRIS update, each with its own workers.
+# The stages are connected by bounded queues (PIPELINE_QUEUE_SIZE), so harvesting waits when the later stages fall behind.
+pipeline = Pipeline(queue_size=pipeline_queue_size, on_error=stage_failed)
+pipeline.add_stage('build', prepare_record, workers=build_workers)
+pipeline.add_stage('pack', pack_record, workers=1, finish=packer.drain)
+pipeline.add_stage('deposit', deposit_batch, workers=deposit_workers)
+pipeline.add_stage('cris_update', update_cris, workers=cris_workers)
+
+# Records are harvested page by page (PAGESIZE per request, at most MAXRECORDS in total)
+# (with WORKER_COUNT > 1 only the publications of this worker)
+harvester = PublicationHarvester(cris_api_ep, cris_query, cris_fields, page_size=page_size, max_records=max_records, on_page=next_page, sort=cris_sort,
+                                 accept=(lambda publ: locking.worker_of(publ['Id'], worker_count) == worker_index) if worker_count > 1 else None)
 
 try:
-    research_lookup_data = requests.get(url=research_lookup_url, headers=research_lookup_headers).text
-    research_publs = json.loads(research_lookup_data)
-    #print(research_publs)
+    total_count = harvester.total_count
 
-    with open(logfile, 'a') as lfile:
-        lfile.write(datetime.datetime.now().strftime("%Y%m%d%H%M%S") + '\tLooking up new publications. Found: ' + str(research_publs['TotalCount']) + ' for (possibly) DOI creation.\n')
-        lfile.close()
+    log.event('Looking up new publications. Found: ' + str(total_count) + ' for (possibly) DOI creation.', stage='harvest', status='ok', count=total_count)
 
-    if research_publs['TotalCount'] > 0:
-        print('Found publs: ' + str(research_publs['TotalCount']))
+    if total_count > 0:
+        print('Found publs: ' + str(total_count))
 
         # debug
         # print(research_publs)
         # exit()
         
         # Loop through and create new DOI:s accordingly
-        
-        # Metadata
-        pubtype = 'dissertation'
-        degree_abbrev = 'PhD'
-
-        enum = 0
-
-        for publ in research_publs['Publications']:
-
-            xml_filename = ''
-            root = ''
-            create_doi = os.getenv("CREATE_DOI")
-
-            # Debug, test
-            # create_doi = 'false'   
-
-            pubid = str(publ['Id'])
-            print(str(pubid ))
-            isbn = str(publ['IdentifierIsbn'][0])
-            isbn_normal = isbn.replace('-', '')
-            print(str(isbn_normal ))
-            #doi_id = str(doi_prefix) + '/cth.diss/' + isbn_normal
-            doi_id = str(publ['IdentifierDoi'][0])
-            
-            # Check if DOI has already been created for this item
-            with open(pidfile, mode='r', ) as infile:
-                for row in csv.reader(infile, dialect='excel-tab'):
-                    if row[0] == pubid and row[1] == doi_id:
-                        print('DOI ' + doi_id + ' has already been created for ' + pubid)
-                        create_doi = 'false'
-
-            # Check if the publ already has a DOI, in that case the CRIS record should not be updated
-            if 'IdentifierDoi' in publ:
-                if len(publ['IdentifierDoi']) > 0:
-                    cris_update = 'no'
-                else:
-                    cris_update = 'yes'
-            else:
-                cris_update = 'yes'         
-
-            title_txt = publ['Title']
-            version_enum = '1'
-            year = str(publ['Year'])
-            
-            abstract_txt = ''
-            if ('Abstract' in publ):
-                abstract_txt = publ['Abstract']
-
-            # Persons
-            authors = []
-            authors = publ['Persons']
-
-            department = ''
-
-            lang = publ['Language']['Iso']
-
-            disp_date = ''
-            if 'DispDate' in publ:
-                disp_date = str(publ['DispDate'])
-
-            itemnumber = ''
-            if 'Series' in publ:
-                if len(publ['Series']) > 0:
-                    for serie in publ['Series']:
-                        if  serie['SerialItem']['Id'] == '3b982ea2-6c34-1014-b6a7-7ac9b7ba4313':
-                            itemnumber = str(serie['SerialNumber'])
-                    
-            cris_pubid = pubid
-            public_pubid = str(publ['IdentifierCplPubid'][0])
-            cris_url = str(cris_base_url) + public_pubid
-            create_date = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-            # Back 1 day to avoid missing records due to time differences etc. (should perhaps be done in a better way)
-            rdate = datetime.datetime.now() - datetime.timedelta(days=1)
-            runtime_date = rdate.strftime("%Y-%m-%d:%H:%M:%S")  
-
-            # Clean relevant text fields
-            if abstract_txt:
-                abstract_clean = BeautifulSoup(abstract_txt.rstrip('\r\n').strip(), "lxml").text
-
-            if title_txt:
-                title_clean = BeautifulSoup(title_txt.rstrip('\r\n').strip(), "lxml").text
-
-            # Check if DOI already exists in CrossRef (and skip to next publ if so)
-            print('Checking if DOI ' + doi_id + ' already exists in CrossRef...')
-            doi_check_url = 'https://doi.org/' + doi_id
-            try:
-                cresponse = requests.get(doi_check_url)
-                if cresponse.status_code == 200 or cresponse.status_code == 301 or cresponse.status_code == 302:
-                    print('DOI ' + doi_id + ' already exists in CrossRef and will NOT be created again! Skipping to next publication...')
-                    continue
-                elif cresponse.status_code == 404:
-                    create_doi = 'true'
-                else:
-                    print('Something went wrong when checking existing DOI in CrossRef. Response: ' + str(cresponse.reason))
-                    with open(logfile, 'a') as lfile:
-                        lfile.write(datetime.datetime.now().strftime("%Y%m%d%H%M%S") + '\tChecking existing DOI in CrossRef for: ' + doi_id + ' failed! Response: ' + str(cresponse.reason) + '\n\n')
-                        lfile.close()
-                    create_doi = 'true'
-            except requests.exceptions.HTTPError as e:
-                print('DOI lookup failed: ' + str(e))
-                create_doi = 'true'
-                
-            # Create XML file
-
-            schema = "http://www.crossref.org/schema/5.4.0 https://www.crossref.org/schemas/crossref5.4.0.xsd"
-            namespace = "http://www.crossref.org/schema/5.4.0"
-            version = "5.4.0"
-
-            xml_filename = create_date + '_' + str(enum) + '.xml'
-
-            # Write to log
-            with open(logfile, 'a') as lfile:
-                lfile.write(datetime.datetime.now().strftime("%Y%m%d%H%M%S") + '\tTrying to create a new DOI: ' + doi_id + ' for Research publ: ' + cris_url + ' using file: ' + xml_filename + '\n')
-                lfile.close()
-
-            ns = namespace
-            xsi = "http://www.w3.org/2001/XMLSchema-instance" 
-            jats = "http://www.ncbi.nlm.nih.gov/JATS1"
-            mml = "http://www.w3.org/1998/Math/MathML"
-            fr = "http://www.crossref.org/fundref.xsd"
-
-            attr_qname = ET.QName("http://www.w3.org/2001/XMLSchema-instance", "schemaLocation")
-            ns_map = { "jats": jats,"mml": mml,"xsi": xsi,"fr": fr }
-
-            for prefix, uri in ns_map.items():
-                ET.register_namespace(prefix, uri)
-
-            root = ET.Element("doi_batch", 
-                                {attr_qname: "http://www.crossref.org/schema/5.4.0 https://www.crossref.org/schemas/crossref5.4.0.xsd"},
-                                xmlns='http://www.crossref.org/schema/5.4.0',
-                                version=version)
-            head = ET.SubElement(root, "head")
-            ET.SubElement(head, "doi_batch_id").text = doi_id
-            ET.SubElement(head, "timestamp").text = create_date
-            depositor = ET.SubElement(head, "depositor")
-            ET.SubElement(depositor, "depositor_name").text = depositor_name
-            ET.SubElement(depositor, "email_address").text = depositor_email
-            ET.SubElement(head, "registrant").text = instname_txt
-            body = ET.SubElement(root, "body")    
-            publication = ET.SubElement(body, pubtype, publication_type="full_text", language=lang)
-            contributors = ET.SubElement(publication, "contributors")
-            if authors:
-                seq = 0
-                seq_txt = 'first'
-                for a in authors:
-                    if seq == 0:
-                        seq_txt = 'first'
-                    else:
-                        seq_txt = 'additional'
-                    person_name = ET.SubElement(contributors, "person_name", contributor_role="author", sequence=seq_txt)
-                    ET.SubElement(person_name, "given_name").text = a['PersonData']['FirstName']
-                    ET.SubElement(person_name, "surname").text = a['PersonData']['LastName']
-                    affiliations = ET.SubElement(person_name, "affiliations")
-                    for aff in a['Organizations']:
-                        department = str(aff['OrganizationData']['DisplayPathEng'])
-                        institution = ET.SubElement(affiliations, "institution")
-                        if str(aff['OrganizationData']['OrganizationTypes'][0]['NameEng']).startswith('Chalmers'):
-                            if pubtype in ['dissertation','report','book','preprint']:
-                                instname = ET.SubElement(institution, "institution_name").text = instname_txt
-                            ror = ET.SubElement(institution, "institution_id", type="ror").text = ror_id
-                        else:
-                            if pubtype in ['dissertation','report','book','preprint']:
-                                instname = ET.SubElement(institution, "institution_name").text = aff['OrganizationData']['NameEng']
-                            else:
-                                instname = ET.SubElement(institution, "institution_acronym").text = aff['OrganizationData']['NameEng']
-                        if 'Identifiers' in aff['OrganizationData'] and len(aff['OrganizationData']['Identifiers']) > 0:
-                            for orgid in aff['OrganizationData']['Identifiers']:
-                                if orgid['Type']['Value'] == 'ROR_ID':
-                                    ror = ET.SubElement(institution, "institution_id", type="ror").text = str(orgid['Value'])
-                        if 'City' in aff['OrganizationData']:
-                            instplace = ET.SubElement(institution, "institution_place").text = str(aff['OrganizationData']['City']) + ', ' + str(aff['OrganizationData']['Country'])
-                        else:    
-                            instplace = ET.SubElement(institution, "institution_place").text = str(aff['OrganizationData']['Country'])
-                    if 'IdentifierOrcid' in a['PersonData']:
-                         if len(a['PersonData']['IdentifierOrcid']) > 0:
-                            orcid = ET.SubElement(person_name, "ORCID", authenticated = "true").text = "https://orcid.org/" + str(a['PersonData']['IdentifierOrcid'][0])  
-                    seq += 1
-            titles = ET.SubElement(publication, "titles")
-            title = ET.SubElement(titles, "title").text = title_clean
-            if abstract_clean:
-                abstract = ET.SubElement(publication, ET.QName(ns_map["jats"], "abstract"))
-                abstract_p = ET.SubElement(abstract, ET.QName(ns_map["jats"], "p")).text = abstract_clean
-            if disp_date:
-                if len(disp_date) > 0:
-                    approvaldate = ET.SubElement(publication, "approval_date")
-                    amonth = ET.SubElement(approvaldate, "month").text = disp_date[5:7]
-                    aday = ET.SubElement(approvaldate, "day").text = disp_date[8:10]
-                    ayear = ET.SubElement(approvaldate, "year").text = disp_date[0:4]
-            institution_publ = ET.SubElement(publication, "institution")
-            ror_publ = ET.SubElement(institution_publ, "institution_id", type="ror").text = ror_id
-            if department:
-                if department.startswith('Chalmers'):
-                    dept_publ = ET.SubElement(institution_publ, "institution_department").text = department
-            if degree_abbrev:
-                degree = ET.SubElement(publication, "degree").text = degree_abbrev
-            if isbn:
-                isbn_print = ET.SubElement(publication, "isbn", media_type="print").text = isbn
-            version_info = ET.SubElement(publication, "version_info")
-            version = ET.SubElement(version_info, "version").text = version_enum
-            doi_data = ET.SubElement(publication, "doi_data")
-            doi = ET.SubElement(doi_data, "doi").text = doi_id
-            resource = ET.SubElement(doi_data, "resource").text = cris_url
-
-            # Post XML to CrossRef endpoint
-            # https://www.crossref.org/documentation/register-maintain-records/direct-deposit-xml/https-post/
-
-            if create_doi == 'true':                    
-                
-                # Create file
-                dom = xml.dom.minidom.parseString(ET.tostring(root))
-                xml_string = dom.toprettyxml()
-                part1, part2 = xml_string.split('?>')
-
-                with open(xml_filename, 'w') as xfile:
-                    xfile.write(part1 + 'encoding=\"{}\"?>'.format(m_encoding) + part2)
-                    xfile.close()
-
-                files = {
-                        'operation': (None, 'doMDUpload'),
-                        'login_id': (None, crossref_uid),
-                        'login_passwd': (None, crossref_pw),
-                        'fname': ('[filename]', open(xml_filename, 'rb'))
-                }
-
-                print('Trying to create a DOI: ' + doi_id + ' for Research publ: ' + cris_url + ' using file: ' + xml_filename + '\n')
-            
-                try:
-                    response = requests.post(crossref_ep, files=files)
-                    if response.status_code == 401:
-                        print("Something went wrong. Response: " + str(response.reason))
-                        with open(logfile, 'a') as lfile:
-                            lfile.write(datetime.datetime.now().strftime("%Y%m%d%H%M%S") + '\tCreating DOI: ' + doi_id + ' for Research publ: ' + cris_url + ' using file: ' + xml_filename + ' failed! Response: ' + str(response.reason) + '\n\n')
-                            lfile.close()
-                        #exit()
-                        continue
-                    else:
-                        print("DOI was created. Status: " + str(response.status_code))
-                        with open(logfile, 'a') as lfile:
-                            lfile.write(datetime.datetime.now().strftime("%Y%m%d%H%M%S") + '\tCreated DOI: ' + doi_id + ' for Research publ: ' + cris_url + '. Filename: ' + xml_filename + '\n')
-                            lfile.close()
-                        # Write CRIS pubid to file
-                        with open(pidfile, 'a') as pfile:
-                            pfile.write(cris_pubid + '\t' + str(doi_id) + '\n')
-                            pfile.close()
-                except requests.exceptions.HTTPError as e:
-                    print('DOI was not created, exiting now. Exception: ' + str(e))
-                    with open(logfile, 'a') as lfile:
-                            lfile.write(datetime.datetime.now().strftime("%Y%m%d%H%M%S") + '\tDOI could NOT be created: ' + doi_id + ' for Research publ: ' + cris_url + ' using file: ' + xml_filename + '\n\n')
-                            lfile.close()
-                    #exit()
-                    continue
-                
-                # Update publication record in Research (if ok and cris_update=yes)
-                if cris_update == 'yes':
-                    print('Updating publication ID: ' + cris_pubid + ' in Research.')
-                    research_url = str(cris_api_ep) + cris_pubid
-                    research_headers = {'Accept': 'application/json'}
-
-                    try:
-                        research_data = requests.get(url=research_url, headers=research_headers).text
-                        # Read response and add updated info
-                        datestring = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ')
-                        research_publ = json.loads(research_data)
-                        research_publ['UpdatedBy'] = cris_updated_by
-                        research_publ['UpdatedDate'] = datestring
-
-                        new_doi = {}
-                        new_doi_type = {}
-                        new_doi_type['Id'] = '5907253f-7ad4-4b1e-84d1-7e72ea1d92a8'
-                        new_doi['Type'] = new_doi_type
-                        new_doi['CreatedBy'] = cris_updated_by
-                        new_doi['CreatedAt'] = datestring
-                        new_doi['Value'] = doi_id
-
-                        existing_ids = research_publ['Identifiers']
-                        new_ids = {}
-                        new_ids = existing_ids
-                        existing_ids.append(new_doi)
-
-                        research_publ['Identifiers'] = new_ids
-
-                        updated_record = json.dumps(research_publ)
-
-                        try:
-                            print('Updating record: ' + cris_pubid + ' in Research\n')
-                            response = requests.put(research_url, json=json.loads(updated_record), headers=research_headers)
-                            if response.status_code == 200:
-                                print(cris_pubid + ' UPDATED\n')
-                                with open(logfile, 'a') as lfile:
-                                    lfile.write(datetime.datetime.now().strftime("%Y%m%d%H%M%S") + '\tResearch CRIS publication ' + cris_pubid + ' has been updated!\n')
-                                    lfile.close()
-                            else:
-                                print(cris_pubid + ' could not be updated! ' + 'Status: ' + str(response.status_code) + '\n')
-                                with open(logfile, 'a') as lfile:
-                                    lfile.write(datetime.datetime.now().strftime("%Y%m%d%H%M%S") + '\tResearch CRIS publication ' + cris_pubid + ' count NOT be updated!\n')
-                                    lfile.close()
-                        except requests.exceptions.HTTPError as e:
-                            print('Exception.')
-                            with open(logfile, 'a') as lfile:
-                                    lfile.write(datetime.datetime.now().strftime("%Y%m%d%H%M%S") + '\tResearch CRIS publication ' + cris_pubid + ' count NOT be updated!\n')
-                                    lfile.close()
-                            print('\n')
-                    except requests.exceptions.HTTPError as e:
-                        print('Exception.')
-                else:
-                    print('CRIS record was NOT updated with new DOI.')
-                    with open(logfile, 'a') as lfile:
-                        lfile.write(datetime.datetime.now().strftime("%Y%m%d%H%M%S") + '\tResearch CRIS publication ' + cris_pubid + ' was NOT updated (existing DOI).\n')
-                        lfile.close()
-            else:
-                print("DOI " + doi_id + " was NOT created, due to system settings or it already exists")
-                with open(logfile, 'a') as lfile:
-                        lfile.write(datetime.datetime.now().strftime("%Y%m%d%H%M%S") + ' DOI ' + doi_id + ' was NOT created, due to system settings or it already exists\n')
-                        lfile.close()      
-
-            # Write runtime timestamp to file
-            with open(runtime_file, 'w') as rtfile:
-                rtfile.write(runtime_date + '\n')
-                rtfile.close()
-
-            enum+=1
-            sleep(5)  # To avoid overloading the system
+        pipeline.start()
+        try:
+            for publ in harvester:
+                watermark.start(str(publ['Id']), publ.get('LatestEventDate'))
+                pipeline.put(publ)
+        finally:
+            # Let the records already harvested go through all stages (the last partial batch is deposited when the pack stage finishes)
+            pipeline.close()
+
+        # Everything harvested has been processed: write the new watermark to the RUNTIME file.
+        # Unless the records came in LatestEventDate order, the watermark stays where it was when MAXRECORDS cut the harvest short
+        # and the run counts as failed (safeguard, MAXRECORDS without CRIS_SORT=LatestEventDate is refused at the start).
+        complete = harvester.limit >= total_count
+        if not watermark.commit(final=True, complete=complete) and not complete and not watermark.ordered:
+            print('Harvest limited to ' + str(harvester.limit) + ' of ' + str(total_count) + ' records without CRIS_SORT=LatestEventDate, the watermark was NOT moved.')
+            log.event('Watermark not moved: harvest limited to ' + str(harvester.limit) + ' of ' + str(total_count) + ' records and not sorted on LatestEventDate',
+                      stage='harvest', status='truncated', count=harvester.limit)
+            tracker.stop(track_wait)
+            exit(1)
+
+        # Wait up to CROSSREF_TRACK_WAIT seconds for pending CrossRef results (the rest is followed up next run)
+        tracker.stop(track_wait)
     else:
         print('No relevant publications found, exiting!')
+        tracker.stop(track_wait)
         exit()
 
-except requests.exceptions.HTTPError as e:
-    print("error")
-    exit()
+except requests.exceptions.RequestException as e:
+    print("error: " + str(e))
+    log.event('Harvesting publications from CRIS failed: ' + str(e), stage='harvest', status='failed')
+    exit(1)
+
+# Held records (failed deposit, claimed by another run, failing pipeline stage) and records that never finished are
+# tried again next run, but this run did not finish its work: exit 1 (create-doi-backfill.py then keeps the shard open)
+held_count, in_progress_count = watermark.unfinished()
+if pipeline.errors or held_count or in_progress_count:
+    print('Run incomplete: ' + str(held_count) + ' record(s) held, ' + str(in_progress_count) + ' still in progress, '
+          + str(pipeline.errors) + ' pipeline stage failure(s), see the log.')
+    log.event('Run incomplete: ' + str(held_count) + ' record(s) held, ' + str(in_progress_count) + ' still in progress, ' + str(pipeline.errors) + ' pipeline stage failure(s)',
+              stage='harvest', status='incomplete', held=held_count, in_progress=in_progress_count, errors=pipeline.errors)
+    exit(1)
 
 exit()
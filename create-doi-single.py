@@ -1,13 +1,24 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import xml.etree.ElementTree as ET
-import xml.dom.minidom
 import datetime
 import requests
-from bs4 import BeautifulSoup
+import atexit
+import httpclient
+import metrics
+import time
+import locking
+from ledger import DepositLedger
+from runlog import open_runlog
+from textclean import clean_text
+from deposit import doi_batch, template_for, pubtypes, content_hash, content_fields
+from cris import resolve_dois, fetch_publications, CrisWriteBack
+from crossref import serialize_doi_batch, archive_xml, deposit_files, DepositValidator, SubmissionTracker
 from dotenv import load_dotenv
 import os
 import json
+import csv
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 
@@ -17,6 +28,8 @@ from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 # Guide: https://www.crossref.org/documentation/schema-library/markup-guide-metadata-segments/
 
 # Use as (example): python3 create-doi-single.py --pubid "6276a252-7aed-444a-8528-2a4517789c9d" --doi "test.001.aaa" --pubtype report --updateCRIS y -v
+#                   python3 create-doi-single.py --manifest reports.csv --existingDOI skip --workers 4
+#                   (reports.csv: pubid,doi,pubtype,updateCRIS with a header row, or a .jsonl file with the same keys)
 
 # CrossRef publication types (supported)
 #
@@ -27,22 +40,44 @@ from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 # report
 #
 
-m_encoding = 'UTF-8'
-
 # Params
 load_dotenv()
 crossref_ep = os.getenv("CROSSREF_API_EP")
 crossref_uid = os.getenv("CROSSREF_UID")
 crossref_pw = os.getenv("CROSSREF_PW")
-schema_version = os.getenv("SCHEMA_VERSION")
+crossref_status_ep = os.getenv("CROSSREF_STATUS_EP") or str(crossref_ep).replace('/deposit', '/submissionDownload')
+track_backoff = os.getenv("CROSSREF_TRACK_BACKOFF") or 30
+track_wait = os.getenv("CROSSREF_TRACK_WAIT") or 0
+schema_version = os.getenv("SCHEMA_VERSION") or "5.4.0"
 logfile = os.getenv("LOGFILE")
-runtime_file = os.getenv("RUNTIME")
+pidfile = os.getenv("PUBIDFILE")
+ledger_db = os.getenv("LEDGER_DB") or str(pidfile) + '.sqlite'
+batch_id_prefix = os.getenv("BATCH_ID_PREFIX") or 'cth'
 create_doi = os.getenv("CREATE_DOI")
 doi_prefix = os.getenv("DOI_PREFIX")
 cris_base_url = os.getenv("CRIS_BASE_URL")
 cris_api_ep = os.getenv("CRIS_API_EP")
 pubtype_id = os.getenv("PUBTYPE_ID")
 max_records = os.getenv("MAXRECORDS")
+xml_validation = str(os.getenv("XML_VALIDATION") or 'true').lower() == 'true'
+
+# Buffered run log (LOGFILE), per-host HTTP counters are written to it when the script exits
+log = open_runlog(logfile)
+atexit.register(httpclient.log_summary, log)
+
+# Stage timings and counters (METRICS_FILE, stage summary in the run log) and profile (PROFILE_FILE), written when the script exits
+metrics.setup('create-doi-single', log)
+
+# Deposit files are checked against the CrossRef schema (SCHEMA_DIR) before they are posted, rejected records go to REJECT_FILE
+validator = DepositValidator(os.getenv("SCHEMA_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schemas'), schema_version,
+                             os.getenv("REJECT_FILE"), enabled=xml_validation)
+if xml_validation and not validator.available:
+    print('No CrossRef schema at ' + validator.schema_file + ', deposit XML is NOT validated before it is posted (copy it with fetch-crossref-schema.py).')
+    log.event('No CrossRef schema at ' + validator.schema_file + ', deposit XML is NOT validated', stage='validate', status='unavailable')
+
+# Requests per second for each service (empty or 0 = unlimited)
+httpclient.set_rate_limit(cris_api_ep, os.getenv("CRIS_RATE_LIMIT"))
+httpclient.set_rate_limit(crossref_ep, os.getenv("CROSSREF_RATE_LIMIT"))
 
 # debug, do not actually create a DOI
 #   create_doi = "false"
@@ -52,12 +87,320 @@ max_records = os.getenv("MAXRECORDS")
 parser = ArgumentParser(description='Script for creating a new CrossRef DOI from a Chalmers CRIS publication record (semi)manually. \nUse as (example): python3 create-doi-single.py --pubid "6276a252-7aed-444a-8528-2a4517789c9d" --doi "test.001.aaa" --pubtype report --updateCRIS y -v',
                         formatter_class=ArgumentDefaultsHelpFormatter)
 parser.add_argument("-v", "--verbose", action="store_true", help="increase verbosity")
-parser.add_argument("-p", "--pubid", help="Chalmers Research publication ID (long, guid)", required=True)
-parser.add_argument("-d", "--doi", help="DOI, without prefix", required=True)
-parser.add_argument("-t", "--pubtype", help="Publication type (CrossRef). Allowed values: book, dissertation, preprint, proceeding, report", required=True)
+parser.add_argument("-p", "--pubid", help="Chalmers Research publication ID (long, guid)")
+parser.add_argument("-d", "--doi", help="DOI, without prefix")
+parser.add_argument("-t", "--pubtype", help="Publication type (CrossRef). Allowed values: book, dissertation, preprint, proceeding, report")
 parser.add_argument("-u", "--updateCRIS", default="y", help="Add the new DOI to the CRIS record (y/n)")
+parser.add_argument("-m", "--manifest", help="CSV (with header) or JSON lines file with pubid, doi, pubtype, updateCRIS per row, processed without prompts")
+parser.add_argument("--existingDOI", default="skip", choices=['skip', 'add'], help="Manifest mode: skip rows whose CRIS record already has a DOI, or add the new DOI anyway")
+parser.add_argument("-w", "--workers", type=int, default=4, help="Manifest mode: rows processed in parallel")
 args = parser.parse_args()
 
+if not args.manifest and not (args.pubid and args.doi and args.pubtype):
+    parser.error('--pubid, --doi and --pubtype are required (or use --manifest)')
+
+# Deposits are recorded in the same ledger as those of create-doi-batch.py (LEDGER_DB / PUBIDFILE), with their
+# content hash, and the DOI is claimed while it is deposited, so the batch runs do not deposit it again
+ledger = DepositLedger(ledger_db, pidfile, timeout=os.getenv("LEDGER_TIMEOUT") or 60, owner=locking.process_owner(log.run_id),
+                       claim_ttl=os.getenv("CLAIM_TTL") or 3600)
+atexit.register(ledger.release_claims)
+
+# CrossRef only queues a deposit: its result is followed up by the submission tracker (up to CROSSREF_TRACK_WAIT seconds
+# at the end of this run, the rest by the next batch run)
+tracker = SubmissionTracker(ledger, crossref_status_ep, crossref_uid, crossref_pw, backoff=track_backoff)
+tracker.start()
+
+cris_updated_by = 'crossref/doi'
+writeback = CrisWriteBack(cris_api_ep, cris_updated_by, retries=os.getenv("CRIS_WRITEBACK_RETRIES") or 2)
+
+# Fields retrieved from Chalmers Research
+cris_fields = 'Id%2CTitle%2CAbstract%2CYear%2CIdentifiers%2CPersons.PersonData.FirstName%2CPersons.PersonData.LastName%2CPersons.PersonData.IdentifierOrcid%2CIncludedPapers%2CLanguage.Iso%2CConference%2CIdentifierIsbn%2CIdentifierDoi%2CIdentifierCplPubid%2CDispDate%2CSeries%2CKeywords%2CPersons.Organizations.OrganizationData.Id%2CPersons.Organizations.OrganizationData.OrganizationTypes.NameEng%2CPersons.Organizations.OrganizationData.Country%2CPersons.Organizations.OrganizationData.City%2CPersons.Organizations.OrganizationData.NameEng%2CPersons.Organizations.OrganizationData.DisplayPathEng%2CPublicationType.NameEng%2CPersons.Organizations.OrganizationData.Identifiers%2CUpdatedDate'
+
+
+def validate(cris_pubid, doi, pubtype, update_cris):
+    # Input errors for one publication (empty if ok)
+    errors = []
+    if not str(pubtype or '').strip():
+        errors.append('Pubtype is missing!')
+    elif pubtype not in pubtypes:
+        errors.append('Pubtype has to be one of "book", "dissertation", "preprint", "proceeding","report"')
+    if update_cris not in ['y','n']:
+        errors.append('UpdateCRIS (-u) has to be y(es) or n(no), default yes (if empty)')
+    # The DOI is deposited as DOI_PREFIX/doi, an empty suffix would deposit the bare prefix
+    if not str(doi or '').strip().strip('/'):
+        errors.append('DOI is missing!')
+    elif str(doi).startswith('10.63959'):
+        errors.append('DOI should be WITHOUT prefix!')
+    elif str(doi) != str(doi).strip() or len(str(doi).split()) > 1:
+        errors.append('DOI should not contain spaces!')
+    if not str(cris_pubid or '').strip():
+        errors.append('Publication ID is missing!')
+    elif len(str(cris_pubid).strip()) < 12:
+        errors.append('Publication ID should be the long (guid) id!')
+    return errors
+
+
+def ask(kind, question):
+    # Interactive confirmation
+    print(question)
+    yes = {'yes', 'y', 'ye', 'j', 'ja', ''}
+    no = {'no', 'n', 'nej'}
+    choice = input().lower()
+    if choice in yes:
+        print('Ok')
+        # continue
+    elif choice in no:
+        print('Ok, exiting...')
+        return False
+    return True
+
+
+def create_doi_for(publ, cris_pubid, doi_id, pubtype, update_cris, confirm, xml_suffix=''):
+    # Create (deposit) the DOI for one CRIS publication record and add it to the record in CRIS (update_cris = y).
+    # confirm(kind, question) decides on an existing DOI in CRIS (kind existing_doi) and on creating the DOI (kind create).
+    # Returns the result for the summary.
+    print('Found publication ' + str(cris_pubid) + ' in Research.')
+    
+    # Loop through the pub data and create a new DOI accordingly
+
+    degree_abbrev = '' # doc or lic?
+
+    pubid = str(publ['Id'])
+
+    title_txt = publ['Title']
+    version_enum = '1'
+    year = str(publ['Year'])
+    isbn = ''
+    isbn_normal = ''
+    if 'IdentifierIsbn' in publ:
+        if len(publ['IdentifierIsbn']) > 0:
+            isbn = str(publ['IdentifierIsbn'][0])
+            isbn_normal = isbn.replace('-', '')
+
+    public_pubid = str(publ['IdentifierCplPubid'][0])
+
+    conference = []
+    if 'Conference' in publ:
+        if len(publ['Conference']) > 0:
+            conference = publ['Conference']
+    
+    # Check if item already has a DOI (just in case)
+    if 'IdentifierDoi' in publ:
+        if len(publ['IdentifierDoi']) > 0 and update_cris == 'y':
+            if not confirm('existing_doi', '\nIt seems this item already has a DOI in Research:  ' + str(publ['IdentifierDoi'][0]) + '\nIs this correct? Do you wish to continue (this would add a possible duplicate)? (y/n)'):
+                return 'skipped (existing DOI in Research)'
+
+    abstract_txt = ''
+    if ('Abstract' in publ):
+        abstract_txt = publ['Abstract']
+
+    # Persons
+    authors = []
+    authors = publ['Persons']
+    
+    included_paper_dois = []
+    if ('IncludedPapers') in publ:
+            if len(publ['IncludedPapers']) > 0:
+                # Retrieve DOI from inluded papers (all in one go) and add these
+                incl_pubids = [str(inclp['Publication']) for inclp in publ['IncludedPapers']]
+                incl_dois = resolve_dois(cris_api_ep, incl_pubids)
+                included_paper_dois = [incl_dois[incl_pubid] for incl_pubid in incl_pubids if incl_dois[incl_pubid]]
+
+    lang = publ['Language']['Iso']
+    
+    cris_pubtype = publ['PublicationType']['NameEng']
+
+    if cris_pubtype == 'Doctoral thesis':
+        degree_abbrev = 'PhD'
+    if cris_pubtype == 'Licentiate thesis':
+        degree_abbrev = 'Licentiate'
+
+    disp_date = ''
+    if 'DispDate' in publ:
+        disp_date = str(publ['DispDate'])
+
+    itemnumber = ''
+    if 'Series' in publ:
+        if len(publ['Series']) > 0:
+            for serie in publ['Series']:
+                if  serie['SerialItem']['Id'] == '3b982ea2-6c34-1014-b6a7-7ac9b7ba4313':
+                    itemnumber = str(serie['SerialNumber'])
+                
+    #cris_pubid = public_pubid
+    cris_url = str(cris_base_url) + public_pubid
+    create_date = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+
+    # Clean relevant text fields
+    abstract_clean = ''
+    if abstract_txt:
+        abstract_clean = clean_text(abstract_txt)
+
+    if title_txt:
+        title_clean = clean_text(title_txt)
+
+    if not confirm('create', '\nITEM DETAILS\n============\nNew DOI: ' + doi_id + '\nTitle: ' + title_txt + '\nResearch Pubtype: ' + cris_pubtype + '\nCrossRef Pubtype: ' + pubtype + '\nResearch ID: ' + cris_pubid + '\nUpdate Research?: ' + update_cris + '\n\nShould we create a DOI for this? (y/n)'):
+        return 'skipped'
+
+    # Write to log
+    log.event('Trying to create a new DOI: ' + doi_id + ' for Research publ: ' + cris_url, stage='build', pubid=cris_pubid, doi=doi_id)
+
+    # Create XML file
+
+    xml_filename = create_date + xml_suffix + '.xml'
+
+    # Every submission gets a unique batch id, it is used to look up the CrossRef result later
+    batch_id = batch_id_prefix + '-' + create_date + xml_suffix
+
+    root, body = doi_batch(batch_id, create_date, schema_version)
+    publication = template_for(pubtype).build({'doi': doi_id, 'url': cris_url, 'title': title_clean, 'abstract': abstract_clean,
+                                               'lang': lang, 'year': year, 'isbn': isbn, 'disp_date': disp_date,
+                                               'degree': degree_abbrev, 'version': version_enum, 'persons': authors,
+                                               'conference': conference})
+    record_hash = content_hash(publication)
+    fields = content_fields(publication)
+    body.append(publication)
+
+    # Serialize in memory (a copy is kept in XML_ARCHIVE_DIR if set)
+    xml_bytes = serialize_doi_batch(root)
+    archive_xml(xml_bytes, xml_filename)
+
+    # Check the file against the CrossRef schema before anything is posted
+    errors = validator.errors(xml_bytes)
+    if errors:
+        print('Deposit XML for ' + doi_id + ' is not valid and will NOT be posted:\n' + '\n'.join(errors[:10]))
+        log.event('Deposit XML for DOI: ' + doi_id + ' (Research publ: ' + cris_url + ') is not valid and was NOT posted: ' + '; '.join(errors[:5]),
+                  stage='validate', status='rejected', pubid=cris_pubid, doi=doi_id, errors=len(errors))
+        validator.reject(cris_pubid, doi_id, errors)
+        return 'failed (invalid XML: ' + errors[0] + ')'
+    
+    # Post XML to CrossRef endpoint
+    # https://www.crossref.org/documentation/register-maintain-records/direct-deposit-xml/https-post/
+
+    print('Attempting to create a DOI: ' + doi_id + ' for Research publ: ' + cris_url + ' using file: ' + xml_filename)
+
+    if create_doi == "true":
+
+        if not ledger.claim(doi_id):
+            print('DOI ' + doi_id + ' is being handled by another run, NOT created.')
+            log.event('DOI ' + doi_id + ' is claimed by another run and was skipped', stage='build', status='claimed', pubid=cris_pubid, doi=doi_id)
+            return 'skipped (DOI is being handled by another run)'
+
+        files = deposit_files(crossref_uid, crossref_pw, xml_bytes, xml_filename)
+
+        started = time.monotonic()
+        try:
+            with metrics.timed('stage', stage='deposit') as timer:
+                response = httpclient.post(crossref_ep, files=files)
+                timer.status = str(response.status_code)
+            duration = time.monotonic() - started
+            if not response.ok:
+                print("Something went wrong! Response: " + str(response.status_code) + ' ' + str(response.reason))
+                log.event('Creating DOI: ' + doi_id + ' for Research publ: ' + cris_url + ' using file: ' + xml_filename + ' failed! Response: ' + str(response.status_code) + ' ' + str(response.reason),
+                          stage='deposit', status='failed', pubid=cris_pubid, doi=doi_id, duration=duration, http_status=response.status_code)
+                return 'failed (CrossRef: ' + str(response.status_code) + ' ' + str(response.reason) + ')'
+            else:
+                # CrossRef only queues the file, the result is followed up by the submission tracker
+                print("DOI submitted to CrossRef (batch id " + batch_id + "). Status: " + str(response.status_code))
+                tracker.track(batch_id)
+                ledger.record(cris_pubid, doi_id, batch_id, record_hash, fields, int(version_enum))
+        except requests.exceptions.RequestException as e:
+            print('DOI was not created, exiting now. Exception: ' + str(e))
+            log.event('DOI could NOT be created: ' + doi_id + ' for Research publ: ' + cris_url + ' using file: ' + xml_filename,
+                      stage='deposit', status='failed', pubid=cris_pubid, doi=doi_id, duration=time.monotonic() - started, error=str(e))
+            return 'failed (CrossRef: ' + str(e) + ')'
+        
+        if update_cris == 'y':
+            # Update publication record in Research (if ok)
+            print('Updating publication ID: ' + cris_pubid + ' in Research.')
+            started = time.monotonic()
+            cris_result, detail = writeback.add_doi(cris_pubid, doi_id, publ.get('UpdatedDate'))
+            if cris_result == 'updated' or cris_result == 'exists':
+                print(cris_pubid + ' UPDATED\n')
+                log.event('Research CRIS publication ' + cris_pubid + ' has been updated!', stage='cris_update', status='ok',
+                          pubid=cris_pubid, doi=doi_id, duration=time.monotonic() - started, result=cris_result)
+                result = 'submitted, CRIS updated'
+            else:
+                print(cris_pubid + ' could not be updated! ' + cris_result + ': ' + str(detail) + '\n')
+                log.event('Research CRIS publication ' + cris_pubid + ' count NOT be updated! (' + cris_result + ': ' + str(detail) + ')', stage='cris_update',
+                          status=cris_result, pubid=cris_pubid, doi=doi_id, duration=time.monotonic() - started)
+                result = 'submitted, CRIS NOT updated (' + cris_result + ': ' + str(detail) + ')'
+        else:
+            print('Chalmers CRIS publication was NOT updated! Use -u y to do this.')  
+            result = 'submitted'
+
+        # Write to log end exit
+        log.event('Created DOI: ' + doi_id + ' for Research publ: ' + cris_url + '. Filename: ' + xml_filename + '. Submission: ' + batch_id,
+                  stage='deposit', status='submitted', pubid=cris_pubid, doi=doi_id, duration=duration, batch=batch_id)
+        return result
+    else:
+        print('DOI was NOT created, due to system settings.')
+        return 'not created (CREATE_DOI)'
+
+
+def read_manifest(manifest_file):
+    # Manifest rows: CSV with a header row, or JSON lines (.jsonl/.json), with pubid, doi, pubtype and (optional) updateCRIS
+    with open(manifest_file, 'r', newline='') as mfile:
+        if manifest_file.endswith('.jsonl') or manifest_file.endswith('.json'):
+            rows = [json.loads(line) for line in mfile if line.strip()]
+        else:
+            rows = list(csv.DictReader(mfile))
+    return [{'pubid': str(row.get('pubid') or '').strip(), 'doi': str(row.get('doi') or '').strip(),
+             'pubtype': str(row.get('pubtype') or '').strip(), 'updateCRIS': str(row.get('updateCRIS') or 'y').strip().lower()} for row in rows]
+
+
+def run_manifest(manifest_file):
+    # Non-interactive mode: validate all rows, fetch the CRIS records in bulk and create the DOIs in parallel
+    rows = read_manifest(manifest_file)
+
+    errors = []
+    pubids = Counter(row['pubid'] for row in rows)
+    dois = Counter(row['doi'] for row in rows)
+    for n, row in enumerate(rows, 1):
+        row_errors = validate(row['pubid'], row['doi'], row['pubtype'], row['updateCRIS'])
+        if pubids[row['pubid']] > 1:
+            row_errors.append('Publication ID occurs more than once in the manifest')
+        if dois[row['doi']] > 1:
+            row_errors.append('DOI occurs more than once in the manifest')
+        errors.extend('row ' + str(n) + ' (' + row['pubid'] + '): ' + error for error in row_errors)
+    if errors:
+        for error in errors:
+            print('ERROR: ' + error)
+        print('Nothing was created, fix the manifest and run again.')
+        exit()
+
+    publs = fetch_publications(cris_api_ep, [row['pubid'] for row in rows], cris_fields)
+
+    def decide(kind, question):
+        # The manifest replaces the prompts, an existing DOI in CRIS is handled by --existingDOI
+        return kind != 'existing_doi' or args.existingDOI == 'add'
+
+    def process(n, row):
+        publ = publs.get(row['pubid'])
+        if publ is None:
+            print('ERROR! No Research publication found for id ' + row['pubid'])
+            return 'not found in Research'
+        try:
+            return create_doi_for(publ, row['pubid'], str(doi_prefix) + '/' + row['doi'], row['pubtype'], row['updateCRIS'], decide, '_' + str(n))
+        except Exception as e:
+            return 'failed (' + str(e) + ')'
+
+    with ThreadPoolExecutor(max_workers=max(args.workers, 1)) as pool:
+        results = list(pool.map(process, range(1, len(rows) + 1), rows))
+
+    totals = Counter(result.split(' (')[0] for result in results)
+    print('\nSUMMARY\n=======')
+    for n, (row, result) in enumerate(zip(rows, results), 1):
+        print(str(n) + '\t' + row['pubid'] + '\t' + str(doi_prefix) + '/' + row['doi'] + '\t' + result)
+    print('\n' + '; '.join(result + ': ' + str(count) for result, count in sorted(totals.items())))
+    log.event('Manifest ' + manifest_file + ': ' + str(len(rows)) + ' rows. ' + '; '.join(result + ': ' + str(count) for result, count in sorted(totals.items())),
+              stage='manifest', status='ok', count=len(rows), results=dict(totals))
+
+
+if args.manifest:
+    run_manifest(args.manifest)
+    tracker.stop(track_wait)
+    exit()
+
 # Metadata
 
 pubtype = args.pubtype
@@ -66,45 +409,20 @@ cris_pubid = args.pubid
 update_cris = args.updateCRIS
 
 # Validate input
-if pubtype not in ['book','dissertation','preprint','proceeding','report']:
-    print('ERROR: Pubtype has to be one of "book", "dissertation", "preprint", "proceeding","report"')
-    exit()
-
-if update_cris not in ['y','n']:
-    print('ERROR! UpdateCRIS (-u) has to be y(es) or n(no), default yes (if empty)')
+for error in validate(cris_pubid, args.doi, pubtype, update_cris):
+    print('ERROR: ' + error)
     exit()
 
-if str(args.doi).startswith('10.63959'):
-    print('ERROR: DOI should be WITHOUT prefix!')
-    exit()
-
-if len(cris_pubid) < 12:
-    print('ERROR: Publication ID should be the long (guid) id!')
-    exit()
-
-instname_txt = 'Chalmers University of Technology'
-instplace_txt = 'Gothenburg, Sweden'
-ror_id = 'https://ror.org/040wg7k59'
-
-depositor_name = 'Chalmers Research Support'
-depositor_email = 'research.lib@chalmers.se'
-cris_updated_by = 'crossref/doi'
-
-# Publ.type specific params
-
-crossref_type = ''
-chalmers_publ = 'y'
-degree_abbrev = '' # doc or lic?
-
 # Retrieve publication record from Chalmers Research
 
-cris_query = 'Id%3A%22' + str(cris_pubid) + '%22&max=1&selectedFields=Id%2CTitle%2CAbstract%2CYear%2CIdentifiers%2CPersons.PersonData.FirstName%2CPersons.PersonData.LastName%2CPersons.PersonData.IdentifierOrcid%2CIncludedPapers%2CLanguage.Iso%2CConference%2CIdentifierIsbn%2CIdentifierDoi%2CIdentifierCplPubid%2CDispDate%2CSeries%2CKeywords%2CPersons.Organizations.OrganizationData.Id%2CPersons.Organizations.OrganizationData.OrganizationTypes.NameEng%2CPersons.Organizations.OrganizationData.Country%2CPersons.Organizations.OrganizationData.City%2CPersons.Organizations.OrganizationData.NameEng%2CPersons.Organizations.OrganizationData.DisplayPathEng%2CPublicationType.NameEng%2CPersons.Organizations.OrganizationData.Identifiers'
+cris_query = 'Id%3A%22' + str(cris_pubid) + '%22&max=1&selectedFields=' + cris_fields
 
 research_lookup_url = str(cris_api_ep) + '?query=' + cris_query
 research_lookup_headers = {'Accept': 'application/json'}
 
 try:
-    research_lookup_data = requests.get(url=research_lookup_url, headers=research_lookup_headers).text
+    with metrics.timed('stage', stage='cris_query'):
+        research_lookup_data = httpclient.get(url=research_lookup_url, headers=research_lookup_headers).text
     research_publ = json.loads(research_lookup_data)
 
     publ = ''
@@ -116,379 +434,7 @@ try:
         exit()
 
     if publ:
-        print('Found publication ' + str(cris_pubid) + ' in Research.')
-        
-        # Loop through the pub data and create a new DOI accordingly
-        
-        xml_filename = ''
-        root = ''
-
-        pubid = str(publ['Id'])
-
-        title_txt = publ['Title']
-        version_enum = '1'
-        year = str(publ['Year'])
-        isbn = ''
-        isbn_normal = ''
-        if 'IdentifierIsbn' in publ:
-            if len(publ['IdentifierIsbn']) > 0:
-                isbn = str(publ['IdentifierIsbn'][0])
-                isbn_normal = isbn.replace('-', '')
-
-        public_pubid = str(publ['IdentifierCplPubid'][0])
-
-        conference = []
-        if 'Conference' in publ:
-            if len(publ['Conference']) > 0:
-                conference = publ['Conference']
-        
-        # Check if item already has a DOI (just in case)
-        if 'IdentifierDoi' in publ:
-            if len(publ['IdentifierDoi']) > 0 and update_cris == 'y':
-                print('\nIt seems this item already has a DOI in Research:  ' + str(publ['IdentifierDoi'][0]) + '\nIs this correct? Do you wish to continue (this would add a possible duplicate)? (y/n)')
-                yes = {'yes', 'y', 'ye', 'j', 'ja', ''}
-                no = {'no', 'n', 'nej'}
-                choice = input().lower()
-                if choice in yes:
-                    print('Ok')
-                    # continue
-                elif choice in no:
-                    print('Ok, exiting...')
-                    exit()
-
-        abstract_txt = ''
-        if ('Abstract' in publ):
-            abstract_txt = publ['Abstract']
-
-        # Persons
-        authors = []
-        authors = publ['Persons']
-        
-        included_paper_dois = []
-        if ('IncludedPapers') in publ:
-                if len(publ['IncludedPapers']) > 0:
-                    for inclp in publ['IncludedPapers']:
-                        # Retrieve DOI from inluded papers and add these
-                        incl_pubid = str(inclp['Publication'])
-                        incl_doi_request_url = str(cris_api_ep) + '?query=Id%3A%22' + incl_pubid + '%22&selectedFields=Id%2CIdentifierDoi'
-                        incl_doi_request_headers = {'Accept': 'application/json'}
-                        incl_doi_request_data = requests.get(url=incl_doi_request_url, headers=incl_doi_request_headers).text
-                        incl_doi_request_publs = json.loads(incl_doi_request_data)
-                        pubinc = incl_doi_request_publs['Publications'][0]
-                        #print(pubinc)
-                        if 'IdentifierDoi' in pubinc:
-                            if len(pubinc['IdentifierDoi']) > 0:
-                                included_paper_dois.append(str(pubinc['IdentifierDoi'][0]))
-
-        lang = publ['Language']['Iso']
-        
-        cris_pubtype = publ['PublicationType']['NameEng']
-
-        if cris_pubtype == 'Doctoral thesis':
-            degree_abbrev = 'PhD'
-        if cris_pubtype == 'Licentiate thesis':
-            degree_abbrev = 'Licentiate'
-
-        disp_date = ''
-        if 'DispDate' in publ:
-            disp_date = str(publ['DispDate'])
-
-        itemnumber = ''
-        if 'Series' in publ:
-            if len(publ['Series']) > 0:
-                for serie in publ['Series']:
-                    if  serie['SerialItem']['Id'] == '3b982ea2-6c34-1014-b6a7-7ac9b7ba4313':
-                        itemnumber = str(serie['SerialNumber'])
-                    
-        #cris_pubid = public_pubid
-        cris_url = str(cris_base_url) + public_pubid
-        create_date = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-        runtime_date = datetime.datetime.now().strftime("%Y-%m-%d:%H:%M:%S")
-
-        # Clean relevant text fields
-        abstract_clean = ''
-        if abstract_txt:
-            abstract_clean = BeautifulSoup(abstract_txt.rstrip('\r\n').strip(), "lxml").text
-
-        if title_txt:
-            title_clean = BeautifulSoup(title_txt.rstrip('\r\n').strip(), "lxml").text
-
-        print('\nITEM DETAILS\n============\nNew DOI: ' + doi_id + '\nTitle: ' + title_txt + '\nResearch Pubtype: ' + cris_pubtype + '\nCrossRef Pubtype: ' + pubtype + '\nResearch ID: ' + cris_pubid + '\nUpdate Research?: ' + update_cris + '\n\nShould we create a DOI for this? (y/n)')
-        yes = {'yes', 'y', 'ye', 'j', 'ja', ''}
-        no = {'no', 'n', 'nej'}
-        choice = input().lower()
-        if choice in yes:
-            print('Ok')
-            # continue
-        elif choice in no:
-            print('Ok, exiting...')
-            exit()
-
-        # Write to log
-        with open(logfile, 'a') as lfile:
-            lfile.write(datetime.datetime.now().strftime("%Y%m%d%H%M%S") + '\tTrying to create a new DOI: ' + doi_id + ' for Research publ: ' + cris_url + '\n')
-            lfile.close()
-
-            # Create XML file
-
-            schema = "http://www.crossref.org/schema/" + str(schema_version) + " https://www.crossref.org/schemas/crossref" + schema_version + ".xsd"
-            namespace = "http://www.crossref.org/schema/" + str(schema_version)
-            version = schema_version
-
-            xml_filename = create_date + '.xml'
-
-            ns = namespace
-            xsi = "http://www.w3.org/2001/XMLSchema-instance" 
-            jats = "http://www.ncbi.nlm.nih.gov/JATS1"
-            mml = "http://www.w3.org/1998/Math/MathML"
-            fr = "http://www.crossref.org/fundref.xsd"
-
-            attr_qname = ET.QName("http://www.w3.org/2001/XMLSchema-instance", "schemaLocation")
-            ns_map = { "jats": jats,"mml": mml,"xsi": xsi,"fr": fr }
-
-            for prefix, uri in ns_map.items():
-                ET.register_namespace(prefix, uri)
-
-            root = ET.Element("doi_batch", 
-                                {attr_qname: "http://www.crossref.org/schema/" + str(schema_version) + " https://www.crossref.org/schemas/crossref" + str(schema_version) + ".xsd"},
-                                xmlns='http://www.crossref.org/schema/' + schema_version +'',
-                                version=schema_version)
-            head = ET.SubElement(root, "head")
-            ET.SubElement(head, "doi_batch_id").text = doi_id
-            ET.SubElement(head, "timestamp").text = create_date
-            depositor = ET.SubElement(head, "depositor")
-            ET.SubElement(depositor, "depositor_name").text = depositor_name
-            ET.SubElement(depositor, "email_address").text = depositor_email
-            ET.SubElement(head, "registrant").text = instname_txt
-            body = ET.SubElement(root, "body")    
-            if pubtype == 'dissertation':
-                publication = ET.SubElement(body, pubtype, publication_type="full_text", language=lang)
-            if pubtype == 'book':
-                publication_book = ET.SubElement(body, pubtype, book_type="monograph")
-                publication = ET.SubElement(publication_book, "book_metadata", language=lang)
-            if pubtype == 'preprint':
-                publication = ET.SubElement(body, "posted_content", type=pubtype)
-            if pubtype == 'report':
-                publication_report = ET.SubElement(body, "report-paper")
-                publication = ET.SubElement(publication_report, "report-paper_metadata", language=lang)
-            if pubtype == 'proceeding':
-                publication_proc = ET.SubElement(body, "conference")
-            if pubtype == 'proceeding':
-                contributors = ET.SubElement(publication_proc, "contributors")
-            else:
-                contributors = ET.SubElement(publication, "contributors")
-            if authors:
-                seq = 0
-                seq_txt = 'first'
-                for a in authors:
-                    role = 'author'
-                    if pubtype == 'proceeding':
-                        role = 'editor'
-                    if seq == 0:
-                        seq_txt = 'first'
-                    else:
-                        seq_txt = 'additional'
-                    person_name = ET.SubElement(contributors, "person_name", contributor_role=role, sequence=seq_txt)
-                    ET.SubElement(person_name, "given_name").text = a['PersonData']['FirstName']
-                    ET.SubElement(person_name, "surname").text = a['PersonData']['LastName']
-                    affiliations = ET.SubElement(person_name, "affiliations")
-                    for aff in a['Organizations']:
-                        department = str(aff['OrganizationData']['DisplayPathEng'])
-                        institution = ET.SubElement(affiliations, "institution")
-                        if str(aff['OrganizationData']['OrganizationTypes'][0]['NameEng']).startswith('Chalmers'):
-                            if pubtype in ['dissertation','report','book','preprint']:
-                                instname = ET.SubElement(institution, "institution_name").text = instname_txt
-                            ror = ET.SubElement(institution, "institution_id", type="ror").text = ror_id
-                        else:
-                            if pubtype in ['dissertation','report','book','preprint']:
-                                instname = ET.SubElement(institution, "institution_name").text = aff['OrganizationData']['NameEng']
-                            else:
-                                instname = ET.SubElement(institution, "institution_acronym").text = aff['OrganizationData']['NameEng']
-                        for orgid in aff['OrganizationData']['Identifiers']:
-                            if orgid['Type']['Value'] == 'ROR_ID':
-                                ror = ET.SubElement(institution, "institution_id", type="ror").text = str(orgid['Value'])
-                        if 'City' in aff['OrganizationData']:
-                            instplace = ET.SubElement(institution, "institution_place").text = str(aff['OrganizationData']['City']) + ', ' + str(aff['OrganizationData']['Country'])
-                        else:    
-                            instplace = ET.SubElement(institution, "institution_place").text = str(aff['OrganizationData']['Country'])
-                    if 'IdentifierOrcid' in a['PersonData']:
-                         if len(a['PersonData']['IdentifierOrcid']) > 0:
-                            orcid = ET.SubElement(person_name, "ORCID", authenticated = "true").text = "https://orcid.org/" + str(a['PersonData']['IdentifierOrcid'][0])  
-                    seq += 1
-            if pubtype == 'proceeding':
-                if conference:
-                    event = ET.SubElement(publication_proc, "event_metadata")
-                    event_name = ET.SubElement(event, "conference_name").text = conference['Name']
-                    if 'City' in conference:
-                        if 'Country' in conference:
-                            event_place = ET.SubElement(event, "conference_location").text = str(conference['City']) + ', ' + str(conference['Country']['NameEng'])
-                    if 'StartDate' in conference:
-                        if 'EndDate' in conference:
-                            startdate = str(conference['StartDate'])
-                            enddate = str(conference['EndDate'])
-                            event_dates = ET.SubElement(event, "conference_date", start_month=startdate[5:7], start_year=startdate[0:4], start_day=startdate[8:10], end_month=enddate[5:7], end_year=enddate[0:4], end_day=enddate[8:10])
-                publication = ET.SubElement(publication_proc, "proceedings_metadata", language=lang)
-                proceedings_title = ET.SubElement(publication, "proceedings_title").text = title_clean       
-            if pubtype in ['book', 'dissertation', 'preprint', 'report']:
-                titles = ET.SubElement(publication, "titles")
-                title = ET.SubElement(titles, "title").text = title_clean
-            if pubtype in ['preprint']:
-                posted_date = ET.SubElement(publication, "posted_date")
-                posted_year = ET.SubElement(posted_date, "year").text = year
-            if abstract_clean and pubtype in ['book', 'dissertation', 'preprint', 'report']:
-                abstract = ET.SubElement(publication, ET.QName(ns_map["jats"], "abstract"))
-                abstract_p = ET.SubElement(abstract, ET.QName(ns_map["jats"], "p")).text = abstract_clean
-            if pubtype == 'dissertation':
-                if disp_date:
-                    if len(disp_date) > 0:
-                        approvaldate = ET.SubElement(publication, "approval_date")
-                        amonth = ET.SubElement(approvaldate, "month").text = disp_date[5:7]
-                        aday = ET.SubElement(approvaldate, "day").text = disp_date[8:10]
-                        ayear = ET.SubElement(approvaldate, "year").text = disp_date[0:4]
-            if pubtype == 'dissertation':
-                institution_publ = ET.SubElement(publication, "institution")
-                ror_publ = ET.SubElement(institution_publ, "institution_id", type="ror").text = ror_id
-                if department:
-                    dept_publ = ET.SubElement(institution_publ, "institution_department").text = department
-            if degree_abbrev:
-                degree = ET.SubElement(publication, "degree").text = degree_abbrev
-            if chalmers_publ and pubtype in ['proceeding']:
-                publisher = ET.SubElement(publication, "publisher")
-                publisher_name = ET.SubElement(publisher, "publisher_name").text = instname_txt
-                publisher_place = ET.SubElement(publisher, "publisher_place").text = instplace_txt
-            if pubtype in ['report','book','proceeding']:
-                pubdate = ET.SubElement(publication, "publication_date", media_type = "online")
-                pubyear = ET.SubElement(pubdate, "year").text = year
-            if isbn:
-                isbn_print = ET.SubElement(publication, "isbn", media_type="print").text = isbn
-            else:
-                if pubtype in ['proceeding','book']:
-                    isbn_print = ET.SubElement(publication, "noisbn", reason='monograph')
-            if chalmers_publ and pubtype in ['report','book']:
-                publisher = ET.SubElement(publication, "publisher")
-                publisher_name = ET.SubElement(publisher, "publisher_name").text = instname_txt
-                publisher_place = ET.SubElement(publisher, "publisher_place").text = instplace_txt
-            # Adding included papers as relations is currently not supported...
-            #if included_paper_dois:
-            #    related_ids = ET.SubElement(publication, "relatedIdentifiers")
-            #    for incl_doi in included_paper_dois:
-            #        related_doi = ET.SubElement(related_ids, "relatedIdentifier", relatedIdentifierType="DOI", relationType="HasPart").text = incl_doi.strip()
-            if pubtype in ['dissertation','report','preprint']:
-                version_info = ET.SubElement(publication, "version_info")
-                version = ET.SubElement(version_info, "version").text = version_enum
-            doi_data = ET.SubElement(publication, "doi_data")
-            doi = ET.SubElement(doi_data, "doi").text = doi_id
-            resource = ET.SubElement(doi_data, "resource").text = cris_url
-
-            # Create file
-            dom = xml.dom.minidom.parseString(ET.tostring(root))
-            xml_string = dom.toprettyxml()
-            part1, part2 = xml_string.split('?>')
-
-            with open(xml_filename, 'w') as xfile:
-                xfile.write(part1 + 'encoding=\"{}\"?>'.format(m_encoding) + part2)
-                xfile.close()
-            
-            # Post XML to CrossRef endpoint
-            # https://www.crossref.org/documentation/register-maintain-records/direct-deposit-xml/https-post/
-
-            print('Attempting to create a DOI: ' + doi_id + ' for Research publ: ' + cris_url + ' using file: ' + xml_filename)
-
-            if create_doi == "true":
-         
-                files = {
-                        'operation': (None, 'doMDUpload'),
-                        'login_id': (None, crossref_uid),
-                        'login_passwd': (None, crossref_pw),
-                        'fname': ('[filename]', open(xml_filename, 'rb'))
-                }
-
-                try:
-                    response = requests.post(crossref_ep, files=files)
-                    if response.status_code == 401:
-                        print("Something went wrong! Response: " + str(response.reason))
-                        with open(logfile, 'a') as lfile:
-                            lfile.write(datetime.datetime.now().strftime("%Y%m%d%H%M%S") + '\tCreating DOI: ' + doi_id + ' for Research publ: ' + cris_url + ' using file: ' + xml_filename + ' failed! Response: ' + str(response.reason) + '\n\n')
-                            lfile.close()
-                        exit()
-                    else:
-                        print("DOI was created. Status: " + str(response.status_code))
-                except requests.exceptions.HTTPError as e:
-                    print('DOI was not created, exiting now. Exception: ' + str(e))
-                    with open(logfile, 'a') as lfile:
-                            lfile.write(datetime.datetime.now().strftime("%Y%m%d%H%M%S") + '\tDOI could NOT be created: ' + doi_id + ' for Research publ: ' + cris_url + ' using file: ' + xml_filename + '\n\n')
-                            lfile.close()
-                    exit()
-                
-                if update_cris == 'y':
-                    # Update publication record in Research (if ok)
-                    research_url = str(cris_api_ep) + cris_pubid
-                    research_headers = {'Accept': 'application/json'}
-                    print('Updating publication ID: ' + cris_pubid + ' in Research.')
-                    try:
-                        research_data = requests.get(url=research_url, headers=research_headers).text
-                        # Read response and add updated info
-                        datestring = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ')
-                        research_publ = json.loads(research_data)
-
-                        research_publ['UpdatedBy'] = cris_updated_by
-                        research_publ['UpdatedDate'] = datestring
-
-                        new_doi = {}
-                        new_doi_type = {}
-                        new_doi_type['Id'] = '5907253f-7ad4-4b1e-84d1-7e72ea1d92a8'
-                        new_doi['Type'] = new_doi_type
-                        new_doi['CreatedBy'] = cris_updated_by
-                        new_doi['CreatedAt'] = datestring
-                        new_doi['Value'] = doi_id
-
-                        existing_ids = research_publ['Identifiers']
-                        new_ids = {}
-                        new_ids = existing_ids
-                        existing_ids.append(new_doi)
-
-                        research_publ['Identifiers'] = new_ids
-
-                        updated_record = json.dumps(research_publ)
-
-                        #print(json.dumps(updated_record, indent=4, sort_keys=True))
-
-                        try:
-                            response = requests.put(research_url, json=json.loads(updated_record), headers=research_headers)
-                            if response.status_code == 200:
-                                print(cris_pubid + ' UPDATED\n')
-                                with open(logfile, 'a') as lfile:
-                                    lfile.write(datetime.datetime.now().strftime("%Y%m%d%H%M%S") + '\tResearch CRIS publication ' + cris_pubid + ' has been updated!\n')
-                                    lfile.close()
-                            else:
-                                print(cris_pubid + ' could not be updated! ' + 'Status: ' + str(response.status_code) + '\n')
-                                with open(logfile, 'a') as lfile:
-                                    lfile.write(datetime.datetime.now().strftime("%Y%m%d%H%M%S") + '\tResearch CRIS publication ' + cris_pubid + ' count NOT be updated!\n')
-                                    lfile.close()
-                        except requests.exceptions.HTTPError as e:
-                            print('Exception.')
-                            with open(logfile, 'a') as lfile:
-                                lfile.write(datetime.datetime.now().strftime("%Y%m%d%H%M%S") + '\tResearch CRIS publication ' + cris_pubid + ' count NOT be updated!\n')
-                                lfile.close()
-                            print('\n')
-
-                    except requests.exceptions.HTTPError as e:
-                        print('Something went wrong! Exiting.')
-                        exit()
-                else:
-                    print('Chalmers CRIS publication was NOT updated! Use -u y to do this.')  
-
-                # Write to log end exit
-                with open(logfile, 'a') as lfile:
-                    lfile.write(datetime.datetime.now().strftime("%Y%m%d%H%M%S") + '\tCreated DOI: ' + doi_id + ' for Research publ: ' + cris_url + '. Filename: ' + xml_filename + '\n')
-                    lfile.close()
-
-                # Write runtime timestamp to file (only if all has finished without issues)
-                with open(runtime_file, 'w') as rtfile:
-                    rtfile.write(runtime_date + '\n')
-                    rtfile.close()
-            else:
-                print('DOI was NOT created, due to system settings.')
+        create_doi_for(publ, cris_pubid, doi_id, pubtype, update_cris, ask)
         #sleep(10)
 
         # debug
@@ -497,9 +443,12 @@ try:
         print('ERROR! No Research publication found for id ' + cris_pubid + ', exiting!')
         exit()
 
-except requests.exceptions.HTTPError as e:
+except requests.exceptions.RequestException as e:
     print("A general error occured! Exiting.")
     exit()
 
+# Wait up to CROSSREF_TRACK_WAIT seconds for the CrossRef result (otherwise it is followed up by the next batch run)
+tracker.stop(track_wait)
+
 # finish here
 exit()
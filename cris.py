@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+import datetime
+import json
+import os
+import re
+import threading
+from urllib.parse import unquote
+import requests
+import httpclient
+import locking
+import metrics
+from concurrent.futures import ThreadPoolExecutor
+
+# Helpers for reading publication records from the Chalmers Research (CRIS) API.
+
+cris_headers = {'Accept': 'application/json'}
+
+
+class PublicationHarvester:
+    # Walks a CRIS search result page by page (start/max) and yields the publications one at a time,
+    # so that a large result never has to be held in memory at once. While the caller works on the
+    # current page, the next page is already being fetched in the background.
+    #
+    # api_ep: CRIS_API_EP, query: the (url encoded) search query, selected_fields: (url encoded) field list
+    # page_size: records per request, max_records: stop after this many records (0 or None = all)
+    # on_page: optional callable, called with the publications of each page before they are yielded
+    # (so also when all records of the previous page have been processed)
+    # sort: optional (url encoded) sort parameter value
+    # accept: optional callable, only the publications it returns True for are passed on (e.g. the share of
+    # one worker process), the others still count for max_records
+
+    def __init__(self, api_ep, query, selected_fields='', page_size=50, max_records=0, on_page=None, sort='', accept=None):
+        self.api_ep = str(api_ep)
+        self.query = query
+        self.selected_fields = selected_fields
+        self.sort = sort
+        self.page_size = max(int(page_size), 1)
+        self.max_records = int(max_records or 0)
+        self.on_page = on_page
+        self.accept = accept
+        self._first_page = None
+
+    def page_url(self, start):
+        url = self.api_ep + '?query=' + self.query + '&max=' + str(self.page_size) + '&start=' + str(start)
+        if self.selected_fields:
+            url += '&selectedFields=' + self.selected_fields
+        if self.sort:
+            url += '&sort=' + self.sort
+        return url
+
+    def fetch_page(self, start):
+        with metrics.timed('stage', stage='cris_query'):
+            response = httpclient.get(url=self.page_url(start), headers=cris_headers)
+            response.raise_for_status()
+            page = json.loads(response.text)
+        if 'Publications' not in page:
+            page['Publications'] = []
+        return page
+
+    @property
+    def total_count(self):
+        # Number of matching records according to CRIS (fetches the first page if needed)
+        if self._first_page is None:
+            self._first_page = self.fetch_page(0)
+        return int(self._first_page.get('TotalCount', 0))
+
+    @property
+    def limit(self):
+        if self.max_records > 0:
+            return min(self.total_count, self.max_records)
+        return self.total_count
+
+    def __iter__(self):
+        limit = self.limit
+        page = self._first_page
+        self._first_page = None
+        start = 0
+        yielded = 0
+
+        with ThreadPoolExecutor(max_workers=1) as prefetch:
+            while page is not None and yielded < limit:
+                publs = page['Publications'][:limit - yielded]
+                start += len(page['Publications'])
+                yielded += len(publs)
+                if self.accept is not None:
+                    publs = [publ for publ in publs if self.accept(publ)]
+
+                # Prefetch the next page while this one is being processed
+                next_page = None
+                if page['Publications'] and start < limit:
+                    next_page = prefetch.submit(self.fetch_page, start)
+
+                if self.on_page is not None and publs:
+                    self.on_page(publs)
+
+                for publ in publs:
+                    yield publ
+
+                page = None
+                if next_page is not None:
+                    page = next_page.result()
+
+
+def parse_event_date(value):
+    # CRIS date (2025-10-01T10:00:00[.fff][Z]), the old RUNTIME format (2025-10-01:10:00:00) or a day, None if empty
+    value = str(value or '').strip()
+    if len(value) >= 19:
+        return datetime.datetime.strptime(value[:10] + 'T' + value[11:19], '%Y-%m-%dT%H:%M:%S')
+    if len(value) >= 10:
+        return datetime.datetime.strptime(value[:10], '%Y-%m-%d')
+    return None
+
+
+def sorted_by_event_date(sort):
+    # True if the CRIS sort parameter (CRIS_SORT, possibly url encoded) sorts on LatestEventDate ascending,
+    # e.g. LatestEventDate, LatestEventDate asc, LatestEventDate:asc (not: -LatestEventDate, LatestEventDate desc, Title)
+    parts = [part for part in re.split(r'[\s,:]+', unquote(str(sort or '')).strip()) if part]
+    if not parts or parts[0].lstrip('+') != 'LatestEventDate':
+        return False
+    return len(parts) == 1 or parts[1].lower() not in ('desc', 'descending')
+
+
+class Watermark:
+    # Incremental harvest position, kept in the RUNTIME file: the highest LatestEventDate of the records
+    # that have been fully processed (deposited, skipped or already existing). The next run harvests
+    # from the watermark minus overlap (minutes).
+    #
+    # Records are registered with start() when harvested and finished with done() or, if their deposit
+    # failed, hold(). Records still in progress and held records cap the watermark, so they are harvested
+    # again. The file is replaced atomically (temp file + rename) and only when the watermark has moved.
+    # If the records come in LatestEventDate order (ordered=True), the watermark is committed after every
+    # page; otherwise only at the end of the run, since a later page may still hold older changes, and not
+    # at all when the harvest was cut short (complete=False, MAXRECORDS): the records that were not harvested
+    # may be older than the newest one that was processed.
+    # The file is written under a lock and never moved backwards, also when another process has written it
+    # in the meantime. Without a RUNTIME file yet, the run starts from initial_file (if given).
+
+    def __init__(self, runtime_file, overlap=0, ordered=False, initial_file=None):
+        self.runtime_file = runtime_file
+        self.overlap = datetime.timedelta(minutes=float(overlap or 0))
+        self.ordered = ordered
+        self.stored = self._read(runtime_file)
+        if self.stored is None and initial_file:
+            self.stored = self._read(initial_file)
+        self.lock = threading.Lock()
+        self.in_progress = {}
+        self.latest = None
+        self.held = None
+        self.held_count = 0
+
+    @staticmethod
+    def _read(path):
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as rtfile:
+            return parse_event_date(rtfile.read())
+
+    def query_from(self):
+        # Lower bound for LatestEventDate in the harvest query
+        start = (self.stored or datetime.datetime(1970, 1, 1)) - self.overlap
+        return start.strftime('%Y-%m-%dT%H:%M:%S')
+
+    def start(self, key, value):
+        with self.lock:
+            self.in_progress[key] = parse_event_date(value)
+
+    def done(self, key):
+        with self.lock:
+            date = self.in_progress.pop(key, None)
+            if date is not None and (self.latest is None or date > self.latest):
+                self.latest = date
+
+    def hold(self, key):
+        with self.lock:
+            if key in self.in_progress:
+                self.held_count += 1
+            date = self.in_progress.pop(key, None)
+            if date is not None and (self.held is None or date < self.held):
+                self.held = date
+
+    def unfinished(self):
+        # (records held, records still in progress): records this run has not finished and that are harvested again
+        with self.lock:
+            return self.held_count, len(self.in_progress)
+
+    def commit(self, final=False, complete=True):
+        # Write the watermark, True if it moved. complete: all matching records have been harvested
+        if not (final or self.ordered):
+            return False
+        if not (complete or self.ordered):
+            return False
+        with self.lock:
+            value = self.latest
+            for date in list(self.in_progress.values()) + [self.held]:
+                if value is not None and date is not None and date < value:
+                    value = date
+            if value is None or (self.stored is not None and value <= self.stored):
+                return False
+            with locking.locked(self.runtime_file):
+                current = self._read(self.runtime_file)
+                if current is not None and value <= current:
+                    # Another process has already moved the watermark further
+                    self.stored = current
+                    return False
+                tmp_file = self.runtime_file + '.tmp'
+                with open(tmp_file, 'w') as rtfile:
+                    rtfile.write(value.strftime('%Y-%m-%dT%H:%M:%S') + '\n')
+                    rtfile.flush()
+                    os.fsync(rtfile.fileno())
+                os.replace(tmp_file, self.runtime_file)
+            self.stored = value
+            return True
+
+
+# DOIs of CRIS publications already looked up in this run: {pubid: doi or ''}
+_doi_cache = {}
+
+
+def _search_ids(api_ep, pubids, selected_fields):
+    query = '(' + '%20OR%20'.join('Id%3A%22' + pubid + '%22' for pubid in pubids) + ')'
+    url = str(api_ep) + '?query=' + query + '&max=' + str(len(pubids)) + '&selectedFields=' + selected_fields
+    with metrics.timed('stage', stage='cris_query'):
+        response = httpclient.get(url=url, headers=cris_headers)
+        response.raise_for_status()
+        return {str(publ['Id']): publ for publ in json.loads(response.text).get('Publications', [])}
+
+
+def fetch_publications(api_ep, pubids, selected_fields, chunk_size=50, workers=4):
+    # CRIS records for many publication ids ({pubid: publication}, ids that were not found are left out),
+    # with one OR-combined Id query per chunk_size ids, chunks in parallel
+    pubids = list(dict.fromkeys(str(pubid) for pubid in pubids))
+    publs = {}
+    if pubids:
+        chunks = [pubids[i:i + chunk_size] for i in range(0, len(pubids), chunk_size)]
+        with ThreadPoolExecutor(max_workers=min(workers, len(chunks))) as pool:
+            for result in pool.map(lambda chunk: _search_ids(api_ep, chunk, selected_fields), chunks):
+                publs.update(result)
+    return publs
+
+
+def resolve_dois(api_ep, pubids, chunk_size=50, workers=4):
+    # DOIs for many CRIS publication ids at once ({pubid: doi or ''}), every id is only fetched once per run
+    pubids = [str(pubid) for pubid in pubids]
+    missing = [pubid for pubid in dict.fromkeys(pubids) if pubid not in _doi_cache]
+    if missing:
+        publs = fetch_publications(api_ep, missing, 'Id%2CIdentifierDoi', chunk_size, workers)
+        for pubid in missing:
+            dois = publs.get(pubid, {}).get('IdentifierDoi') or []
+            _doi_cache[pubid] = str(dois[0]) if len(dois) > 0 else ''
+    return {pubid: _doi_cache[pubid] for pubid in pubids}
+
+
+# Identifier type of DOIs in CRIS
+doi_identifier_type = '5907253f-7ad4-4b1e-84d1-7e72ea1d92a8'
+
+
+class CrisWriteBack:
+    # Adds new DOIs to publication records in CRIS. The record is read once, the DOI is appended to its
+    # Identifiers (with UpdatedBy/UpdatedDate set) and the same object is sent back with PUT (the API only
+    # takes whole records, so there is no smaller payload to send).
+    #
+    # Concurrent changes: expected_updated is the UpdatedDate of the record as it was harvested. If the
+    # record has been changed since then and now holds another DOI, it is left alone ('conflict'). Other
+    # changes are kept, since the DOI is added to the record as it is now. If CRIS gives an ETag, the PUT is
+    # sent with If-Match; on 409/412 the record is read again and the DOI applied again, at most retries
+    # times. A DOI that is already in the record is not added again. Can be used from several threads.
+    #
+    # add_doi returns (result, detail): updated, exists, conflict or failed, with the HTTP status or reason
+
+    def __init__(self, api_ep, updated_by, retries=2):
+        self.api_ep = str(api_ep)
+        self.updated_by = updated_by
+        self.retries = int(retries)
+
+    def add_doi(self, pubid, doi, expected_updated=None):
+        with metrics.timed('stage', stage='cris_update') as timer:
+            result = self._add_doi(pubid, doi, expected_updated)
+            timer.status = result[0]
+            return result
+
+    def _add_doi(self, pubid, doi, expected_updated):
+        record_url = self.api_ep + str(pubid)
+        result = ('conflict', None)
+        try:
+            for attempt in range(self.retries + 1):
+                response = httpclient.get(url=record_url, headers=cris_headers)
+                response.raise_for_status()
+                record = response.json()
+                identifiers = record.get('Identifiers') or []
+                dois = [str(identifier.get('Value')) for identifier in identifiers if (identifier.get('Type') or {}).get('Id') == doi_identifier_type]
+                if doi in dois:
+                    return ('exists', response.status_code)
+                if expected_updated and record.get('UpdatedDate') != expected_updated and dois:
+                    return ('conflict', 'changed since ' + str(expected_updated) + ', has DOI ' + dois[0])
+
+                datestring = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ')
+                identifiers.append({'Type': {'Id': doi_identifier_type}, 'CreatedBy': self.updated_by, 'CreatedAt': datestring, 'Value': doi})
+                record['Identifiers'] = identifiers
+                record['UpdatedBy'] = self.updated_by
+                record['UpdatedDate'] = datestring
+
+                headers = dict(cris_headers)
+                if response.headers.get('ETag'):
+                    headers['If-Match'] = response.headers['ETag']
+                response = httpclient.put(record_url, json=record, headers=headers)
+                if response.status_code in (409, 412):
+                    result = ('conflict', response.status_code)
+                    continue
+                if response.status_code == 200:
+                    return ('updated', response.status_code)
+                return ('failed', response.status_code)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            return ('failed', str(e))
+        return result
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+import datetime
+import io
+import json
+import os
+import threading
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from lxml import etree
+import httpclient
+import locking
+import metrics
+
+# Helpers for registering DOIs with CrossRef.
+
+def doi_resolver():
+    # Base URL for DOI existence checks: DOI_RESOLVER if set (e.g. the local stand-in, see standin.py), else doi.org
+    return os.getenv('DOI_RESOLVER') or 'https://doi.org/'
+
+
+def serialize_doi_batch(root):
+    # UTF-8 bytes of a doi_batch tree, XML declaration included, written in one pass to memory
+    buffer = io.BytesIO()
+    buffer.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+    ET.ElementTree(root).write(buffer, encoding='UTF-8', xml_declaration=False)
+    return buffer.getvalue()
+
+
+def archive_xml(xml_bytes, filename, archive_dir=None):
+    # Keep a copy of a deposit file in XML_ARCHIVE_DIR (nothing is written when it is not set)
+    archive_dir = archive_dir or os.getenv('XML_ARCHIVE_DIR')
+    if not archive_dir:
+        return None
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, filename)
+    with open(path, 'wb') as xfile:
+        xfile.write(xml_bytes)
+    return path
+
+
+def deposit_files(uid, pw, xml_bytes, filename):
+    # Multipart form for a doMDUpload, the XML is streamed from memory
+    # https://www.crossref.org/documentation/register-maintain-records/direct-deposit-xml/https-post/
+    return {
+            'operation': (None, 'doMDUpload'),
+            'login_id': (None, uid),
+            'login_passwd': (None, pw),
+            'fname': (filename, io.BytesIO(xml_bytes), 'application/xml')
+    }
+
+
+def check_doi(doi_id):
+    # Status code doi.org answers for a DOI, without following the redirect to the landing page
+    # (302 = registered, 404 = unknown). None if the lookup itself failed.
+    with metrics.timed('stage', stage='doi_check') as timer:
+        try:
+            status = httpclient.head(doi_resolver() + str(doi_id), allow_redirects=False).status_code
+        except requests.exceptions.RequestException as e:
+            print('DOI lookup failed for ' + str(doi_id) + ': ' + str(e))
+            status = None
+        timer.status = str(status) if status is not None else 'failed'
+        return status
+
+
+def check_dois(doi_ids, workers=None):
+    # Check many DOIs at once through a bounded thread pool. Returns {doi: status code or None}.
+    doi_ids = list(dict.fromkeys(str(doi_id) for doi_id in doi_ids))
+    if not doi_ids:
+        return {}
+    workers = int(workers or os.getenv('DOI_CHECK_WORKERS') or 10)
+    with ThreadPoolExecutor(max_workers=min(workers, len(doi_ids))) as pool:
+        return dict(zip(doi_ids, pool.map(check_doi, doi_ids)))
+
+
+class DepositPacker:
+    # Packs per-record deposit bodies (e.g. <dissertation> elements) into multi-record doi_batch files.
+    # A batch is handed back as soon as it holds max_records records or the next record would push it
+    # over max_bytes (serialized size of the bodies). Each record carries an info dict, so the caller
+    # can still update the ledger and CRIS per publication after the upload.
+
+    def __init__(self, max_records=1, max_bytes=5000000):
+        self.max_records = max(int(max_records), 1)
+        self.max_bytes = int(max_bytes)
+        self.records = []
+        self.size = 0
+
+    def add(self, element, info):
+        # Returns a list with the batches (lists of (element, info)) that are ready to be deposited
+        ready = []
+        size = len(ET.tostring(element))
+        if self.records and self.size + size > self.max_bytes:
+            ready.extend(self.drain())
+        self.records.append((element, info))
+        self.size += size
+        if len(self.records) >= self.max_records:
+            ready.extend(self.drain())
+        return ready
+
+    def drain(self):
+        # Hand back the current (possibly partial) batch
+        if not self.records:
+            return []
+        records = self.records
+        self.records = []
+        self.size = 0
+        return [records]
+
+
+# Compiled CrossRef schemas, one per schema file and process: {path: (XMLSchema, lock)}
+_schemas = {}
+_schemas_lock = threading.Lock()
+
+
+def _schema(path):
+    with _schemas_lock:
+        if path not in _schemas:
+            _schemas[path] = (etree.XMLSchema(etree.parse(path)), threading.Lock())
+        return _schemas[path]
+
+
+class DepositValidator:
+    # Checks doi_batch files against the CrossRef XSD before they are posted, so malformed records are
+    # found locally instead of being rejected (or silently dropped) after the upload.
+    #
+    # schema_dir holds a copy of the CrossRef schema files (crossref<schema_version>.xsd and the files it
+    # includes and imports, as in https://gitlab.com/crossref/schema/-/tree/master/schemas). The schema is
+    # compiled once per process and shared by all threads, after that a check is a parse and a validation
+    # of the serialized file. Without the schema files validation is switched off (available is False).
+    #
+    # Rejected records are appended to reject_file (if set) as JSON lines: time, pubid, doi, errors.
+
+    def __init__(self, schema_dir, schema_version='5.4.0', reject_file=None, enabled=True):
+        self.schema_file = os.path.join(str(schema_dir), 'crossref' + str(schema_version) + '.xsd')
+        self.reject_file = reject_file
+        self.available = bool(enabled) and os.path.exists(self.schema_file)
+        self.lock = threading.Lock()
+
+    def errors(self, xml_bytes):
+        # Schema errors of a serialized doi_batch ([] = valid, or validation switched off)
+        if not self.available:
+            return []
+        schema, lock = _schema(self.schema_file)
+        try:
+            document = etree.fromstring(xml_bytes)
+        except etree.XMLSyntaxError as e:
+            return ['not well-formed: ' + str(e)]
+        with lock:
+            if schema.validate(document):
+                return []
+            return ['line ' + str(error.line) + ': ' + error.message for error in schema.error_log]
+
+    def reject(self, pubid, doi, errors):
+        if not self.reject_file:
+            return
+        line = json.dumps({'time': datetime.datetime.now().isoformat(timespec='seconds'), 'pubid': pubid, 'doi': doi,
+                           'errors': errors}, ensure_ascii=False)
+        with self.lock:
+            locking.append_lines(self.reject_file, [line + '\n'])
+
+
+def parse_submission_result(text):
+    # Read a CrossRef submission log (doi_batch_diagnostic). Returns (batch status, {doi: (registered/failed, message)}).
+    # The batch status is completed, queued, in_process or unknown (None if the answer could not be read).
+    try:
+        diagnostic = ET.fromstring(text)
+    except ET.ParseError:
+        return None, {}
+    if diagnostic.tag != 'doi_batch_diagnostic':
+        return None, {}
+    results = {}
+    for record in diagnostic.iter('record_diagnostic'):
+        doi_id = (record.findtext('doi') or '').strip()
+        if doi_id:
+            status = 'registered' if record.get('status') in ['Success', 'Warning'] else 'failed'
+            results[doi_id] = (status, (record.findtext('msg') or '').strip())
+    return diagnostic.get('status'), results
+
+
+class SubmissionTracker:
+    # Follows CrossRef submissions until their result is known and marks each DOI in the ledger as
+    # registered or failed. Submissions are kept in the ledger, so anything still queued when a run
+    # ends is picked up by the next run. A background thread polls the submissions that are due,
+    # several at a time, with an exponential backoff per submission (backoff, 2*backoff, ... max_backoff).
+    #
+    # status_ep: CrossRef submissionDownload servlet, e.g. https://test.crossref.org/servlet/submissionDownload
+
+    def __init__(self, ledger, status_ep, uid, pw, workers=4, backoff=30, max_backoff=3600, max_attempts=20, interval=5):
+        self.ledger = ledger
+        self.status_ep = status_ep
+        self.uid = uid
+        self.pw = pw
+        self.workers = int(workers)
+        self.backoff = float(backoff)
+        self.max_backoff = float(max_backoff)
+        self.max_attempts = int(max_attempts)
+        self.interval = float(interval)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def track(self, batch_id):
+        # Register a new submission, first poll after backoff seconds
+        self.ledger.add_submission(batch_id, time.time() + self.backoff)
+
+    def fetch_result(self, batch_id):
+        params = {'usr': self.uid, 'pwd': self.pw, 'doi_batch_id': batch_id, 'type': 'result'}
+        with metrics.timed('stage', stage='submission_status') as timer:
+            try:
+                response = httpclient.get(self.status_ep, params=params)
+            except requests.exceptions.RequestException as e:
+                print('Submission status lookup failed for ' + batch_id + ': ' + str(e))
+                timer.status = 'failed'
+                return None, {}
+            if response.status_code != 200:
+                timer.status = 'failed'
+                return None, {}
+            status, results = parse_submission_result(response.content)
+            timer.status = status or 'unknown'
+            return status, results
+
+    def poll(self, submission):
+        batch_id, attempts = submission
+        status, results = self.fetch_result(batch_id)
+        attempts += 1
+        if status == 'completed':
+            self.ledger.complete_submission(batch_id, results)
+            failed = [doi_id for doi_id, (doi_status, message) in results.items() if doi_status == 'failed']
+            metrics.count('crossref_records', len(results) - len(failed), status='registered')
+            metrics.count('crossref_records', len(failed), status='failed')
+            print('CrossRef submission ' + batch_id + ' completed: ' + str(len(results) - len(failed)) + ' registered, ' + str(len(failed)) + ' failed')
+        elif attempts >= self.max_attempts:
+            self.ledger.abandon_submission(batch_id, attempts, 'no CrossRef result after ' + str(attempts) + ' status checks')
+            print('Giving up on CrossRef submission ' + batch_id + ' after ' + str(attempts) + ' status checks, its records will be deposited again')
+        else:
+            wait = min(self.backoff * 2 ** attempts, self.max_backoff)
+            self.ledger.reschedule_submission(batch_id, attempts, time.time() + wait)
+        return status
+
+    def poll_due(self):
+        # One polling round over the submissions that are due, returns the number polled
+        due = self.ledger.due_submissions(time.time())
+        if due:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(due))) as pool:
+                list(pool.map(self.poll, due))
+        return len(due)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.poll_due()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='submission-tracker', daemon=True)
+            self._thread.start()
+
+    def stop(self, wait=0):
+        # Stop polling. With wait > 0, keep polling in the foreground for up to wait seconds
+        # or until no submissions are pending.
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        deadline = time.time() + float(wait or 0)
+        while time.time() < deadline and self.ledger.pending_submissions() > 0:
+            self.poll_due()
+            next_poll = self.ledger.next_submission_poll() or deadline
+            time.sleep(max(min(next_poll, deadline) - time.time(), 0))
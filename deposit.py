@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+
+# Builds CrossRef deposit XML (doi_batch) from Chalmers CRIS publication records, shared by
+# create-doi-batch.py and create-doi-single.py.
+# Sample XML: https://gitlab.com/crossref/schema/-/tree/master/best-practice-examples
+# Guide: https://www.crossref.org/documentation/schema-library/markup-guide-metadata-segments/
+#
+# There is one DepositTemplate per CrossRef publication type. A template is compiled once: the
+# container elements and the list of steps that fill the record are chosen when it is created, so
+# building a record only runs the steps that apply to its type. Subtrees that are the same for every
+# record (depositor, registrant, publisher, ...) are built once and shared between records; they
+# must not be modified after they have been appended.
+#
+# CRIS organisations (OrganizationData) are resolved once per run into an Institution descriptor,
+# keyed by the organisation Id, and each template keeps the rendered <institution> element per
+# organisation, so the same departments are not re-evaluated for every author of every record.
+
+instname_txt = 'Chalmers University of Technology'
+instplace_txt = 'Gothenburg, Sweden'
+ror_id = 'https://ror.org/040wg7k59'
+
+depositor_name = 'Chalmers Research Support'
+depositor_email = 'research.lib@chalmers.se'
+
+xsi = "http://www.w3.org/2001/XMLSchema-instance"
+jats = "http://www.ncbi.nlm.nih.gov/JATS1"
+mml = "http://www.w3.org/1998/Math/MathML"
+fr = "http://www.crossref.org/fundref.xsd"
+
+attr_qname = ET.QName(xsi, "schemaLocation")
+ns_map = {"jats": jats, "mml": mml, "xsi": xsi, "fr": fr}
+
+for prefix, uri in ns_map.items():
+    ET.register_namespace(prefix, uri)
+
+jats_abstract = ET.QName(jats, "abstract")
+jats_p = ET.QName(jats, "p")
+
+# CrossRef publication types (supported)
+pubtypes = ['book', 'dissertation', 'preprint', 'proceeding', 'report']
+
+# Types where affiliations are given by institution_name (otherwise institution_acronym)
+named_institution_pubtypes = ['dissertation', 'report', 'book', 'preprint']
+
+
+def _element(tag, text=None, **attrib):
+    element = ET.Element(tag, attrib)
+    element.text = text
+    return element
+
+
+def _text_element(parent, tag, text, **attrib):
+    element = ET.SubElement(parent, tag, attrib)
+    element.text = text
+    return element
+
+
+# Shared, invariant subtrees
+depositor_element = _element("depositor")
+_text_element(depositor_element, "depositor_name", depositor_name)
+_text_element(depositor_element, "email_address", depositor_email)
+registrant_element = _element("registrant", instname_txt)
+
+publisher_element = _element("publisher")
+_text_element(publisher_element, "publisher_name", instname_txt)
+_text_element(publisher_element, "publisher_place", instplace_txt)
+
+noisbn_element = _element("noisbn", reason='monograph')
+chalmers_ror_element = _element("institution_id", ror_id, type="ror")
+_version_elements = {}
+
+
+# Organisation as used in the deposit: chalmers (bool), name, ror_ids (tuple), place, department (DisplayPathEng)
+Institution = namedtuple('Institution', ['chalmers', 'name', 'ror_ids', 'place', 'department'])
+
+institutions = {}
+
+
+def _institution(org):
+    ror_ids = tuple(str(orgid['Value']) for orgid in org.get('Identifiers') or [] if orgid['Type']['Value'] == 'ROR_ID')
+    if 'City' in org:
+        place = str(org['City']) + ', ' + str(org['Country'])
+    else:
+        place = str(org['Country'])
+    chalmers = str(org['OrganizationTypes'][0]['NameEng']).startswith('Chalmers')
+    return Institution(chalmers, instname_txt if chalmers else org['NameEng'], ror_ids, place, org.get('DisplayPathEng'))
+
+
+def institution_of(org):
+    # Institution descriptor of a CRIS OrganizationData (cached by organisation Id)
+    org_id = org.get('Id')
+    if org_id is None:
+        return _institution(org)
+    institution = institutions.get(org_id)
+    if institution is None:
+        institution = institutions[org_id] = _institution(org)
+    return institution
+
+
+def doi_batch(batch_id, timestamp, schema_version='5.4.0'):
+    # New doi_batch root with head, returns (root, body)
+    schema_version = str(schema_version)
+    root = ET.Element("doi_batch",
+                      {attr_qname: "http://www.crossref.org/schema/" + schema_version + " https://www.crossref.org/schemas/crossref" + schema_version + ".xsd"},
+                      xmlns='http://www.crossref.org/schema/' + schema_version,
+                      version=schema_version)
+    head = ET.SubElement(root, "head")
+    _text_element(head, "doi_batch_id", batch_id)
+    _text_element(head, "timestamp", timestamp)
+    head.append(depositor_element)
+    head.append(registrant_element)
+    body = ET.SubElement(root, "body")
+    return root, body
+
+
+def department_of(persons):
+    # Department given for the publication: the display path of the last listed affiliation
+    department = ''
+    for person in persons or []:
+        for aff in person['Organizations']:
+            department = str(institution_of(aff['OrganizationData']).department)
+    return department
+
+
+class DepositTemplate:
+    # record: dict with the (cleaned) values of one publication
+    #   doi, url, title, abstract, lang, year, isbn, disp_date, degree, version,
+    #   persons (CRIS Persons), conference (CRIS Conference)
+
+    def __init__(self, pubtype):
+        if pubtype not in pubtypes:
+            raise ValueError('Unsupported CrossRef publication type: ' + str(pubtype))
+        self.pubtype = pubtype
+        self.role = 'editor' if pubtype == 'proceeding' else 'author'
+        self.named_institutions = pubtype in named_institution_pubtypes
+        # Rendered (shared) <institution> elements by organisation Id
+        self.affiliations = {}
+
+        if pubtype == 'dissertation':
+            self.steps = [self.titles, self.abstract, self.approval_date, self.institution, self.degree,
+                          self.isbn, self.version_info, self.doi_data]
+        elif pubtype == 'book':
+            self.steps = [self.titles, self.abstract, self.degree, self.publication_date, self.isbn_or_noisbn,
+                          self.publisher, self.doi_data]
+        elif pubtype == 'preprint':
+            self.steps = [self.titles, self.posted_date, self.abstract, self.degree, self.isbn, self.version_info,
+                          self.doi_data]
+        elif pubtype == 'report':
+            self.steps = [self.titles, self.abstract, self.degree, self.publication_date, self.isbn, self.publisher,
+                          self.version_info, self.doi_data]
+        elif pubtype == 'proceeding':
+            self.steps = [self.proceedings_title, self.degree, self.publisher, self.publication_date,
+                          self.isbn_or_noisbn, self.doi_data]
+
+    def build(self, record):
+        # Element to append to the doi_batch body
+        lang = record.get('lang')
+        if self.pubtype == 'dissertation':
+            container = publication = _element(self.pubtype, publication_type="full_text", language=lang)
+            self.contributors(publication, record)
+        elif self.pubtype == 'book':
+            container = _element(self.pubtype, book_type="monograph")
+            publication = ET.SubElement(container, "book_metadata", language=lang)
+            self.contributors(publication, record)
+        elif self.pubtype == 'preprint':
+            container = publication = _element("posted_content", type=self.pubtype)
+            self.contributors(publication, record)
+        elif self.pubtype == 'report':
+            container = _element("report-paper")
+            publication = ET.SubElement(container, "report-paper_metadata", language=lang)
+            self.contributors(publication, record)
+        else:
+            container = _element("conference")
+            self.contributors(container, record)
+            self.event_metadata(container, record)
+            publication = ET.SubElement(container, "proceedings_metadata", language=lang)
+        for step in self.steps:
+            step(publication, record)
+        return container
+
+    # Steps
+
+    def contributors(self, parent, record):
+        contributors = ET.SubElement(parent, "contributors")
+        for seq, person in enumerate(record.get('persons') or []):
+            person_name = ET.SubElement(contributors, "person_name", contributor_role=self.role, sequence='first' if seq == 0 else 'additional')
+            _text_element(person_name, "given_name", person['PersonData']['FirstName'])
+            _text_element(person_name, "surname", person['PersonData']['LastName'])
+            affiliations = ET.SubElement(person_name, "affiliations")
+            for aff in person['Organizations']:
+                affiliations.append(self.affiliation(aff['OrganizationData']))
+            if len(person['PersonData'].get('IdentifierOrcid') or []) > 0:
+                _text_element(person_name, "ORCID", "https://orcid.org/" + str(person['PersonData']['IdentifierOrcid'][0]), authenticated="true")
+
+    def affiliation(self, org):
+        org_id = org.get('Id')
+        element = self.affiliations.get(org_id) if org_id is not None else None
+        if element is None:
+            element = self.render_institution(institution_of(org))
+            if org_id is not None:
+                self.affiliations[org_id] = element
+        return element
+
+    def render_institution(self, inst):
+        institution = _element("institution")
+        if inst.chalmers:
+            if self.named_institutions:
+                _text_element(institution, "institution_name", inst.name)
+            institution.append(chalmers_ror_element)
+        else:
+            _text_element(institution, "institution_name" if self.named_institutions else "institution_acronym", inst.name)
+        for ror in inst.ror_ids:
+            _text_element(institution, "institution_id", ror, type="ror")
+        _text_element(institution, "institution_place", inst.place)
+        return institution
+
+    def event_metadata(self, parent, record):
+        conference = record.get('conference')
+        if not conference:
+            return
+        event = ET.SubElement(parent, "event_metadata")
+        _text_element(event, "conference_name", conference['Name'])
+        if 'City' in conference and 'Country' in conference:
+            _text_element(event, "conference_location", str(conference['City']) + ', ' + str(conference['Country']['NameEng']))
+        if 'StartDate' in conference and 'EndDate' in conference:
+            startdate = str(conference['StartDate'])
+            enddate = str(conference['EndDate'])
+            ET.SubElement(event, "conference_date", start_month=startdate[5:7], start_year=startdate[0:4], start_day=startdate[8:10],
+                          end_month=enddate[5:7], end_year=enddate[0:4], end_day=enddate[8:10])
+
+    def titles(self, publication, record):
+        titles = ET.SubElement(publication, "titles")
+        _text_element(titles, "title", record.get('title'))
+
+    def proceedings_title(self, publication, record):
+        _text_element(publication, "proceedings_title", record.get('title'))
+
+    def abstract(self, publication, record):
+        if record.get('abstract'):
+            abstract = ET.SubElement(publication, jats_abstract)
+            _text_element(abstract, jats_p, record['abstract'])
+
+    def posted_date(self, publication, record):
+        posted_date = ET.SubElement(publication, "posted_date")
+        _text_element(posted_date, "year", record.get('year'))
+
+    def approval_date(self, publication, record):
+        disp_date = record.get('disp_date')
+        if disp_date:
+            approvaldate = ET.SubElement(publication, "approval_date")
+            _text_element(approvaldate, "month", disp_date[5:7])
+            _text_element(approvaldate, "day", disp_date[8:10])
+            _text_element(approvaldate, "year", disp_date[0:4])
+
+    def institution(self, publication, record):
+        institution_publ = ET.SubElement(publication, "institution")
+        institution_publ.append(chalmers_ror_element)
+        department = department_of(record.get('persons'))
+        if department.startswith('Chalmers'):
+            _text_element(institution_publ, "institution_department", department)
+
+    def degree(self, publication, record):
+        if record.get('degree'):
+            _text_element(publication, "degree", record['degree'])
+
+    def publication_date(self, publication, record):
+        pubdate = ET.SubElement(publication, "publication_date", media_type="online")
+        _text_element(pubdate, "year", record.get('year'))
+
+    def isbn(self, publication, record):
+        if record.get('isbn'):
+            _text_element(publication, "isbn", record['isbn'], media_type="print")
+
+    def isbn_or_noisbn(self, publication, record):
+        if record.get('isbn'):
+            _text_element(publication, "isbn", record['isbn'], media_type="print")
+        else:
+            publication.append(noisbn_element)
+
+    def publisher(self, publication, record):
+        publication.append(publisher_element)
+
+    def version_info(self, publication, record):
+        version = str(record.get('version') or '1')
+        element = _version_elements.get(version)
+        if element is None:
+            element = _element("version_info")
+            _text_element(element, "version", version)
+            _version_elements[version] = element
+        publication.append(element)
+
+    def doi_data(self, publication, record):
+        doi_data = ET.SubElement(publication, "doi_data")
+        _text_element(doi_data, "doi", record['doi'])
+        _text_element(doi_data, "resource", record['url'])
+
+
+# Record elements that differ between deposits of the same content, left out of content_hash
+volatile_tags = {'version_info'}
+
+
+def _canonical_parts(element, parts):
+    if element.tag in volatile_tags:
+        return
+    parts.append('<' + str(element.tag))
+    for name, value in sorted((str(name), value) for name, value in element.attrib.items()):
+        parts.append(' ' + name + '="' + value + '"')
+    parts.append('>' + (element.text or '').strip())
+    for child in element:
+        _canonical_parts(child, parts)
+    parts.append('</>' + (element.tail or '').strip())
+
+
+def content_hash(element):
+    # Hash of the CrossRef-relevant content of a record element, independent of how it is serialized:
+    # namespace-qualified tags, sorted attributes, texts without surrounding whitespace, volatile_tags left out.
+    # The doi_batch head (batch id, timestamp) is not part of a record.
+    parts = []
+    _canonical_parts(element, parts)
+    return hashlib.sha256('\x00'.join(parts).encode('utf-8')).hexdigest()
+
+
+def content_fields(element):
+    # Hash per part of a record element ({'titles': ..., 'contributors': ..., 'doi_data': ...}, the attributes
+    # of the record element as 'attributes'), to tell which parts changed between two deposits
+    parts = {'attributes': [' ' + str(name) + '="' + value + '"' for name, value in sorted(element.attrib.items())]}
+    for child in element:
+        if child.tag not in volatile_tags:
+            _canonical_parts(child, parts.setdefault(str(child.tag).split('}')[-1], []))
+    return {name: hashlib.sha256('\x00'.join(values).encode('utf-8')).hexdigest() for name, values in parts.items()}
+
+
+def changed_fields(old, new):
+    # Parts (see content_fields) that differ between two deposits
+    return sorted(name for name in set(old) | set(new) if old.get(name) != new.get(name))
+
+
+templates = {}
+
+
+def template_for(pubtype):
+    # Compiled template per CrossRef publication type (created on first use)
+    template = templates.get(pubtype)
+    if template is None:
+        template = templates[pubtype] = DepositTemplate(pubtype)
+    return template
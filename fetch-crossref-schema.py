@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import posixpath
+import sys
+from urllib.parse import urljoin, urlsplit
+import requests
+from lxml import etree
+from dotenv import load_dotenv
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import httpclient
+from crossref import DepositValidator
+
+# Script for copying the CrossRef deposit schema (crossref<version>.xsd and every file it includes and imports)
+# into the schemas directory, keeping the directory layout of https://gitlab.com/crossref/schema/-/tree/master/schemas,
+# so the DOI scripts can validate deposit files before they are posted (see schemas/README.md).
+
+# Use as (example): python3 fetch-crossref-schema.py
+#                   python3 fetch-crossref-schema.py --schema-version 5.4.0 --schema-dir schemas
+
+load_dotenv()
+xsd_ns = '{http://www.w3.org/2001/XMLSchema}'
+default_base_url = 'https://gitlab.com/crossref/schema/-/raw/master/schemas/'
+
+
+def schema_locations(xsd_bytes):
+    # schemaLocation of the xs:include / xs:import / xs:redefine elements of a schema file
+    root = etree.fromstring(xsd_bytes)
+    return [element.get('schemaLocation') for element in root.iter(xsd_ns + 'include', xsd_ns + 'import', xsd_ns + 'redefine')
+            if element.get('schemaLocation')]
+
+
+def fetch_schema(base_url, schema_dir, main_file, verbose=False):
+    # Download main_file and everything it refers to (relative locations only, absolute URLs are left to the XSD
+    # processor). Returns (files written, absolute locations that were not copied).
+    base_url = base_url.rstrip('/') + '/'
+    todo = [main_file]
+    done = set()
+    external = set()
+    while todo:
+        path = posixpath.normpath(todo.pop())
+        if path in done:
+            continue
+        if path.startswith('../'):
+            raise ValueError('Schema file outside of ' + base_url + ': ' + path)
+        done.add(path)
+        response = httpclient.get(urljoin(base_url, path))
+        response.raise_for_status()
+        target = os.path.join(str(schema_dir), *path.split('/'))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as xsd_file:
+            xsd_file.write(response.content)
+        if verbose:
+            print(path)
+        for location in schema_locations(response.content):
+            if urlsplit(location).scheme:
+                external.add(location)
+            else:
+                todo.append(posixpath.join(posixpath.dirname(path), location))
+    return sorted(done), sorted(external)
+
+
+parser = ArgumentParser(description='Copy the CrossRef deposit schema files into the schemas directory. \nUse as (example): python3 fetch-crossref-schema.py --schema-version 5.4.0',
+                        formatter_class=ArgumentDefaultsHelpFormatter)
+parser.add_argument("-v", "--verbose", action="store_true", help="increase verbosity")
+parser.add_argument("--schema-version", default=os.getenv("SCHEMA_VERSION") or "5.4.0", help="CrossRef schema version")
+parser.add_argument("--schema-dir", default=os.getenv("SCHEMA_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schemas'),
+                    help="Directory for the schema files")
+parser.add_argument("--base-url", default=os.getenv("CROSSREF_SCHEMA_URL") or default_base_url, help="Where the CrossRef schema files are downloaded from")
+args = parser.parse_args()
+
+validator = DepositValidator(args.schema_dir, args.schema_version)
+try:
+    files, external = fetch_schema(args.base_url, args.schema_dir, os.path.basename(validator.schema_file), args.verbose)
+except (requests.exceptions.RequestException, etree.XMLSyntaxError, ValueError) as e:
+    print('Could not copy the CrossRef schema: ' + str(e))
+    sys.exit(1)
+print(str(len(files)) + ' schema files written to ' + str(args.schema_dir))
+for location in external:
+    print('Refers to (not copied): ' + location)
+
+# The schema must compile, otherwise the DOI scripts could not validate anything
+try:
+    etree.XMLSchema(etree.parse(validator.schema_file))
+except (etree.XMLSchemaParseError, etree.XMLSyntaxError) as e:
+    print('The schema in ' + validator.schema_file + ' does not compile: ' + str(e))
+    sys.exit(1)
+print('Check the deposit files against it with: python3 benchmark.py validate --schema-dir ' + str(args.schema_dir))
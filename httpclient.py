@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+import datetime
+import email.utils
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+# Shared HTTP layer for CRIS, doi.org and CrossRef.
+# One pooled keep-alive session is kept per host, every request gets a (connect, read) timeout,
+# and per-host counters record request count, latency and how many new connections were opened.
+# Errors are requests that raised, or that ended with a 4xx/5xx answer (429/503 after the last retry included,
+# and also the doi.org 404 for a DOI that does not exist yet).
+#
+# Settings (environment / .env):
+# HTTP_CONNECT_TIMEOUT  seconds to wait for a connection (default 5)
+# HTTP_READ_TIMEOUT     seconds to wait for a response (default 60)
+# HTTP_POOL_SIZE        max keep-alive connections per host (default 10)
+# HTTP_GZIP             ask for gzip/deflate compressed responses (default true)
+# HTTP_MAX_RETRIES      retries after a 429/503 answer (default 3)
+# HTTP_BACKOFF          first backoff in seconds when no Retry-After is given, doubled per retry (default 2)
+#
+# Requests per host are throttled by a token bucket (see set_rate_limit). A 429/503 answer pauses
+# the whole host for Retry-After seconds (or the backoff), not just the request that got it.
+# When the host still answers 429/503 after the last retry, RetriesExhausted is raised (a requests.HTTPError,
+# so callers handle it like any other failed request, the last response is in e.response).
+
+_sessions = {}
+_stats = {}
+_buckets = {}
+_lock = threading.Lock()
+
+retry_statuses = [429, 503]
+
+
+class RetriesExhausted(requests.exceptions.HTTPError):
+    pass
+
+
+class TokenBucket:
+    # rate: requests per second (0 = unlimited), burst: how many requests may be sent at once
+
+    def __init__(self, rate=0, burst=None):
+        self.rate = float(rate or 0)
+        self.capacity = float(burst or max(self.rate, 1))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # Wait until a request may be sent
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.rate <= 0:
+                    return
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # Block all requests for a while (after 429/503)
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+def _settings():
+    return {
+        'timeout': (float(os.getenv('HTTP_CONNECT_TIMEOUT') or 5), float(os.getenv('HTTP_READ_TIMEOUT') or 60)),
+        'pool_size': int(os.getenv('HTTP_POOL_SIZE') or 10),
+        'gzip': str(os.getenv('HTTP_GZIP') or 'true').lower() in ['true', 'yes', 'y', '1'],
+        'max_retries': int(os.getenv('HTTP_MAX_RETRIES') or 3),
+        'backoff': float(os.getenv('HTTP_BACKOFF') or 2),
+    }
+
+
+def _host(url):
+    parts = urlsplit(str(url))
+    return parts.scheme + '://' + parts.netloc
+
+
+def set_rate_limit(url, rate, burst=None):
+    # Limit requests to the host of url to rate per second (0 or empty = unlimited)
+    with _lock:
+        _buckets[_host(url)] = TokenBucket(float(rate or 0), burst)
+
+
+def _bucket(host):
+    with _lock:
+        bucket = _buckets.get(host)
+        if bucket is None:
+            bucket = _buckets[host] = TokenBucket()
+    return bucket
+
+
+def _retry_after(response, default):
+    # Seconds to wait according to the Retry-After header (seconds or HTTP date)
+    value = response.headers.get('Retry-After')
+    if not value:
+        return default
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_date = email.utils.parsedate_to_datetime(value)
+        return max((retry_date - datetime.datetime.now(retry_date.tzinfo)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+
+def _rewind(kwargs):
+    # Make file uploads readable again before a retry
+    for value in (kwargs.get('files') or {}).values():
+        fileobj = value[1] if isinstance(value, tuple) else value
+        if hasattr(fileobj, 'seek'):
+            fileobj.seek(0)
+
+
+def session_for(url):
+    # Pooled session for the host of url (created on first use)
+    host = _host(url)
+    with _lock:
+        session = _sessions.get(host)
+        if session is None:
+            settings = _settings()
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings['pool_size'])
+            session.mount(host, adapter)
+            session.headers['Accept-Encoding'] = 'gzip, deflate' if settings['gzip'] else 'identity'
+            _sessions[host] = session
+            _stats[host] = {'requests': 0, 'errors': 0, 'error_statuses': 0, 'seconds': 0.0, 'new_connections': 0, 'new_connection_seconds': 0.0}
+    return session
+
+
+def _connection_count(session, url):
+    # Number of connections opened so far by the pools serving url (approximate under concurrency)
+    pools = session.get_adapter(url).poolmanager.pools
+    count = 0
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is not None:
+            count += pool.num_connections
+    return count
+
+
+def request(method, url, **kwargs):
+    settings = _settings()
+    bucket = _bucket(_host(url))
+    backoff = settings['backoff']
+    for attempt in range(settings['max_retries'] + 1):
+        bucket.acquire()
+        response = _send(method, url, settings, **kwargs)
+        if response.status_code not in retry_statuses:
+            if not response.ok:
+                _count_error_status(url)
+            return response
+        if attempt == settings['max_retries']:
+            _count_error_status(url)
+            raise RetriesExhausted('HTTP ' + str(response.status_code) + ' from ' + _host(url) + ' after ' + str(attempt + 1) + ' attempts',
+                                   response=response)
+        wait = _retry_after(response, backoff)
+        print('HTTP ' + str(response.status_code) + ' from ' + _host(url) + ', retrying in ' + '{:.1f}'.format(wait) + ' s')
+        bucket.pause(wait)
+        backoff *= 2
+        _rewind(kwargs)
+
+
+def _count_error_status(url):
+    # A request that ended with an error answer (4xx/5xx, also 429/503 after the last retry) counts as an error
+    with _lock:
+        stats = _stats[_host(url)]
+        stats['errors'] += 1
+        stats['error_statuses'] += 1
+
+
+def _send(method, url, settings, **kwargs):
+    session = session_for(url)
+    host = _host(url)
+    kwargs.setdefault('timeout', settings['timeout'])
+    opened = _connection_count(session, url)
+    start = time.perf_counter()
+    try:
+        with metrics.timed('http_request', host=host, method=method) as timer:
+            response = session.request(method, url, **kwargs)
+            timer.status = str(response.status_code)
+    except requests.exceptions.RequestException:
+        with _lock:
+            _stats[host]['errors'] += 1
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        new_connection = _connection_count(session, url) > opened
+        with _lock:
+            stats = _stats[host]
+            stats['requests'] += 1
+            stats['seconds'] += elapsed
+            if new_connection:
+                stats['new_connections'] += 1
+                stats['new_connection_seconds'] += elapsed
+    return response
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def head(url, **kwargs):
+    return request('HEAD', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request('PUT', url, **kwargs)
+
+
+def stats():
+    # Copy of the per-host counters
+    with _lock:
+        return {host: dict(values) for host, values in _stats.items()}
+
+
+def summary():
+    # One line per host. Connection setup cost is estimated as the extra time spent by requests
+    # that had to open a new connection compared to requests on a reused one.
+    lines = []
+    for host, s in sorted(stats().items()):
+        reused = s['requests'] - s['new_connections']
+        avg_new = s['new_connection_seconds'] / s['new_connections'] if s['new_connections'] else 0.0
+        avg_reused = (s['seconds'] - s['new_connection_seconds']) / reused if reused else 0.0
+        setup = max(avg_new - avg_reused, 0.0) * s['new_connections'] if reused else 0.0
+        errors = str(s['errors']) + ' errors' + (', ' + str(s['error_statuses']) + ' with an error status' if s['error_statuses'] else '')
+        lines.append(host + ': ' + str(s['requests']) + ' requests (' + errors + '), '
+                     + '{:.2f}'.format(s['seconds']) + ' s total, ' + str(s['new_connections']) + ' new connections, '
+                     + 'approx. ' + '{:.2f}'.format(setup) + ' s connection setup')
+    return lines
+
+
+def log_summary(log):
+    # Print the summary and write it to the run log (used at exit by the scripts)
+    for line in summary():
+        print('HTTP ' + line)
+        log.event('HTTP ' + line, stage='http')
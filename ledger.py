@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+import csv
+import datetime
+import json
+import os
+import sqlite3
+import threading
+import time
+import locking
+
+# Ledger of deposited (CRIS pubid, DOI) pairs, kept in an embedded SQLite database.
+# Lookups use the primary key index, so the cost per publication no longer grows with the
+# size of the ledger. The tab-separated PUBIDFILE is still imported on open and appended to
+# on every new deposit, so existing readers of that file keep working.
+#
+# Deposits also carry the CrossRef submission (doi_batch_id) they were sent in and their
+# registration status: submitted -> registered / failed (with the CrossRef message), or unknown when the
+# submission tracker gave up waiting for the result.
+# content_hash is the hash of the deposited record (see deposit.content_hash), registered_hash the
+# hash of the last deposit CrossRef registered, so unchanged records are not deposited again.
+# fields (JSON, see deposit.content_fields) and version (version_info) describe the latest deposit,
+# so a metadata update can tell what changed and which version comes next.
+#
+# Several processes may use the same ledger at once (overlapping runs, workers, backfill shards). SQLite
+# serialises the writes (WAL journal, writers wait up to timeout seconds for each other) and the PUBIDFILE
+# is read and appended to under a file lock. Before a process decides on depositing a DOI it claims it
+# (claims table): only one process at a time can hold the claim, so two processes never both see the DOI
+# as new and deposit it twice. Claims are released when the ledger is closed; a claim of a process that
+# died is taken over, any other claim after claim_ttl seconds.
+
+schema = '''
+CREATE TABLE IF NOT EXISTS deposits (
+    pubid TEXT NOT NULL,
+    doi TEXT NOT NULL,
+    created TEXT,
+    PRIMARY KEY (pubid, doi)
+);
+CREATE INDEX IF NOT EXISTS deposits_doi ON deposits (doi);
+CREATE TABLE IF NOT EXISTS submissions (
+    batch_id TEXT PRIMARY KEY,
+    submitted TEXT,
+    status TEXT NOT NULL DEFAULT 'submitted',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_poll REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS submissions_pending ON submissions (status, next_poll);
+CREATE TABLE IF NOT EXISTS claims (
+    doi TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    claimed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS claims_owner ON claims (owner);
+'''
+
+# Columns added to deposits after the first version of the ledger
+deposit_columns = [('batch_id', 'TEXT'), ('status', 'TEXT'), ('message', 'TEXT'), ('updated', 'TEXT'),
+                   ('content_hash', 'TEXT'), ('registered_hash', 'TEXT'), ('fields', 'TEXT'), ('version', 'INTEGER')]
+
+
+def _now():
+    return datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+
+
+class DepositLedger:
+
+    def __init__(self, db_file, pidfile=None, timeout=60, owner=None, claim_ttl=3600):
+        self.db_file = db_file
+        self.pidfile = pidfile
+        self.owner = owner or locking.process_owner()
+        self.claim_ttl = float(claim_ttl)
+        # The connection is shared with the submission tracker thread, all access goes through self.lock
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_file, timeout=float(timeout), check_same_thread=False)
+        # Creating and upgrading the tables is done by one process at a time
+        with locking.locked(db_file):
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.executescript(schema)
+            existing = [row[1] for row in self.conn.execute('PRAGMA table_info(deposits)')]
+            for column, column_type in deposit_columns:
+                if column not in existing:
+                    self.conn.execute('ALTER TABLE deposits ADD COLUMN ' + column + ' ' + column_type)
+            self.conn.execute('CREATE INDEX IF NOT EXISTS deposits_batch ON deposits (batch_id)')
+            self.conn.commit()
+        if pidfile and os.path.exists(pidfile):
+            self.import_tsv(pidfile)
+
+    def import_tsv(self, pidfile):
+        # Import an existing tab-separated ledger (pubid<TAB>doi per row), skipping known pairs
+        with locking.locked(pidfile), open(pidfile, mode='r') as infile:
+            rows = [(row[0], row[1]) for row in csv.reader(infile, dialect='excel-tab') if len(row) > 1]
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO deposits (pubid, doi) VALUES (?, ?)', rows)
+
+    def claim(self, doi):
+        # True if this process may go on with the DOI (check and deposit it), False while another process holds it
+        now = time.time()
+        with self.lock, self.conn:
+            cur = self.conn.execute('INSERT INTO claims (doi, owner, claimed) VALUES (?, ?, ?) '
+                                    'ON CONFLICT (doi) DO UPDATE SET owner = excluded.owner, claimed = excluded.claimed '
+                                    'WHERE claims.owner = excluded.owner OR claims.claimed < ?',
+                                    (str(doi), self.owner, now, now - self.claim_ttl))
+            if cur.rowcount > 0:
+                return True
+            row = self.conn.execute('SELECT owner FROM claims WHERE doi = ?', (str(doi),)).fetchone()
+            if row is None or locking.owner_alive(row[0]):
+                return False
+            # The process holding the claim has died
+            cur = self.conn.execute('UPDATE claims SET owner = ?, claimed = ? WHERE doi = ? AND owner = ?', (self.owner, now, str(doi), row[0]))
+            return cur.rowcount > 0
+
+    def release_claims(self):
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM claims WHERE owner = ?', (self.owner,))
+
+    def contains(self, pubid, doi):
+        with self.lock:
+            cur = self.conn.execute('SELECT 1 FROM deposits WHERE pubid = ? AND doi = ?', (str(pubid), str(doi)))
+            return cur.fetchone() is not None
+
+    def record(self, pubid, doi, batch_id=None, content_hash=None, fields=None, version=None):
+        # Add a new deposit. The database insert is committed before the PUBIDFILE line is written.
+        # A known pair that is deposited again is moved to the new submission.
+        status = 'submitted' if batch_id else None
+        fields = json.dumps(fields, sort_keys=True) if fields is not None else None
+        with self.lock:
+            with self.conn:
+                cur = self.conn.execute('INSERT OR IGNORE INTO deposits (pubid, doi, created, batch_id, status, updated, content_hash, fields, version) '
+                                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                        (str(pubid), str(doi), _now(), batch_id, status, _now(), content_hash, fields, version))
+                added = cur.rowcount
+                if not added and batch_id:
+                    self.conn.execute('UPDATE deposits SET batch_id = ?, status = ?, message = NULL, updated = ?, content_hash = ?, fields = ?, version = ? '
+                                      'WHERE pubid = ? AND doi = ?',
+                                      (batch_id, status, _now(), content_hash, fields, version, str(pubid), str(doi)))
+        if added and self.pidfile:
+            with locking.locked(self.pidfile), open(self.pidfile, 'a') as pfile:
+                pfile.write(str(pubid) + '\t' + str(doi) + '\n')
+
+    def status(self, doi):
+        # (status, message) of the latest deposit of a DOI, or None
+        with self.lock:
+            return self.conn.execute('SELECT status, message FROM deposits WHERE doi = ? ORDER BY updated DESC LIMIT 1', (str(doi),)).fetchone()
+
+    def deposit_hashes(self, doi):
+        # Content hashes that count as deposited for a DOI: of the latest deposit if CrossRef registered it or
+        # is still processing it (its submission is still being followed up), and of the last deposit CrossRef
+        # registered. A deposit whose submission was given up on or completed without it does not count.
+        with self.lock:
+            rows = self.conn.execute('SELECT d.content_hash, d.status, d.registered_hash, s.status FROM deposits d '
+                                     'LEFT JOIN submissions s ON s.batch_id = d.batch_id WHERE d.doi = ?', (str(doi),)).fetchall()
+        hashes = set()
+        for content_hash, status, registered_hash, submission_status in rows:
+            if content_hash and (status == 'registered' or (status == 'submitted' and submission_status == 'submitted')):
+                hashes.add(content_hash)
+            if registered_hash:
+                hashes.add(registered_hash)
+        return hashes
+
+    def last_deposit(self, doi):
+        # (fields, version, status) of the latest deposit of a DOI that has them, or None
+        with self.lock:
+            row = self.conn.execute('SELECT fields, version, status FROM deposits WHERE doi = ? AND fields IS NOT NULL ORDER BY updated DESC LIMIT 1',
+                                    (str(doi),)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1], row[2]
+
+    def registered(self, doi):
+        # True if CrossRef has registered a deposit of the DOI that has a content hash
+        with self.lock:
+            return self.conn.execute('SELECT 1 FROM deposits WHERE doi = ? AND registered_hash IS NOT NULL LIMIT 1', (str(doi),)).fetchone() is not None
+
+    def add_submission(self, batch_id, next_poll):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO submissions (batch_id, submitted, status, attempts, next_poll) VALUES (?, ?, ?, 0, ?)',
+                              (batch_id, _now(), 'submitted', next_poll))
+
+    def due_submissions(self, now, limit=100):
+        # Submissions still waiting for a CrossRef result that should be polled now: [(batch_id, attempts)]
+        with self.lock:
+            return self.conn.execute("SELECT batch_id, attempts FROM submissions WHERE status = 'submitted' AND next_poll <= ? ORDER BY next_poll LIMIT ?",
+                                     (now, limit)).fetchall()
+
+    def pending_submissions(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM submissions WHERE status = 'submitted'").fetchone()[0]
+
+    def next_submission_poll(self):
+        # Earliest next_poll of the pending submissions (None if nothing is pending)
+        with self.lock:
+            return self.conn.execute("SELECT MIN(next_poll) FROM submissions WHERE status = 'submitted'").fetchone()[0]
+
+    def reschedule_submission(self, batch_id, attempts, next_poll, status='submitted'):
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE submissions SET attempts = ?, next_poll = ?, status = ? WHERE batch_id = ?',
+                              (attempts, next_poll, status, batch_id))
+
+    def complete_submission(self, batch_id, results):
+        # Store the CrossRef result of a submission. results: {doi: (registered/failed, message)}
+        with self.lock, self.conn:
+            self.conn.executemany('UPDATE deposits SET status = ?, message = ?, updated = ?, '
+                                  "registered_hash = CASE WHEN ? = 'registered' THEN content_hash ELSE registered_hash END "
+                                  'WHERE doi = ? AND batch_id = ?',
+                                  [(status, message, _now(), status, doi, batch_id) for doi, (status, message) in results.items()])
+            self.conn.execute("UPDATE submissions SET status = 'completed' WHERE batch_id = ?", (batch_id,))
+
+    def abandon_submission(self, batch_id, attempts, message):
+        # No CrossRef result for a submission after the last status check: its deposits that are still waiting
+        # become 'unknown', so they no longer count as deposited and are sent again by the next run
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE deposits SET status = 'unknown', message = ?, updated = ? WHERE batch_id = ? AND status = 'submitted'",
+                              (message, _now(), batch_id))
+            self.conn.execute("UPDATE submissions SET attempts = ?, next_poll = 0, status = 'unknown' WHERE batch_id = ?", (attempts, batch_id))
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM deposits').fetchone()[0]
+
+    def close(self):
+        self.release_claims()
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import socket
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory file locks on this platform (Windows): the files are used without locks, run one process at a time
+    fcntl = None
+
+# Coordination of DOI script processes on one host (overlapping cron runs, worker processes, backfill shards).
+# Files shared between the processes are guarded by advisory locks (flock):
+#   locked(path)         exclusive lock on <path>.lock, waits until it is free (e.g. the RUNTIME watermark, ledger migrations)
+#   try_lock(path)       the same without waiting, None if another process holds it (one run per RUNTIME file)
+#   append_lines(path)   appends under a lock on the file itself, so lines of different processes never interleave
+# The locks are released by the OS when a process dies, so a crashed run never leaves a stale lock behind.
+
+
+@contextmanager
+def locked(path):
+    with open(str(path) + '.lock', 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def try_lock(path):
+    # Open file holding the lock on <path>.lock (keep it open for as long as the lock is needed), or None if it is taken
+    lock_file = open(str(path) + '.lock', 'a')
+    if fcntl is not None:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+    return lock_file
+
+
+def append_lines(path, lines):
+    with open(path, 'a') as out_file:
+        if fcntl is not None:
+            fcntl.flock(out_file.fileno(), fcntl.LOCK_EX)
+        try:
+            out_file.writelines(lines)
+            out_file.flush()
+        finally:
+            if fcntl is not None:
+                fcntl.flock(out_file.fileno(), fcntl.LOCK_UN)
+
+
+def process_owner(run_id=''):
+    # Owner name of claims made by this process: host:pid:run
+    return socket.gethostname() + ':' + str(os.getpid()) + ':' + str(run_id)
+
+
+def owner_alive(owner):
+    # False only if the owner is a process on this host that no longer runs
+    parts = str(owner).split(':')
+    if len(parts) < 2 or parts[0] != socket.gethostname() or not parts[1].isdigit():
+        return True
+    try:
+        os.kill(int(parts[1]), 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def worker_of(key, workers):
+    # Worker (0 .. workers - 1) of a key (CRIS pubid), the same in every process and run
+    return int(hashlib.sha1(str(key).encode('utf-8')).hexdigest()[:8], 16) % max(int(workers), 1)
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+import atexit
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+# Run metrics of the DOI scripts: counters, latency histograms and in-flight gauges.
+# Stages are timed with
+#   with metrics.timed('stage', stage='deposit') as t:
+#       ...
+#       t.status = 'failed'      (optional, default ok / error on exception)
+# which observes the duration in the histogram <name>_seconds, counts the call in <name>_total by status
+# and keeps the number of calls in progress in the gauge <name>_in_flight (and its maximum in <name>_in_flight_max).
+#
+# Settings (environment / .env):
+# METRICS_FILE    written when the script exits: *.prom = Prometheus textfile (node_exporter textfile collector),
+#                 anything else = JSON summary (default: no file)
+# METRICS_PREFIX  prefix of the Prometheus metric names (default research2crossref)
+# PROFILE_FILE    run the script under cProfile and write the stats (pstats format) to this file,
+#                 look at them with: python3 -m pstats <file>
+
+buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_gauges = {}
+_labels = {}
+_profiles = []
+_started = time.time()
+
+
+def _key(name, labels):
+    return (name, tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None)))
+
+
+def count(name, n=1, **labels):
+    key = _key(name + '_total', labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + n
+
+
+def observe(name, seconds, **labels):
+    key = _key(name + '_seconds', labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {'buckets': [0] * len(buckets), 'count': 0, 'sum': 0.0, 'max': 0.0}
+        for i, bound in enumerate(buckets):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+        histogram['count'] += 1
+        histogram['sum'] += seconds
+        histogram['max'] = max(histogram['max'], seconds)
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def _in_flight(name, delta, labels):
+    key = _key(name + '_in_flight', labels)
+    max_key = _key(name + '_in_flight_max', labels)
+    with _lock:
+        value = _gauges[key] = _gauges.get(key, 0) + delta
+        _gauges[max_key] = max(_gauges.get(max_key, 0), value)
+
+
+class _Timer:
+
+    def __init__(self):
+        self.status = None
+
+
+@contextmanager
+def timed(name, **labels):
+    timer = _Timer()
+    _in_flight(name, 1, labels)
+    start = time.perf_counter()
+    try:
+        yield timer
+    except BaseException:
+        timer.status = timer.status or 'error'
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        _in_flight(name, -1, labels)
+        observe(name, elapsed, **labels)
+        count(name, status=timer.status or 'ok', **labels)
+
+
+def snapshot():
+    # Copy of all metrics: {'counters': [...], 'histograms': [...], 'gauges': [...]}, one entry per series
+    with _lock:
+        return {
+            'labels': dict(_labels),
+            'counters': [dict(name=name, labels=dict(labels), value=value) for (name, labels), value in sorted(_counters.items())],
+            'histograms': [dict(name=name, labels=dict(labels), count=h['count'], sum=h['sum'], max=h['max'],
+                                buckets=dict(zip([str(bound) for bound in buckets], h['buckets'])))
+                           for (name, labels), h in sorted(_histograms.items())],
+            'gauges': [dict(name=name, labels=dict(labels), value=value) for (name, labels), value in sorted(_gauges.items())],
+        }
+
+
+def _series(prefix, name, labels, extra=None):
+    labels = dict(_labels, **labels)
+    if extra:
+        labels.update(extra)
+    text = ','.join(key + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+                    for key, value in sorted(labels.items()))
+    return prefix + name + ('{' + text + '}' if text else '')
+
+
+def prometheus_text(prefix=None):
+    # All metrics in the Prometheus text exposition format
+    prefix = (prefix if prefix is not None else os.getenv('METRICS_PREFIX') or 'research2crossref') + '_'
+    data = snapshot()
+    lines = []
+    typed = set()
+
+    def declare(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append('# TYPE ' + prefix + name + ' ' + kind)
+
+    for entry in data['counters']:
+        declare(entry['name'], 'counter')
+        lines.append(_series(prefix, entry['name'], entry['labels']) + ' ' + str(entry['value']))
+    for entry in data['histograms']:
+        declare(entry['name'], 'histogram')
+        for bound, value in entry['buckets'].items():
+            lines.append(_series(prefix, entry['name'] + '_bucket', entry['labels'], {'le': bound}) + ' ' + str(value))
+        lines.append(_series(prefix, entry['name'] + '_bucket', entry['labels'], {'le': '+Inf'}) + ' ' + str(entry['count']))
+        lines.append(_series(prefix, entry['name'] + '_sum', entry['labels']) + ' ' + repr(entry['sum']))
+        lines.append(_series(prefix, entry['name'] + '_count', entry['labels']) + ' ' + str(entry['count']))
+    for entry in data['gauges']:
+        declare(entry['name'], 'gauge')
+        lines.append(_series(prefix, entry['name'], entry['labels']) + ' ' + repr(entry['value']))
+    return '\n'.join(lines) + '\n'
+
+
+def write(path):
+    # Write the metrics to path (Prometheus textfile for *.prom, else JSON), replacing the file in one step
+    # so a collector never reads half a file
+    set_gauge('run_duration_seconds', time.time() - _started)
+    set_gauge('run_end_timestamp_seconds', time.time())
+    if path.endswith('.prom'):
+        content = prometheus_text()
+    else:
+        content = json.dumps(snapshot(), indent=2)
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'w') as mfile:
+        mfile.write(content)
+    os.replace(tmp_file, path)
+
+
+def summary():
+    # One line per timed stage: calls by status, total and slowest time
+    lines = []
+    data = snapshot()
+    totals = {}
+    for entry in data['counters']:
+        if entry['name'] == 'stage_total':
+            stage = entry['labels'].get('stage')
+            totals.setdefault(stage, {})[entry['labels'].get('status')] = entry['value']
+    for entry in data['histograms']:
+        if entry['name'] == 'stage_seconds':
+            stage = entry['labels'].get('stage')
+            statuses = ', '.join(status + ': ' + str(value) for status, value in sorted(totals.get(stage, {}).items()))
+            lines.append(stage + ': ' + str(entry['count']) + ' (' + statuses + '), ' + '{:.2f}'.format(entry['sum']) + ' s total, '
+                         + '{:.2f}'.format(entry['max']) + ' s max')
+    return lines
+
+
+def profiled(func):
+    # func for a worker thread, run under its own profiler when PROFILE_FILE is set (cProfile only sees one thread)
+    if not os.getenv('PROFILE_FILE'):
+        return func
+
+    def run(*args, **kwargs):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already active in this thread / interpreter
+            return func(*args, **kwargs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            with _lock:
+                _profiles.append(profile)
+
+    return run
+
+
+def _write_profile(path):
+    with _lock:
+        profiles = list(_profiles)
+    for profile in profiles:
+        profile.disable()
+    if profiles:
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
+
+
+def _finish(log):
+    metrics_file = os.getenv('METRICS_FILE')
+    profile_file = os.getenv('PROFILE_FILE')
+    for line in summary():
+        print('Stage ' + line)
+        if log is not None:
+            log.event('Stage ' + line, stage='metrics')
+    if metrics_file:
+        write(metrics_file)
+        if log is not None:
+            log.event('Metrics written to ' + metrics_file, stage='metrics')
+    if profile_file:
+        _write_profile(profile_file)
+        if log is not None:
+            log.event('Profile written to ' + profile_file, stage='metrics')
+
+
+def setup(script, log=None):
+    # Label all metrics with the script name, start the profiler of the main thread (PROFILE_FILE) and
+    # write the stage summary (to the run log), METRICS_FILE and PROFILE_FILE when the script exits
+    global _started
+    _started = time.time()
+    with _lock:
+        _labels['script'] = script
+    set_gauge('run_start_timestamp_seconds', _started)
+    if os.getenv('PROFILE_FILE'):
+        profile = cProfile.Profile()
+        profile.enable()
+        with _lock:
+            _profiles.append(profile)
+    atexit.register(_finish, log)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import queue
+import threading
+
+import metrics
+
+# Thread pipeline for the batch script: records flow through a list of stages (e.g. build -> pack ->
+# deposit -> CRIS update). Every stage has its own worker threads and reads from a bounded queue, so a
+# slow stage makes the stages before it wait (put blocks) instead of piling up records in memory.
+#
+# A stage function gets one item and returns the items for the next stage (an iterable, or None for
+# nothing). An item only reaches a stage after the previous stage has finished with it, so work that
+# depends on an earlier step (e.g. the CRIS update after a successful deposit) just goes in a later stage.
+# A failing item is reported to on_error and dropped, the workers keep going.
+# Every item is timed per stage (metrics pipeline_seconds / pipeline_in_flight, label stage).
+
+_end = object()
+
+
+class Stage:
+
+    def __init__(self, name, func, workers=1, queue_size=100, finish=None):
+        self.name = name
+        self.func = func
+        self.workers = max(int(workers), 1)
+        self.queue = queue.Queue(maxsize=max(int(queue_size), 1))
+        # finish: optional callable, run once when all input has been handled, returns the last items
+        self.finish = finish
+        self.threads = []
+
+
+class Pipeline:
+
+    def __init__(self, queue_size=100, on_error=None):
+        self.queue_size = queue_size
+        self.on_error = on_error
+        self.stages = []
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def add_stage(self, name, func, workers=1, finish=None):
+        self.stages.append(Stage(name, func, workers, self.queue_size, finish))
+        return self
+
+    def start(self):
+        for index, stage in enumerate(self.stages):
+            for n in range(stage.workers):
+                thread = threading.Thread(target=metrics.profiled(self._work), args=(index,), name=stage.name + '-' + str(n), daemon=True)
+                thread.start()
+                stage.threads.append(thread)
+
+    def put(self, item):
+        # Feed an item to the first stage (blocks while its queue is full)
+        self.stages[0].queue.put(item)
+
+    def close(self):
+        # No more input: let every stage finish its queue (in order) and wait for the workers
+        for index, stage in enumerate(self.stages):
+            for thread in stage.threads:
+                stage.queue.put(_end)
+            for thread in stage.threads:
+                thread.join()
+            if stage.finish is not None:
+                self._forward(index, self._call(stage, stage.finish))
+
+    def _work(self, index):
+        stage = self.stages[index]
+        while True:
+            item = stage.queue.get()
+            if item is _end:
+                return
+            self._forward(index, self._call(stage, stage.func, item))
+
+    def _call(self, stage, func, *item):
+        try:
+            with metrics.timed('pipeline', stage=stage.name):
+                return func(*item)
+        except Exception as e:
+            with self.lock:
+                self.errors += 1
+            if self.on_error is not None:
+                self.on_error(stage.name, item[0] if item else None, e)
+            return None
+
+    def _forward(self, index, items):
+        if items is None or index + 1 >= len(self.stages):
+            return
+        next_queue = self.stages[index + 1].queue
+        for item in items:
+            next_queue.put(item)
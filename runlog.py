@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import atexit
+import datetime
+import json
+import os
+import threading
+import time
+import uuid
+
+import locking
+import metrics
+
+# Run log (LOGFILE) of the DOI scripts.
+# Log events are kept in memory and appended to the log file in one write when LOG_BUFFER_LINES
+# events are waiting, when LOG_FLUSH_INTERVAL seconds have passed since the last write, and when the
+# script exits, instead of opening the file for every line. With LOG_BACKGROUND=true a background
+# thread also writes waiting events on the interval, so a slow run still shows up in the log.
+#
+# LOG_FORMAT=text (default) writes the same lines as before: timestamp (%Y%m%d%H%M%S)<TAB>message
+# LOG_FORMAT=json writes one JSON object per line with the fields
+#   time, run, stage, status, pubid, doi, duration (s), message (fields without a value are left out)
+# Events with a stage and status are also counted in the metrics (events_total, see metrics.py).
+# Each write holds a lock on the log file, so runs that share LOGFILE do not mix up each other's lines.
+
+formats = ['text', 'json']
+
+
+class RunLog:
+
+    def __init__(self, logfile, fmt='text', buffer_lines=100, flush_interval=5, background=False, run_id=None):
+        if fmt not in formats:
+            raise ValueError('Unsupported log format: ' + str(fmt))
+        self.logfile = logfile
+        self.fmt = fmt
+        self.buffer_lines = max(int(buffer_lines), 1)
+        self.flush_interval = float(flush_interval)
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+        self.lock = threading.Lock()
+        self.lines = []
+        self.last_flush = time.monotonic()
+        self.closed = threading.Event()
+        self.thread = None
+        if background and self.flush_interval > 0:
+            self.thread = threading.Thread(target=self._run, name='runlog', daemon=True)
+            self.thread.start()
+
+    def event(self, message, stage=None, status=None, pubid=None, doi=None, duration=None, **fields):
+        now = datetime.datetime.now()
+        if stage is not None and status is not None:
+            metrics.count('events', stage=stage, status=status)
+        if self.fmt == 'text':
+            line = now.strftime("%Y%m%d%H%M%S") + '\t' + message
+        else:
+            record = {'time': now.isoformat(timespec='seconds'), 'run': self.run_id, 'stage': stage, 'status': status,
+                      'pubid': pubid, 'doi': doi, 'duration': round(duration, 3) if duration is not None else None}
+            record.update(fields)
+            record['message'] = message
+            line = json.dumps({key: value for key, value in record.items() if value is not None}, ensure_ascii=False)
+        with self.lock:
+            self.lines.append(line + '\n')
+            due = len(self.lines) >= self.buffer_lines or time.monotonic() - self.last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            lines, self.lines = self.lines, []
+            self.last_flush = time.monotonic()
+            if lines and self.logfile:
+                locking.append_lines(self.logfile, lines)
+
+    def _run(self):
+        while not self.closed.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self.closed.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+
+
+def open_runlog(logfile):
+    # RunLog configured from the environment, everything still waiting is written when the script exits
+    log = RunLog(logfile,
+                 fmt=os.getenv("LOG_FORMAT") or 'text',
+                 buffer_lines=os.getenv("LOG_BUFFER_LINES") or 100,
+                 flush_interval=os.getenv("LOG_FLUSH_INTERVAL") or 5,
+                 background=str(os.getenv("LOG_BACKGROUND")).lower() == 'true')
+    atexit.register(log.close)
+    return log
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import gzip
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+import xml.etree.ElementTree as ET
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+
+# Local stand-in for the services used by the DOI scripts, for reproducible (offline) runs:
+#
+#   CRIS      GET  /cris/publications/?query=...&start=&max=&selectedFields=   search (Id:"..." terms and
+#                                                                              LatestEventDate:[... TO *] are applied)
+#             GET  /cris/publications/<id>, PUT /cris/publications/<id>        record (ETag / If-Match supported)
+#   CrossRef  POST /crossref/servlet/deposit                                   doMDUpload
+#             GET  /crossref/servlet/submissionDownload?doi_batch_id=...       submission result
+#   doi.org   HEAD /doi/<doi>                                                  302 if registered, else 404
+#             GET  /stats                                                      request and deposit counters
+#
+# Point the scripts at it with (port 8080):
+#   CRIS_API_EP=http://127.0.0.1:8080/cris/publications/
+#   CROSSREF_API_EP=http://127.0.0.1:8080/crossref/servlet/deposit
+#   DOI_RESOLVER=http://127.0.0.1:8080/doi/
+#
+# Publications are synthetic (--records, --seed) or recorded (--corpus: a saved CRIS search response or
+# JSON lines with one publication per line). Latency and error rates are set per service; with the same
+# seed and settings a run gets the same answers.
+# Use as (example): python3 standin.py --records 500 --deposit-latency 0.3 --deposit-error-rate 0.05
+
+first_names = ['Anna', 'Erik', 'Maria', 'Lars', 'Karin', 'Johan', 'Sara', 'Anders', 'Li', 'Ahmed']
+last_names = ['Andersson', 'Johansson', 'Karlsson', 'Nilsson', 'Eriksson', 'Larsson', 'Olsson', 'Persson', 'Zhang', 'Hassan']
+departments = ['Architecture and Civil Engineering', 'Chemistry and Chemical Engineering', 'Computer Science and Engineering',
+               'Electrical Engineering', 'Industrial and Materials Science', 'Life Sciences', 'Mechanics and Maritime Sciences',
+               'Physics', 'Space, Earth and Environment', 'Technology Management and Economics']
+
+
+cris_pubtypes = ['Doctoral thesis', 'Licentiate thesis', 'Book', 'Report', 'Paper in proceeding', 'Preprint']
+
+
+def synthetic_publications(count, seed=1, doi_prefix='10.63959', authors=(1, 6), affiliations=1, paragraphs=(5, 30), mixed=False):
+    # Publications shaped like CRIS search results (Id, DOI, ISBN, persons with organisations, ...):
+    # authors = (min, max) persons, up to affiliations organisations per person, paragraphs = (min, max)
+    # sentences of abstract, mixed = also other publication types than doctoral theses
+    rng = random.Random(seed)
+    ids = [str(uuid.UUID(int=rng.getrandbits(128))) for i in range(count)]
+    publs = []
+    for i, pubid in enumerate(ids):
+        day = datetime_string(2025, 1 + i % 12, 1 + i % 28)
+        persons = []
+        for j in range(rng.randint(authors[0], authors[1])):
+            orgs = []
+            for k in range(rng.randint(1, affiliations) if affiliations > 1 else 1):
+                dept = rng.randrange(len(departments))
+                chalmers = (j == 0 and k == 0) or rng.random() < 0.7
+                org = {'Id': 'org-' + str(dept if chalmers else 100 + dept), 'Country': 'Sweden', 'City': 'Gothenburg',
+                       'NameEng': departments[dept] if chalmers else 'University of Gothenburg',
+                       'DisplayPathEng': ('Chalmers, ' if chalmers else 'University of Gothenburg, ') + departments[dept],
+                       'OrganizationTypes': [{'NameEng': 'Chalmers department' if chalmers else 'University'}],
+                       'Identifiers': [] if chalmers else [{'Type': {'Value': 'ROR_ID'}, 'Value': 'https://ror.org/01tm6cn81'}]}
+                orgs.append({'OrganizationData': org})
+            persons.append({'PersonData': {'FirstName': rng.choice(first_names), 'LastName': rng.choice(last_names),
+                                           'IdentifierOrcid': ['0000-0002-' + str(rng.randint(1000, 9999)) + '-' + str(rng.randint(1000, 9999))] if rng.random() < 0.6 else []},
+                            'Organizations': orgs})
+        pubtype = rng.choice(cris_pubtypes) if mixed else 'Doctoral thesis'
+        publ = {
+            'Id': pubid,
+            'Title': rng.choice(['', 'On the ', 'Towards ']) + 'modelling of CO<sub>2</sub> transport in ' + rng.choice(['porous', 'fibrous', 'granular']) + ' media ' + str(i),
+            'Abstract': '<p>' + 'The thesis studies transport phenomena in fibre networks &amp; membranes. ' * rng.randint(paragraphs[0], paragraphs[1]) + '</p>',
+            'Year': 2025, 'Language': {'Iso': 'en'},
+            'IdentifierDoi': [doi_prefix + '/cth.diss/' + str(i)],
+            'IdentifierIsbn': ['978-91-8103-' + str(i % 1000).zfill(3) + '-' + str(i % 10)],
+            'IdentifierCplPubid': [str(500000 + i)],
+            'DispDate': day, 'LatestEventDate': day, 'UpdatedDate': day, 'CreatedDate': day,
+            'PublicationType': {'NameEng': pubtype},
+            'Identifiers': [],
+            'IncludedPapers': [{'Publication': rng.choice(ids)} for k in range(rng.randint(0, 4))],
+            'Series': [], 'Keywords': [],
+            'Persons': persons,
+        }
+        if pubtype == 'Paper in proceeding':
+            publ['Conference'] = {'Name': 'Conference on Transport Phenomena ' + str(i), 'City': 'Gothenburg', 'Country': {'NameEng': 'Sweden'},
+                                  'StartDate': day[:10], 'EndDate': day[:10]}
+        publs.append(publ)
+    return publs
+
+
+def datetime_string(year, month, day):
+    return str(year) + '-' + str(month).zfill(2) + '-' + str(day).zfill(2) + 'T10:00:00'
+
+
+def load_publications(path):
+    # Recorded publications: a saved CRIS search response (with Publications) or JSON lines
+    with open(path, 'r') as cfile:
+        content = cfile.read()
+    try:
+        publs = json.loads(content)
+        return publs['Publications'] if isinstance(publs, dict) else publs
+    except ValueError:
+        return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+class StandIn:
+    # State and behaviour of the stand-in services (shared by the request handler threads)
+
+    def __init__(self, publs, seed=1, cris_latency=0.0, cris_error_rate=0.0, deposit_latency=0.0, deposit_error_rate=0.0,
+                 doi_latency=0.0, existing_rate=0.0, processing_time=0.0, failure_rate=0.0):
+        self.publs = {str(publ['Id']): publ for publ in publs}
+        self.order = [str(publ['Id']) for publ in publs]
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.cris_latency = cris_latency
+        self.cris_error_rate = cris_error_rate
+        self.deposit_latency = deposit_latency
+        self.deposit_error_rate = deposit_error_rate
+        self.doi_latency = doi_latency
+        self.existing_rate = existing_rate
+        self.processing_time = processing_time
+        self.failure_rate = failure_rate
+        self.lock = threading.Lock()
+        self.submissions = {}
+        self.registered = set()
+        self.counters = {}
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def fails(self, rate):
+        with self.lock:
+            return rate > 0 and self.rng.random() < rate
+
+    def existing(self, doi):
+        # DOIs that are already registered: deposited here, or a fixed share (existing_rate) of the others
+        if doi in self.registered:
+            return True
+        digest = hashlib.sha1((str(self.seed) + doi).encode('utf-8')).digest()
+        return int.from_bytes(digest[:4], 'big') / 2 ** 32 < self.existing_rate
+
+    def search(self, query, start, max_records, selected_fields):
+        query = unquote(query)
+        ids = re.findall(r'(?<![\w.])Id:"([^"]+)"', query)
+        if ids:
+            matches = [pubid for pubid in ids if pubid in self.publs]
+        else:
+            matches = self.order
+        since = re.search(r'LatestEventDate:\[\"?([0-9T:\-]+)\"?\s+TO', query)
+        if since:
+            matches = [pubid for pubid in matches if str(self.publs[pubid].get('LatestEventDate', '')) >= since.group(1)]
+        # CreatedDate:[from TO *] or CreatedDate:[from TO to} (end exclusive)
+        created = re.search(r'CreatedDate:\[\"?([0-9T:\-]+)\"?\s+TO\s+\"?([0-9T:\-]+|\*)\"?([\]}])', query)
+        if created:
+            low, high, bracket = created.groups()
+            matches = [pubid for pubid in matches if str(self.publs[pubid].get('CreatedDate', '')) >= low
+                       and (high == '*' or str(self.publs[pubid].get('CreatedDate', ''))[:len(high)] < high
+                            or (bracket == ']' and str(self.publs[pubid].get('CreatedDate', ''))[:len(high)] == high))]
+        page = [self.publs[pubid] for pubid in matches[start:start + max_records]]
+        if selected_fields:
+            keep = set(field.split('.')[0] for field in selected_fields.split(','))
+            page = [{key: value for key, value in publ.items() if key in keep} for publ in page]
+        return {'TotalCount': len(matches), 'Publications': page}
+
+    def submit(self, xml_bytes):
+        root = ET.fromstring(xml_bytes)
+        batch_id = None
+        dois = []
+        for element in root.iter():
+            tag = element.tag.split('}')[-1]
+            if tag == 'doi_batch_id':
+                batch_id = element.text
+            elif tag == 'doi':
+                dois.append(element.text)
+        with self.lock:
+            results = {doi: 'Failure' if self.failure_rate > 0 and self.rng.random() < self.failure_rate else 'Success' for doi in dois}
+            self.submissions[batch_id] = (time.monotonic(), results)
+        self.count('deposited_records', len(dois))
+        return batch_id
+
+    def result(self, batch_id):
+        with self.lock:
+            submission = self.submissions.get(batch_id)
+        if submission is None:
+            return '<doi_batch_diagnostic status="unknown"><batch_id>' + str(batch_id) + '</batch_id></doi_batch_diagnostic>'
+        submitted, results = submission
+        if time.monotonic() - submitted < self.processing_time:
+            return '<doi_batch_diagnostic status="in_process"><batch_id>' + batch_id + '</batch_id></doi_batch_diagnostic>'
+        diagnostic = ET.Element('doi_batch_diagnostic', status='completed')
+        ET.SubElement(diagnostic, 'batch_id').text = batch_id
+        for doi, status in results.items():
+            record = ET.SubElement(diagnostic, 'record_diagnostic', status=status)
+            ET.SubElement(record, 'doi').text = doi
+            ET.SubElement(record, 'msg').text = 'Successfully added' if status == 'Success' else 'Record not processed'
+            if status == 'Success':
+                with self.lock:
+                    self.registered.add(doi)
+        return ET.tostring(diagnostic, encoding='unicode')
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    standin = None
+    verbose = False
+
+    def reply(self, status, body=b'', content_type='application/json', headers=None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if len(body) > 1024 and 'gzip' in self.headers.get('Accept-Encoding', '') and self.command != 'HEAD':
+            body = gzip.compress(body, compresslevel=5)
+            headers = dict(headers or {}, **{'Content-Encoding': 'gzip'})
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def cris_delay(self):
+        standin = self.standin
+        standin.count('cris_requests')
+        time.sleep(standin.cris_latency)
+        if standin.fails(standin.cris_error_rate):
+            standin.count('cris_errors')
+            self.reply(503, b'{"error": "unavailable"}', headers={'Retry-After': '1'})
+            return True
+        return False
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+        standin = self.standin
+        if url.path.startswith('/cris/publications'):
+            if self.cris_delay():
+                return
+            pubid = unquote(url.path[len('/cris/publications'):].strip('/'))
+            if pubid:
+                publ = standin.publs.get(pubid)
+                if publ is None:
+                    return self.reply(404, b'{}')
+                return self.reply(200, json.dumps(publ), headers={'ETag': etag(publ)})
+            page = standin.search(url.query.split('query=', 1)[1].split('&', 1)[0] if 'query=' in url.query else '',
+                                  int(params.get('start', ['0'])[0]), int(params.get('max', ['50'])[0]),
+                                  params.get('selectedFields', [''])[0])
+            return self.reply(200, json.dumps(page))
+        if url.path.startswith('/crossref/servlet/submissionDownload'):
+            standin.count('status_requests')
+            return self.reply(200, standin.result(params.get('doi_batch_id', [''])[0]), 'text/xml')
+        if url.path.startswith('/doi/'):
+            return self.do_HEAD()
+        if url.path == '/stats':
+            with standin.lock:
+                stats = dict(standin.counters, registered=len(standin.registered), submissions=len(standin.submissions))
+            return self.reply(200, json.dumps(stats))
+        self.reply(404, b'{}')
+
+    def do_HEAD(self):
+        url = urlsplit(self.path)
+        standin = self.standin
+        if not url.path.startswith('/doi/'):
+            return self.reply(404)
+        standin.count('doi_requests')
+        time.sleep(standin.doi_latency)
+        doi = unquote(url.path[len('/doi/'):])
+        if standin.existing(doi):
+            return self.reply(302, headers={'Location': 'https://research.chalmers.se/'})
+        self.reply(404)
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        standin = self.standin
+        body = self.body()
+        if not url.path.startswith('/crossref/servlet/deposit'):
+            return self.reply(404)
+        standin.count('deposit_requests')
+        time.sleep(standin.deposit_latency)
+        if standin.fails(standin.deposit_error_rate):
+            standin.count('deposit_errors')
+            return self.reply(503, b'<html>Service unavailable</html>', 'text/html', headers={'Retry-After': '1'})
+        start = body.find(b'<?xml')
+        end = body.rfind(b'</doi_batch>')
+        if start < 0 or end < 0:
+            return self.reply(400, b'<html>No deposit file</html>', 'text/html')
+        standin.submit(body[start:end + len(b'</doi_batch>')])
+        self.reply(200, b'<html><body><h2>SUCCESS</h2><p>Your batch submission was successfully received.</p></body></html>', 'text/html')
+
+    def do_PUT(self):
+        url = urlsplit(self.path)
+        standin = self.standin
+        body = self.body()
+        if not url.path.startswith('/cris/publications/'):
+            return self.reply(404)
+        if self.cris_delay():
+            return
+        pubid = unquote(url.path[len('/cris/publications/'):].strip('/'))
+        with standin.lock:
+            publ = standin.publs.get(pubid)
+            if publ is None:
+                return self.reply(404, b'{}')
+            if self.headers.get('If-Match') and self.headers['If-Match'] != etag(publ):
+                return self.reply(412, b'{}')
+            standin.publs[pubid] = json.loads(body)
+        standin.count('cris_updates')
+        self.reply(200, b'{}')
+
+    def log_message(self, format, *args):
+        if self.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def etag(publ):
+    return '"' + hashlib.sha1(str(publ.get('UpdatedDate')).encode('utf-8')).hexdigest()[:16] + '"'
+
+
+def serve(standin, host='127.0.0.1', port=8080, verbose=False):
+    # Start the stand-in in a background thread, returns the server (server.shutdown() to stop)
+    handler = type('StandInHandler', (Handler,), {'standin': standin, 'verbose': verbose})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='standin', daemon=True).start()
+    return server
+
+
+parser = ArgumentParser(description='Local CRIS / CrossRef / doi.org stand-in for the Research2CrossRef scripts.', formatter_class=ArgumentDefaultsHelpFormatter)
+parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
+parser.add_argument('--records', type=int, default=200, help='Synthetic publications')
+parser.add_argument('--corpus', help='Recorded publications (saved CRIS search response or JSON lines) instead of synthetic ones')
+parser.add_argument('--dump', help='Write the publications that are served to this file (JSON) and continue')
+parser.add_argument('--seed', type=int, default=1, help='Random seed (records, errors, existing DOIs)')
+parser.add_argument('--doi-prefix', default='10.63959', help='DOI prefix of the synthetic records')
+parser.add_argument('--cris-latency', type=float, default=0.0, help='Seconds per CRIS request')
+parser.add_argument('--cris-error-rate', type=float, default=0.0, help='Share of CRIS requests answered with 503')
+parser.add_argument('--deposit-latency', type=float, default=0.0, help='Seconds per CrossRef deposit')
+parser.add_argument('--deposit-error-rate', type=float, default=0.0, help='Share of CrossRef deposits answered with 503')
+parser.add_argument('--doi-latency', type=float, default=0.0, help='Seconds per doi.org check')
+parser.add_argument('--existing-rate', type=float, default=0.0, help='Share of DOIs that already exist at doi.org')
+parser.add_argument('--processing-time', type=float, default=0.0, help='Seconds before a submission result is completed')
+parser.add_argument('--failure-rate', type=float, default=0.0, help='Share of deposited records that CrossRef rejects')
+parser.add_argument('-v', '--verbose', action='store_true', help='Log every request')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    publs = load_publications(args.corpus) if args.corpus else synthetic_publications(args.records, args.seed, args.doi_prefix)
+    if args.dump:
+        with open(args.dump, 'w') as dfile:
+            json.dump({'TotalCount': len(publs), 'Publications': publs}, dfile)
+    standin = StandIn(publs, seed=args.seed, cris_latency=args.cris_latency, cris_error_rate=args.cris_error_rate,
+                      deposit_latency=args.deposit_latency, deposit_error_rate=args.deposit_error_rate,
+                      doi_latency=args.doi_latency, existing_rate=args.existing_rate,
+                      processing_time=args.processing_time, failure_rate=args.failure_rate)
+    server = serve(standin, args.host, args.port, args.verbose)
+    print('Stand-in serving ' + str(len(publs)) + ' publications on http://' + args.host + ':' + str(args.port) + '/ (Ctrl-C to stop)')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+import html
+import re
+from functools import lru_cache
+from html.entities import name2codepoint
+
+from bs4 import BeautifulSoup
+
+# Cleaning of CRIS title and abstract strings (HTML) into plain text for the deposit XML.
+#
+# clean_text(text) gives the same result as BeautifulSoup(text.rstrip('\r\n').strip(), "lxml").text,
+# but avoids building a document tree for the common cases:
+# - plain strings (no markup, entities or control characters) are returned as they are
+# - simple inline markup (<p>, <i>, <sub>, ... and HTML 4 / numeric entities) is stripped directly
+# - everything else (comments, scripts, unknown tags, stray '<', odd whitespace, byte order marks, which the
+#   parser drops at the start of the document) still goes to BeautifulSoup
+# Results are cached, since the same titles and abstracts come back on every run.
+
+_needs_parsing = re.compile('[<&\r\x00-\x08\x0b\x0c\x0e-\x1f\x7f-\x9f\ufeff]')
+_control = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\x7f-\x9f\ufeff]')
+_tag = re.compile(r'<(/?)([A-Za-z][A-Za-z0-9]*)((?:\s[^<>]*)?)/?>')
+_entity = re.compile(r'&(?:([A-Za-z][A-Za-z0-9]*)|#([0-9]{1,7})|#[xX]([0-9A-Fa-f]{1,6}));')
+
+inline_tags = {'a', 'b', 'br', 'em', 'i', 'p', 's', 'small', 'span', 'strong', 'sub', 'sup', 'u'}
+
+
+def _valid_codepoint(codepoint):
+    # Characters that the parser and html.unescape decode the same way (no controls or noncharacters)
+    if 0xfdd0 <= codepoint <= 0xfdef or codepoint & 0xfffe == 0xfffe:
+        return False
+    return (codepoint in (9, 10) or 0x20 <= codepoint <= 0x7e or 0xa0 <= codepoint <= 0xd7ff
+            or 0xe000 <= codepoint <= 0x10ffff)
+
+
+def _unescape(segment):
+    # Decode the entities of a text segment, None if any '&' is not a plain HTML 4 or numeric entity
+    if '&' not in segment:
+        return segment
+    pos = 0
+    while True:
+        pos = segment.find('&', pos)
+        if pos < 0:
+            break
+        m = _entity.match(segment, pos)
+        if m is None:
+            return None
+        if m.group(1) is not None:
+            if m.group(1) not in name2codepoint:
+                return None
+        elif not _valid_codepoint(int(m.group(2), 10) if m.group(2) is not None else int(m.group(3), 16)):
+            return None
+        pos = m.end()
+    return html.unescape(segment)
+
+
+def strip_simple_markup(text):
+    # Plain text of a string with simple inline markup only, None if it needs a real HTML parser
+    if _control.search(text):
+        return None
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    segments = []
+    pos = 0
+    for m in _tag.finditer(text):
+        if m.group(2).lower() not in inline_tags:
+            return None
+        attributes = m.group(3)
+        if attributes.count('"') % 2 or attributes.count("'") % 2:
+            return None
+        segments.append(text[pos:m.start()])
+        pos = m.end()
+    segments.append(text[pos:])
+
+    parts = []
+    previous_blank = False
+    for segment in segments:
+        if '<' in segment:
+            return None
+        if segment:
+            blank = not segment.strip()
+            if blank and (previous_blank or segment not in (' ', '\n')):
+                # The parser collapses other whitespace-only text between elements
+                return None
+            previous_blank = blank
+        segment = _unescape(segment)
+        if segment is None:
+            return None
+        parts.append(segment)
+    result = ''.join(parts)
+    if result != result.strip():
+        return None
+    return result
+
+
+@lru_cache(maxsize=4096)
+def _clean(text):
+    text = text.rstrip('\r\n').strip()
+    if not _needs_parsing.search(text):
+        return text
+    result = strip_simple_markup(text)
+    if result is None:
+        result = BeautifulSoup(text, "lxml").text
+    return result
+
+
+def clean_text(text):
+    if not text:
+        return ''
+    return _clean(str(text))